@@ -0,0 +1,128 @@
+"""
+Develop the raw Bayer frames captured by the Raspberry Pi telecine
+in raw capture mode (capture_mode = raw in the job ini file).
+
+Run it on the PC from the folder with the job's .raw files and the
+raw-frames.csv file written during the capture. The csv file has the
+perforation position, crop, and white balance gains of each frame.
+
+Each frame is cropped on the Bayer mosaic first - so only the pixels
+that are kept are processed - then the 10 bit data is unpacked,
+demosaiced with bilinear interpolation, white balanced and written
+as a 16 bit png. All of the processing is vectorized with Numpy and
+the frames are shared between worker processes, one per core by default.
+
+Usage: python develop-raw.py [-o output_folder] [-p processes] [-b black_level] [-f]
+-f writes the full frame instead of the crop.
+"""
+
+from __future__ import division
+
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import numpy as np
+import cv2
+
+# The layout of the raw data and the Bayer offsets are shared with the
+# telecine software, in rpiTelecine/frames.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rpiTelecine'))
+from frames import bayerOffsets, rawBayerFrame
+
+# Layout of the raw data from the OV5647 (V1) camera
+header_size = rawBayerFrame.headerSize
+raw_shape = rawBayerFrame.rawShape
+image_size = rawBayerFrame.imageSize
+
+def read_raw(fn):
+    # Returns the Bayer order and the 10 bit mosaic as uint16
+    data = np.fromfile(fn, dtype=np.uint8)
+    if data[:4].tostring() != b'BRCM':
+        raise Exception('{} does not contain raw Bayer data'.format(fn))
+    order = int(data[176+68])
+    rows, cols = image_size
+    data = data[header_size:].reshape(raw_shape)[:rows, :(cols*5)//4]
+    data = data.reshape(rows, cols//4, 5).astype(np.uint16)
+    # First 4 bytes are the top 8 bits of 4 pixels, the fifth holds
+    # the bottom 2 bits of each
+    low = data[:, :, 4]
+    mosaic = np.empty((rows, cols//4, 4), dtype=np.uint16)
+    for i in range(4):
+        mosaic[:, :, i] = (data[:, :, i] << 2) | ((low >> (i*2)) & 0b11)
+    return order, mosaic.reshape(rows, cols)
+
+def convolve3(img, kernel):
+    # 3x3 convolution using shifted views of an edge padded image
+    h, w = img.shape
+    p = np.pad(img, 1, mode='reflect')
+    out = np.zeros_like(img)
+    for dy in range(3):
+        for dx in range(3):
+            if kernel[dy][dx]:
+                out += kernel[dy][dx] * p[dy:dy+h, dx:dx+w]
+    return out
+
+def demosaic(mosaic, order):
+    # Bilinear demosaic - returns a float32 BGR image
+    (ry,rx), (gy,gx), (Gy,Gx), (by,bx) = bayerOffsets[order]
+    m = mosaic.astype(np.float32)
+    planes = []
+    for sites, kernel in ( ([(by,bx)], [[.25,.5,.25],[.5,1,.5],[.25,.5,.25]]),
+                           ([(gy,gx),(Gy,Gx)], [[0,.25,0],[.25,1,.25],[0,.25,0]]),
+                           ([(ry,rx)], [[.25,.5,.25],[.5,1,.5],[.25,.5,.25]]) ):
+        sparse = np.zeros_like(m)
+        for y, x in sites:
+            sparse[y::2, x::2] = m[y::2, x::2]
+        planes.append(convolve3(sparse, kernel))
+    return np.dstack(planes)
+
+def develop(job):
+    fn, outname, crop, gains, black_level = job
+    order, mosaic = read_raw(fn)
+    if crop is not None:
+        # Keep the crop origin on an even pixel so the Bayer order is unchanged
+        x, y, w, h = crop
+        x = max(0, x - x%2)
+        y = max(0, y - y%2)
+        mosaic = mosaic[y:y+h, x:x+w]
+    img = demosaic(mosaic, order) - black_level
+    img[:, :, 0] *= gains[1]
+    img[:, :, 2] *= gains[0]
+    # Scale 10 bit data up to 16 bits
+    img = np.clip(img * (65535.0/(1023-black_level)), 0, 65535).astype(np.uint16)
+    cv2.imwrite(outname, img)
+    return outname
+
+def read_frames(args):
+    # Reads the metadata csv file and creates the list of jobs
+    jobs = []
+    with open('raw-frames.csv', 'r') as f:
+        for row in csv.reader(f):
+            frame, fn, found, cx, cy, crop_x, crop_y, crop_w, crop_h, gain_r, gain_b, shutter = row
+            if not os.path.exists(fn):
+                print('Missing {}'.format(fn))
+                continue
+            crop = None if args.full else (int(crop_x), int(crop_y), int(crop_w), int(crop_h))
+            outname = os.path.join(args.output, os.path.splitext(fn)[0] + '.png')
+            jobs.append( (fn, outname, crop, (float(gain_r), float(gain_b)), args.black_level) )
+    return jobs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Develop raw telecine frames')
+    parser.add_argument('-o', '--output', default='.', help='Output folder')
+    parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count(), help='Number of worker processes')
+    parser.add_argument('-b', '--black-level', type=int, default=16, help='Sensor black level (10 bit)')
+    parser.add_argument('-f', '--full', action='store_true', help='Write full frames, not the crop')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    jobs = read_frames(args)
+    print('Developing {} frames with {} processes'.format(len(jobs), args.processes))
+    pool = multiprocessing.Pool(args.processes)
+    for outname in pool.imap(develop, jobs):
+        print(outname)
+    pool.close()
+    pool.join()
@@ -0,0 +1,71 @@
+"""
+Write the frames of a frame store back out as a file for each image.
+
+Jobs run with output_format = store in the job ini file keep all of the
+images in a few large files - frames.idx and frames-NNNN.dat in the job
+folder. Copy those to the PC, then run this to get the img-NNNNN files
+tc-run.py would otherwise have written. The images are written exactly
+as they were encoded on the Pi, nothing is decoded.
+
+If a frame was taken more than once - the job was run again over the
+same frames - the last one taken is written.
+
+Usage: python export-frames.py job_folder [-o output_folder] [-s start] [-e end] [--no-failed] [-l]
+-l lists the frames in the store instead of writing them.
+"""
+
+from __future__ import division
+
+import argparse
+import os
+import sys
+import time
+
+# The store is read with rpiTelecine/store.py from the telecine software
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rpiTelecine'))
+from store import frameStoreReader, failedFlag
+
+def selected(reader, args):
+    # Indexes of the images to export, the last of each name
+    last = {}
+    for i,r in enumerate(reader.index):
+        if args.start is not None and r['frame'] < args.start:
+            continue
+        if args.end is not None and r['frame'] > args.end:
+            continue
+        if not args.failed and r['flags'] & failedFlag:
+            continue
+        last[reader.name(i)] = i
+    return sorted(last.values(), key=lambda i: reader.name(i))
+
+def list_frames(reader, indexes):
+    print('{:<24} {:>10} {:>9} {:>9}  {}'.format('name', 'bytes', 'perf x', 'perf y', 'taken'))
+    for i in indexes:
+        r = reader.index[i]
+        print('{:<24} {:>10d} {:>9.1f} {:>9.1f}  {}'.format( reader.name(i), int(r['length']), r['cx'], r['cy'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['captured'])) ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the frames of a telecine frame store to files')
+    parser.add_argument('store', help='Job folder with frames.idx')
+    parser.add_argument('-o', '--output', default='.', help='Output folder')
+    parser.add_argument('-s', '--start', type=int, help='First frame')
+    parser.add_argument('-e', '--end', type=int, help='Last frame')
+    parser.add_argument('--no-failed', dest='failed', action='store_false', help="Don't export full frames where the perforation wasn't found")
+    parser.add_argument('-l', '--list', action='store_true', help='List the frames instead of exporting them')
+    args = parser.parse_args()
+
+    reader = frameStoreReader(args.store)
+    indexes = selected(reader, args)
+    if args.list:
+        list_frames(reader, indexes)
+        quit()
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    print('Exporting {} of {} images'.format(len(indexes), len(reader)))
+    for i in indexes:
+        outname = os.path.join(args.output, reader.name(i))
+        with open(outname, 'wb') as f:
+            f.write( reader.data(i) )
+        print(outname)
+    reader.close()
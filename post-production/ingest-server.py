@@ -0,0 +1,185 @@
+"""
+Receive frames streamed from the Pi and write them as they arrive.
+
+Jobs run with output_format = stream in the job ini file send each image
+over the network instead of writing it to the SD card. Run this on the PC
+first, and set stream_host in the job ini file to the PC's address. The
+images are written to a folder named after the job, with the names
+tc-run.py would have used.
+
+Each image is acknowledged once it is written. The last sequence number
+written for each job is kept in .ingest-last in the job folder, so if the
+connection is lost, or the job is run again, the Pi carries on from there
+and nothing is written twice.
+
+Usage: python ingest-server.py [-o output_folder] [-p port] [-a address]
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# Messages - see rpiTelecine/stream.py
+streamVersion = 1
+helloFormat = '<4sHH'
+replyFormat = '<4sQ'
+frameFormat = '<4sQHIB'
+ackFormat = '<4sQ'
+compressedFlag = 1
+stateName = '.ingest-last'
+
+jobLocks = {}           # Held while a job is being received
+jobSockets = {}         # The connection receiving each job
+jobLocksLock = threading.Lock()
+
+def recvExactly(sock, n):
+    # Reads n bytes, or raises EOFError if the connection is closed first
+    parts = []
+    while n > 0:
+        data = sock.recv(min(n, 1<<16))
+        if not data:
+            raise EOFError('Connection closed')
+        parts.append(data)
+        n -= len(data)
+    return b''.join(parts)
+
+def safeName(name):
+    # Keeps names sent over the network inside the output folder
+    name = os.path.basename(name.replace('\\', '/'))
+    if name in ('', '.', '..'):
+        raise ValueError('Bad name: {!r}'.format(name))
+    return name
+
+def readLast(folder):
+    try:
+        with open(os.path.join(folder, stateName)) as f:
+            return int(f.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+def writeLast(folder, seq):
+    fn = os.path.join(folder, stateName)
+    with open(fn + '.tmp', 'w') as f:
+        f.write('{}\n'.format(seq))
+    os.rename(fn + '.tmp', fn)
+
+def writeFile(fn, data):
+    # Written under a temporary name first, so a file with the final name is complete
+    with open(fn + '.part', 'wb') as f:
+        f.write(data)
+    if os.path.exists(fn):
+        os.remove(fn)   # os.rename won't replace a file on Windows
+    os.rename(fn + '.part', fn)
+
+class ingestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer = '{}:{}'.format(*self.client_address[:2])
+        try:
+            magic,version,length = struct.unpack( helloFormat, recvExactly(sock, struct.calcsize(helloFormat)) )
+            if magic != b'TCST' or version != streamVersion:
+                print('{}: not a telecine stream'.format(peer))
+                return
+            job = safeName( recvExactly(sock, length).decode('utf8') )
+        except (EOFError, socket.error, ValueError) as e:
+            print('{}: {}'.format(peer, e))
+            return
+        # One connection per job at a time. When the Pi reconnects the old
+        # connection may not have noticed it was lost, so it is shut down
+        with jobLocksLock:
+            lock = jobLocks.setdefault(job, threading.Lock())
+            old = jobSockets.get(job)
+            if old is not None:
+                try:
+                    old.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        with lock:
+            with jobLocksLock:
+                jobSockets[job] = sock
+            try:
+                self.receive(sock, peer, job)
+            finally:
+                with jobLocksLock:
+                    if jobSockets.get(job) is sock:
+                        del jobSockets[job]
+
+    def receive(self, sock, peer, job):
+        folder = os.path.join(self.server.output, job)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        last = readLast(folder)
+        print('{}: job {}, carrying on after image {}'.format(peer, job, last))
+        sock.sendall( struct.pack(replyFormat, b'TCOK', last) )
+        size = struct.calcsize(frameFormat)
+        count = 0
+        received = 0
+        start = time.time()
+        try:
+            while True:
+                try:
+                    header = recvExactly(sock, size)
+                except EOFError:
+                    break
+                magic,seq,nameLength,length,flags = struct.unpack(frameFormat, header)
+                if magic != b'TCFR':
+                    print('{}: lost track of the stream'.format(peer))
+                    break
+                name = safeName( recvExactly(sock, nameLength).decode('utf8') )
+                data = recvExactly(sock, length)
+                received += length
+                if seq > last:
+                    if flags & compressedFlag:
+                        data = zlib.decompress(data)
+                    writeFile(os.path.join(folder, name), data)
+                    last = seq
+                    writeLast(folder, last)
+                    count += 1
+                    if not self.server.quiet:
+                        print('{}/{} {} bytes'.format(job, name, len(data)))
+                # Anything up to seq is written - images sent again that
+                # were already written are only acknowledged
+                sock.sendall( struct.pack(ackFormat, b'TCAK', seq) )
+        except (EOFError, socket.error, ValueError) as e:
+            print('{}: {}'.format(peer, e))
+        secs = max(time.time()-start, 1e-6)
+        print('{}: job {} - {} images written, {:.1f} MB received at {:.1f} MB/sec'.format(
+                peer, job, count, received/1e6, received/secs/1e6))
+
+class ingestServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def main():
+    parser = argparse.ArgumentParser(description='Receive frames streamed by tc-run.py')
+    parser.add_argument('-o','--output', default='.', help='Folder to write the job folders in')
+    parser.add_argument('-p','--port', type=int, default=7390, help='Port to listen on')
+    parser.add_argument('-a','--address', default='', help='Address to listen on - every interface by default')
+    parser.add_argument('-q','--quiet', action='store_true', help="Don't print each image written")
+    args = parser.parse_args()
+
+    server = ingestServer( (args.address, args.port), ingestHandler )
+    server.output = args.output
+    server.quiet = args.quiet
+    print('Listening on {}:{}, writing to {}'.format(args.address or '*', args.port, os.path.abspath(args.output)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
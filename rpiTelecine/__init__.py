@@ -33,18 +33,79 @@ from rpiTelecine.config import (
     telecineConfig,
     )
 
-from rpiTelecine.camera import (
-    TelecineCamera,
-    )
+# The camera and control board need the Pi's picamera and wiringpi2
+# modules. Without them only the replay camera and control can be used
+try:
+    from rpiTelecine.camera import (
+        TelecineCamera,
+        )
+except ImportError:
+    TelecineCamera = None
+
+try:
+    from rpiTelecine.control import (
+        tcControl,
+        )
+except ImportError:
+    tcControl = None
 
-from rpiTelecine.control import (
-    tcControl,
+from rpiTelecine.replay import (
+    replayCamera,
+    replayControl,
     )
 
 from rpiTelecine.perforation import (
     telecinePerforation,
     filmTypes,
+    reductionTypes,
+    )
+
+from rpiTelecine.engines import (
+    detectionResult,
+    thresholdEngine,
+    segmentsEngine,
+    templateEngine,
+    dualEngine,
+    engineTypes,
+    defaultEngines,
+    registerEngine,
+    makeEngines,
+    compareEngines,
     )
 
+from rpiTelecine.frames import (
+    frameRing,
+    )
+
+from rpiTelecine.encoder import (
+    processEncoder,
+    effortController,
+    encodeLevels,
+    )
 
+from rpiTelecine.trace import (
+    frameTrace,
+    )
 
+from rpiTelecine.store import (
+    frameStore,
+    frameStoreReader,
+    isStore,
+    )
+
+from rpiTelecine.metrics import (
+    metricsRegistry,
+    metricsServer,
+    jobMetrics,
+    )
+
+from rpiTelecine.stream import (
+    frameStreamer,
+    )
+
+from rpiTelecine.journal import (
+    jobJournal,
+    readJournal,
+    resumePoint,
+    syncFiles,
+    )
@@ -52,6 +52,8 @@ from picamera import PiCamera
 import picamera.array 
 import time
 
+from rpiTelecine.frames import bgrBufferPool, captureBuffer, rawBayerFrame, yuvFrame
+
 # Subclass of PiCamera
 
 class TelecineCamera( PiCamera ):
@@ -63,6 +65,11 @@ class TelecineCamera( PiCamera ):
         self.framerate = 15              # Maximum allowed for full frame stills/preview/video 
         self.iso=100                     # Fix ISO for minimum sensor gain
         self.image_denoise=False         # Switch off image denoise - speeds up capture and retains detail in image
+        self._raw_output = None          # Reused buffer for raw captures
+        self._yuv_frames = []            # Reused buffers for yuv captures
+        self.base_shutter = self.shutter_speed
+        self.bracket_stops = []          # Exposure schedule in stops
+        self.bracket_shutters = []       # Shutter speed for each exposure in the schedule
  
     def setup_cam(self,awb_gains,shutter,drc='off',effect='none'):
         """ 
@@ -73,6 +80,7 @@ class TelecineCamera( PiCamera ):
         self.awb_gains=awb_gains
         self.awb_mode='off'              # Fix the awb_gains
         self.shutter_speed=shutter       # Fix shutter speed
+        self.base_shutter=shutter
         self.sharpness = -100            # Reduce sharpening to minimum. Too much sharpening introduces artefacts into image
         if effect in self.IMAGE_EFFECTS:
             self.image_effect = effect
@@ -88,22 +96,137 @@ class TelecineCamera( PiCamera ):
             self.capture(output, format='bgr')
             return output.array 
 
-    def take_bracket_pictures(self):
+    def set_sensor_crop(self, crop=None, mirror=None):
+        """
+        Only capture part of the sensor - crop is (x,y,w,h) in pixels of
+        the full image, or None to capture the full image again.
+        The width is rounded up to a multiple of 32 and the height to 16, 
+        so the camera doesn't pad the image. Returns the crop actually used.
+        The zoom rectangle is in sensor coordinates, before the vflip - 
+        mirror (defaults to vflip) turns it upside down to match.
+        """
+        W,H = self.MAX_IMAGE_RESOLUTION
+        if crop is None:
+            self.zoom = (0.0, 0.0, 1.0, 1.0)
+            self.resolution = (W,H)
+            return (0,0,W,H)
+        x,y,w,h = crop
+        w = min( W, (w+31)//32*32 )
+        h = min( H, (h+15)//16*16 )
+        x = min( max(0, x - x%2), W-w )
+        y = min( max(0, y - y%2), H-h )
+        if mirror is None:
+            mirror = self.vflip
+        zy = H-(y+h) if mirror else y
+        self.zoom = ( x/W, zy/H, w/W, h/H )
+        self.resolution = (w,h)
+        return (x,y,w,h)
+
+    def yuv_frame(self,n=0):
+        """
+        Returns the n'th reusable yuvFrame buffer, ready to capture into.
+        New buffers are made if the resolution has changed.
+        """
+        if self._yuv_frames and self._yuv_frames[0].resolution != tuple(self.resolution):
+            self._yuv_frames = []
+        while len(self._yuv_frames) <= n:
+            self._yuv_frames.append( yuvFrame(self.resolution) )
+        frame = self._yuv_frames[n]
+        frame.reset()
+        return frame
+
+    def take_yuv_picture(self):
+        """
+        Returns a yuvFrame - the luma plane can be used directly
+        as a greyscale image. The frame's buffer is reused by the next
+        yuv capture, so anything needed from it should be copied or
+        converted before then.
+        """
+        frame = self.yuv_frame()
+        self.capture(frame, format='yuv')
+        return frame
+
+    def take_raw_picture(self):
+        """
+        Returns a rawBayerFrame holding the undemosaiced sensor data.
+        The jpeg the raw data is attached to is thrown away, so is
+        taken at low quality to keep it small.
+        """
+        if self._raw_output is None:
+            # Room for the jpeg as well as the raw data
+            self._raw_output = captureBuffer( rawBayerFrame.rawSize*2 )
+        self._raw_output.reset()
+        self.capture(self._raw_output, format='jpeg', bayer=True, quality=10)
+        return rawBayerFrame( self._raw_output.tail(rawBayerFrame.rawSize) )
+
+    def continuous_pictures(self, buffers=3):
+        """
+        Generator returning openCV compatible colour images taken
+        through the video port. This avoids the still port mode switch
+        on each capture, and the images are written into a small pool
+        of preallocated buffers rather than a new array each time.
+        Each image is only valid until another 'buffers' images have
+        been taken - copy anything that needs to be kept longer.
+        """
+        self.video_denoise = False       # As image_denoise for the stills port
+        pool = bgrBufferPool(self.resolution, buffers)
+        captures = self.capture_continuous(pool, format='bgr', use_video_port=True)
+        try:
+            for output in captures:
+                yield pool.next_frame()
+        finally:
+            captures.close()
+
+    def setup_brackets(self, stops=(0,2)):
+        """
+        Sets the exposure schedule for take_bracket_pictures. stops is a
+        list of exposures in stops relative to the job's shutter speed,
+        e.g. (-1,0,2).
+        The gains are locked so that changing the shutter speed is the
+        only thing that changes between exposures - call this after some
+        pictures have been taken, so the gains have settled.
+        The frame rate is lowered if needed so the longest exposure fits
+        in one frame period, and doesn't have to wait for the sensor.
+        """
+        self.bracket_stops = list(stops)
+        self.bracket_shutters = [ int(round(self.base_shutter * 2**s)) for s in stops ]
+        longest = max(self.bracket_shutters)
+        if longest > 1000000/self.framerate:
+            self.framerate = 1000000/longest
+        self.exposure_mode = 'off'
+        self._bracket_shutter = self.shutter_speed
+        self._bracket_reverse = False
+
+    def take_bracket_pictures(self,yuv=False):
 	""" 
-	Returns two images in a list
-	One with normal exposure, and one with 2 stop longer exposure 
+	Returns a list of images, one for each exposure in the schedule set by
+	setup_brackets - by default one normal exposure and one 2 stops longer.
 	The aim to to get detail out of shadows/underexposed film
 	Resulting images can be combined on a PC with Hugin's enfuse utility
+	If yuv is True, yuvFrames are returned instead of BGR images
+	
+	The exposures are taken in reverse order on every other call, so the
+	shutter speed is already right for the first exposure of each frame,
+	and only changes within the bracket. The list is always returned in
+	the order of the schedule.
 	"""
-	old_shutter = self.shutter_speed
-	imgs = []
-	with picamera.array.PiRGBArray(self) as output:
-	    self.capture(output, format='bgr')
-	    imgs.append( output.array )
-	    self.shutter_speed = old_shutter*4
-	    output.truncate(0)
-	    self.capture(output, format='bgr')
-	    imgs.append( output.array )
-	self.shutter_speed = old_shutter
+	if not self.bracket_shutters:
+	    self.setup_brackets()
+	n = len(self.bracket_shutters)
+	imgs = [None]*n
+	order = range(n)
+	if self._bracket_reverse:
+	    order.reverse()
+	for i in order:
+	    if self._bracket_shutter != self.bracket_shutters[i]:
+		self._bracket_shutter = self.bracket_shutters[i]
+		self.shutter_speed = self._bracket_shutter
+	    if yuv:
+		imgs[i] = self.yuv_frame(i)
+		self.capture(imgs[i], format='yuv')
+	    else:
+		with picamera.array.PiRGBArray(self) as output:
+		    self.capture(output, format='bgr')
+		    imgs[i] = output.array
+	self._bracket_reverse = not self._bracket_reverse
 	return imgs
-	
@@ -35,6 +35,8 @@ from __future__ import division
 import os
 import ConfigParser
 
+from rpiTelecine.engines import engineTypes, defaultEngines
+
 
 
 class telecineConfig():
@@ -46,6 +48,7 @@ class telecineConfig():
     awb_gains = [1.5,1.5]
     show_gray = False
     brackets = False
+    bracket_stops = [0,2] # Exposure of each bracket in stops relative to shutter_speed
     
     # Dynamic Range Compression
     drc_values = ('off','low','medium','high')
@@ -55,6 +58,38 @@ class telecineConfig():
         'blur','film',  'colorswap','sketch','oilpaint','hatch','pastel','watercolor',\
         'posterise','colorpoint','cartoon')
     image_effect = 'none'
+
+    # Camera capture mode - still port, continuous capture through the video port,
+    # raw Bayer data to be developed on the host, or yuv stills
+    capture_mode_values = ('still','continuous','raw','yuv')
+    capture_mode = 'still'
+    capture_buffers = 3 # Number of image buffers used in continuous capture
+    writer_threads = 2 # Number of threads encoding and writing images
+    writer_processes = 0 # Encode in this many worker processes instead of threads, 0 for threads
+    write_buffer = 100 # MB of memory for images waiting to be written by the threads
+    png_compression = -1 # Most PNG compression used when the writers keep up, -1 for OpenCV's default
+    jpeg_quality = 95
+    jpeg_quality_floor = 95 # Lowest JPEG quality used when the writers fall behind
+    output_format_values = ('files','store','stream')
+    output_format = 'files' # A file for each image, a frame store in the job folder, or streamed to the PC
+    store_chunk_size = 1000 # MB in each chunk file of a frame store
+    stream_host = '' # Address of the PC running ingest-server.py when streaming
+    stream_port = 7390
+    stream_window = 8 # Images sent before waiting for the server to acknowledge them
+    stream_compress = False # zlib compress the streamed images - worthwhile for raw frames
+    stream_timeout = 60 # Seconds to keep trying to reach the ingest server before giving up
+    journal_batch = 25 # Frames written before they are synced to disk and recorded in the journal
+    metrics_port = 0 # Serve live metrics of a running job on this port, 0 for off
+    metrics_address = 'localhost' # Address to serve the metrics on, blank for every interface
+    # Crop on the sensor to the perforation ROI and film crop, once the perforation is found
+    sensor_crop = False
+    sensor_crop_margin = 100 # Pixels added around the sensor crop to allow for weave
+    # How the perforation detection reduces the ROI to a strip - see telecinePerforation
+    perf_reduction_values = ('median','partition','subsample','trimmed')
+    perf_reduction = 'median'
+    perf_tracking = False # Search a small window round the predicted perforation position
+    # Chain of perforation detection engines, tried in turn - see rpiTelecine.engines
+    perf_engines = list(defaultEngines)
     
     perf_size = [0,0] # Perforation size - w,h
     perf_cx = 0 # Perforation centre line - cx
@@ -108,8 +143,74 @@ class telecineConfig():
 	    self.crop_size[1] = self.config.getint(section, 'crop_h')
 	if 'brackets' in options:
 	    self.brackets = self.config.getboolean(section, 'brackets')
+	if 'bracket_stops' in options:
+	    self.bracket_stops = [ float(stop) for stop in self.config.get(section, 'bracket_stops').split(',') ]
 	if 'grayscale' in options:
 	    self.show_gray = self.config.getboolean(section, 'grayscale')
+	if 'capture_mode' in options:
+	    self.capture_mode = self.config.get(section, 'capture_mode')
+	    if self.capture_mode not in self.capture_mode_values:
+		print('Unknown capture mode: {} - using still'.format(self.capture_mode))
+		self.capture_mode = 'still'
+	if 'capture_buffers' in options:
+	    self.capture_buffers = self.config.getint(section, 'capture_buffers')
+	if 'writer_threads' in options:
+	    self.writer_threads = max(1, self.config.getint(section, 'writer_threads'))
+	if 'writer_processes' in options:
+	    self.writer_processes = max(0, self.config.getint(section, 'writer_processes'))
+	if 'write_buffer' in options:
+	    self.write_buffer = max(1, self.config.getint(section, 'write_buffer'))
+	if 'png_compression' in options:
+	    self.png_compression = min(max(self.config.getint(section, 'png_compression'), -1), 9)
+	if 'jpeg_quality' in options:
+	    self.jpeg_quality = min(max(self.config.getint(section, 'jpeg_quality'), 1), 100)
+	if 'jpeg_quality_floor' in options:
+	    self.jpeg_quality_floor = min(max(self.config.getint(section, 'jpeg_quality_floor'), 1), 100)
+	if 'output_format' in options:
+	    self.output_format = self.config.get(section, 'output_format')
+	    if self.output_format not in self.output_format_values:
+		print('Unknown output format: {} - using files'.format(self.output_format))
+		self.output_format = 'files'
+	if 'store_chunk_size' in options:
+	    self.store_chunk_size = max(1, self.config.getint(section, 'store_chunk_size'))
+	if 'stream_host' in options:
+	    self.stream_host = self.config.get(section, 'stream_host')
+	if 'stream_port' in options:
+	    self.stream_port = self.config.getint(section, 'stream_port')
+	if 'stream_window' in options:
+	    self.stream_window = max(1, self.config.getint(section, 'stream_window'))
+	if 'stream_compress' in options:
+	    self.stream_compress = self.config.getboolean(section, 'stream_compress')
+	if 'stream_timeout' in options:
+	    self.stream_timeout = max(1, self.config.getint(section, 'stream_timeout'))
+	if 'journal_batch' in options:
+	    self.journal_batch = max(1, self.config.getint(section, 'journal_batch'))
+	if 'metrics_port' in options:
+	    self.metrics_port = self.config.getint(section, 'metrics_port')
+	if 'metrics_address' in options:
+	    self.metrics_address = self.config.get(section, 'metrics_address')
+	if 'sensor_crop' in options:
+	    self.sensor_crop = self.config.getboolean(section, 'sensor_crop')
+	if 'sensor_crop_margin' in options:
+	    self.sensor_crop_margin = self.config.getint(section, 'sensor_crop_margin')
+	if 'perf_reduction' in options:
+	    self.perf_reduction = self.config.get(section, 'perf_reduction')
+	    if self.perf_reduction not in self.perf_reduction_values:
+		print('Unknown perforation reduction: {} - using median'.format(self.perf_reduction))
+		self.perf_reduction = 'median'
+	if 'perf_engines' in options:
+	    # Checked against the registry, so engines added with registerEngine can be used
+	    engines = [ e.strip() for e in self.config.get(section, 'perf_engines').split(',') if e.strip() ]
+	    unknown = [ e for e in engines if e not in engineTypes ]
+	    if not engines:
+		print('No perforation engines given - using {}'.format(','.join(defaultEngines)))
+		engines = list(defaultEngines)
+	    elif unknown:
+		print('Unknown perforation engine: {} - using {}'.format(','.join(unknown),','.join(defaultEngines)))
+		engines = list(defaultEngines)
+	    self.perf_engines = engines
+	if 'perf_tracking' in options:
+	    self.perf_tracking = self.config.getboolean(section, 'perf_tracking')
 	if 'ave_steps_fd' in options:
 	    self.ave_steps_fd = self.config.getint(section, 'ave_steps_fd')
 	else:
@@ -132,7 +233,31 @@ class telecineConfig():
 	    self.config.set('Telecine','gain_r','%.3f'%(self.awb_gains[0]))
 	    self.config.set('Telecine','gain_b','%.3f'%(self.awb_gains[1]))
 	    self.config.set('Telecine','brackets',str(self.brackets))
+	    self.config.set('Telecine','bracket_stops',','.join('%g'%stop for stop in self.bracket_stops))
 	    self.config.set('Telecine','grayscale',str(self.show_gray))
+	    self.config.set('Telecine','capture_mode',self.capture_mode)
+	    self.config.set('Telecine','capture_buffers',str(self.capture_buffers))
+	    self.config.set('Telecine','writer_threads',str(self.writer_threads))
+	    self.config.set('Telecine','writer_processes',str(self.writer_processes))
+	    self.config.set('Telecine','write_buffer',str(self.write_buffer))
+	    self.config.set('Telecine','png_compression',str(self.png_compression))
+	    self.config.set('Telecine','jpeg_quality',str(self.jpeg_quality))
+	    self.config.set('Telecine','jpeg_quality_floor',str(self.jpeg_quality_floor))
+	    self.config.set('Telecine','output_format',self.output_format)
+	    self.config.set('Telecine','store_chunk_size',str(self.store_chunk_size))
+	    self.config.set('Telecine','stream_host',self.stream_host)
+	    self.config.set('Telecine','stream_port',str(self.stream_port))
+	    self.config.set('Telecine','stream_window',str(self.stream_window))
+	    self.config.set('Telecine','stream_compress',str(self.stream_compress))
+	    self.config.set('Telecine','stream_timeout',str(self.stream_timeout))
+	    self.config.set('Telecine','journal_batch',str(self.journal_batch))
+	    self.config.set('Telecine','metrics_port',str(self.metrics_port))
+	    self.config.set('Telecine','metrics_address',self.metrics_address)
+	    self.config.set('Telecine','sensor_crop',str(self.sensor_crop))
+	    self.config.set('Telecine','sensor_crop_margin',str(self.sensor_crop_margin))
+	    self.config.set('Telecine','perf_reduction',self.perf_reduction)
+	    self.config.set('Telecine','perf_tracking',str(self.perf_tracking))
+	    self.config.set('Telecine','perf_engines',','.join(self.perf_engines))
 	    if self.perf_size != (0,0):
 		self.config.set('Telecine','perf_w','%d'%self.perf_size[0])
 		self.config.set('Telecine','perf_h','%d'%self.perf_size[1])
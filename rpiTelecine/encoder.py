@@ -0,0 +1,242 @@
+# RPi Telecine - Image encoding in worker processes
+#
+# Encoding a frame to PNG takes around a second on a Pi 2, which is longer
+# than taking it. Threads only help while OpenCV has released the GIL, so
+# the encoding is done in worker processes, one per core.
+#
+# Images are not pickled and sent to the workers. Instead there is a fixed
+# set of slots in shared memory, made before the workers are started. An
+# image is copied into a free slot and only the slot number, shape and file
+# name go through the queue. A worker puts the slot back on the free list
+# as soon as it has written the image, so the slots are recycled. When no
+# slot is free, put waits for one - the time waited is recorded.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import numpy as np
+import cv2
+
+def encodeLevels(ext, pngCompression=-1, jpegQuality=95, jpegFloor=95):
+    """
+    The encoding settings an effortController chooses from, as (level,
+    params) pairs from the most effort to the least.
+    PNG is always lossless - the levels go from pngCompression down to 1,
+    then OpenCV's default, which is tuned for speed. -1 is only the
+    default and 0 only no compression. JPEG quality goes down from
+    jpegQuality to jpegFloor in steps of 5, so there is nothing to choose
+    unless the floor is lower.
+    """
+    if ext == 'png':
+        if pngCompression == 0:
+            # No compression at all
+            return [ ('png0', [int(cv2.IMWRITE_PNG_COMPRESSION), 0]) ]
+        levels = [ ('png{}'.format(c), [int(cv2.IMWRITE_PNG_COMPRESSION), c]) for c in range(pngCompression,0,-1) ]
+        return levels + [ ('png', []) ]
+    qualities = range(jpegQuality, jpegFloor, -5) + [ min(jpegFloor,jpegQuality) ]
+    return [ ('jpg{}'.format(q), [int(cv2.IMWRITE_JPEG_QUALITY), q]) for q in qualities ]
+
+class effortController():
+    """
+    Chooses how much effort to put into encoding each image, so the
+    writers keep up with the capture rather than the capture waiting.
+
+    levels is a list of (name, params), from the most effort to the least.
+    choose is given how full the queue is (0 to 1) and returns the index of
+    the level to use. Less effort is used when the queue is getting full,
+    or when the encoding time at the current level is longer than the time
+    between images shared between the writers. More effort is used again
+    once the queue is nearly empty and the measured time at that level
+    would keep up.
+    """
+
+    low = 0.2       # Queue fill below which more effort can be used
+    high = 0.5      # Queue fill above which less effort is always used
+    smoothing = 0.2 # Weight of each new time in the running averages
+
+    def __init__(self, levels, writers=1):
+        self.levels = levels
+        self.writers = max(1, writers)
+        self.index = 0
+        self.encodeTimes = [None]*len(levels)   # Average seconds per image at each level
+        self.interval = None                    # Average seconds between images arriving
+        self.lastArrival = None
+        self.lock = threading.Lock()
+
+    def average(self, old, new):
+        return new if old is None else old + self.smoothing*(new-old)
+
+    def arrived(self, blocked=0):
+        # Called as each image is queued, with the seconds the capture was
+        # held up waiting for room, which isn't counted in the time between
+        # images - it is how fast images would arrive that matters
+        now = time.time()
+        with self.lock:
+            if self.lastArrival is not None:
+                self.interval = self.average(self.interval, max(now-self.lastArrival-blocked, 0))
+            self.lastArrival = now
+
+    def written(self, index, secs):
+        # Called with the level used and the time taken once an image is written
+        with self.lock:
+            self.encodeTimes[index] = self.average(self.encodeTimes[index], secs)
+
+    def keepsUp(self, index):
+        # If the writers can encode at this level as fast as images arrive
+        t = self.encodeTimes[index]
+        return t is None or self.interval is None or t/self.writers <= self.interval
+
+    def choose(self, fill):
+        with self.lock:
+            if fill > self.high or (fill > self.low and not self.keepsUp(self.index)):
+                self.index = min(self.index+1, len(self.levels)-1)
+            elif fill < self.low and self.index > 0 and self.keepsUp(self.index-1):
+                self.index -= 1
+            return self.index
+
+    def name(self, index):
+        return self.levels[index][0]
+
+    def params(self, index):
+        return self.levels[index][1]
+
+def encodeWorker(n, slots, jobs, free, results):
+    # Run in each worker process. Writes the images it is given until it
+    # gets None. Ctrl-C is left to the main process, which stops the
+    # workers once the images already queued are written
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    views = [ np.frombuffer(slot, dtype=np.uint8) for slot in slots ]
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        slot,shape,fn,params,queued = job
+        start = time.time()
+        size = int(np.prod(shape))
+        data = views[slot][:size]
+        try:
+            if params is None:
+                # Data to be written as it is, such as raw Bayer frames
+                with open(fn,'wb') as f:
+                    f.write(data.tostring())
+            else:
+                cv2.imwrite(fn, data.reshape(shape), params)
+            # The bytes written, after encoding
+            written = os.path.getsize(fn)
+            ok = True
+        except:
+            written = 0
+            ok = False
+        free.put(slot)
+        results.put( (n, fn, ok, time.time()-start, start-queued, written) )
+
+class processEncoder():
+    """
+    Encodes and writes images in worker processes, fed through slots
+    in shared memory.
+
+    slotSize is the largest image in bytes that will be written - such as
+    a full frame. Anything larger is refused.
+    Call start before taking any pictures, and close at the end of the job
+    to wait for the images to be written.
+    """
+
+    def __init__(self, workers, slotSize, slots=None):
+        self.workers = max(1, workers)
+        self.slotSize = slotSize
+        count = slots or self.workers*2
+        # Made before the workers are started, so they share the memory
+        self.slots = [ multiprocessing.RawArray('B', slotSize) for n in range(count) ]
+        self.views = [ np.frombuffer(slot, dtype=np.uint8) for slot in self.slots ]
+        self.jobs = multiprocessing.Queue()
+        self.free = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        for n in range(count):
+            self.free.put(n)
+        self.processes = []
+        self.slotWaits = []     # Seconds put waited for a free slot, for each image
+        self.written = []       # (worker, filename, ok, seconds writing, seconds queued, bytes)
+
+    def start(self):
+        for n in range(self.workers):
+            p = multiprocessing.Process( target=encodeWorker,
+                        args=(n, self.slots, self.jobs, self.free, self.results) )
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+
+    def put(self, fn, img, params=[]):
+        """
+        Copies the image into a free slot and queues it for writing with
+        cv2.imwrite and params. If params is None the data is written to
+        the file as it is.
+        """
+        img = np.ascontiguousarray(img)
+        if img.dtype != np.uint8 or img.nbytes > self.slotSize:
+            raise Exception('Cannot encode {} - {} bytes of {} with slots of {} bytes'.format(fn,img.nbytes,img.dtype,self.slotSize))
+        t = time.time()
+        slot = self.free.get()
+        self.slotWaits.append( time.time()-t )
+        self.views[slot][:img.size] = img.reshape(-1)
+        self.jobs.put( (slot, img.shape, fn, params, time.time()) )
+
+    def poll(self):
+        # Results of the images written since the last call, without waiting
+        done = []
+        while True:
+            try:
+                done.append( self.results.get_nowait() )
+            except:
+                break
+        self.written.extend(done)
+        return done
+
+    def collect(self):
+        # Gathers the results of the images written so far
+        while len(self.written) < len(self.slotWaits):
+            try:
+                self.written.append( self.results.get(timeout=0.1) )
+            except:
+                if not any( p.is_alive() for p in self.processes ):
+                    break
+        return self.written
+
+    def close(self):
+        # Waits for the queued images to be written and stops the workers
+        for p in self.processes:
+            self.jobs.put(None)
+        self.collect()
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        return self.written
@@ -0,0 +1,427 @@
+# RPi Telecine - Perforation detection engines
+#
+# Ways of finding the perforation, used by telecinePerforation.find().
+# An engine is an object with:
+#   name           - the name it is registered under
+#   find(pf, img)  - looks for the perforation in the ROI of pf. If it is
+#                    found it calls pf.setPerfPosition, sets pf.found and
+#                    returns a detectionResult, otherwise returns None
+#
+# The engines are registered by name in engineTypes, so a job can give a
+# chain of them - each is tried in turn until one finds the perforation.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import collections
+import time
+import numpy as np
+import cv2
+
+from rpiTelecine.perforation import findRuns, edgePosition
+
+# What an engine found - centre (x,y) and size (w,h) of the perforation
+# in pixels on the full frame, and confidence from 0 to 1
+detectionResult = collections.namedtuple( 'detectionResult', 'centre size confidence' )
+
+def result(pf):
+    # detectionResult of the last detection by pf, or None if it failed
+    if not pf.found:
+        return None
+    return detectionResult( pf.exactCentre, pf.foundSize, pf.confidence )
+
+def refineMatch(signal, template, pos, r):
+    # Offset within pos-r..pos+r where the 1D template best matches the
+    # signal by normalised cross correlation. signal starts at pos-r.
+    # The fraction of a pixel comes from a parabola through the best
+    # score and the scores either side of it
+    n = template.size
+    t = template - template.mean()
+    t = t / (np.sqrt((t*t).sum()) or 1)
+    scores = []
+    for offset in range(-r, r+1):
+        s = signal[offset+r:offset+r+n]
+        if s.size < n:
+            break
+        s = s - s.mean()
+        norm = np.sqrt((s*s).sum())
+        scores.append( (s*t).sum()/norm if norm else -1 )
+    if not scores:
+        return 0.0
+    best = int(np.argmax(scores))
+    fraction = 0.0
+    if 0 < best < len(scores)-1:
+        a,b,c = scores[best-1], scores[best], scores[best+1]
+        if a - 2*b + c < 0:
+            fraction = 0.5*(a-c)/(a - 2*b + c)
+    return best - r + fraction
+
+class thresholdEngine():
+    """
+    The original detection - the brightest part of a strip down the middle
+    of the ROI is the perforation (telecinePerforation.findVertical), then
+    the left edge is found if checkLeftEdge is set.
+    Confidence is how close the height is to the expected height.
+    """
+
+    name = 'threshold'
+
+    def find(self, pf, img):
+        pf.findVertical(img, alternative=False)
+        if pf.found and pf.checkLeftEdge:
+            pf.findLeftEdge()
+        return result(pf)
+
+class segmentsEngine():
+    """
+    The brightest run of rows of the right height in a strip down the ROI
+    (telecinePerforation.findVerticalAlternative). Copes with bright
+    image data above or below the perforation that the threshold misses.
+    Not used in the tracking window, where a partly seen perforation
+    could be taken for a whole one.
+    """
+
+    name = 'segments'
+
+    def find(self, pf, img):
+        pf.found = False
+        if pf.predictedY is not None:
+            return None
+        pf.setROIimg(img)
+        pf.findVerticalAlternative()
+        if pf.found and pf.checkLeftEdge:
+            pf.findLeftEdge()
+        return result(pf)
+
+class templateEngine():
+    """
+    Finds the perforation by normalised cross correlation with a template.
+
+    The template is built from the expected perforation size - a bright
+    perforation with film above, below and to its left. The right side is
+    left out as that is where the picture is. As the correlation is
+    normalised it doesn't depend on the perforation being the brightest
+    thing in the ROI, so it copes with bright frames that defeat the
+    threshold detection.
+
+    The template is matched on every reduction'th pixel of the ROI first,
+    then the position is refined at full resolution by matching the
+    profiles down and across the template within reduction pixels.
+    """
+
+    margin = 0.25           # Film round the perforation in the template - fraction of its size
+    reduction = 4           # Coarse search on every 4th pixel
+    minCorrelation = 0.5    # Lowest correlation accepted as a perforation
+    floor = 0.8             # Pixels darker than this fraction of the brightest are raised to it
+
+    name = 'template'
+
+    def __init__(self):
+        self.template = None
+        self.size = ( 0,0 )
+        self.offset = ( 0,0 )
+        self.correlation = 0.0  # Correlation of the last match
+
+    def margins(self, pf):
+        # Film to include to the left of the perforation, and room for weave.
+        # Both are cut down if the perforation is near the edge of the image
+        w,h = pf.expectedSize
+        room = max( 0, pf.ROIcentrexy[0] - w//2 )
+        mx = min( int(w*self.margin), room//2 )
+        sx = min( int(w*pf.sizeMargin), room-mx )
+        return mx, int(h*self.margin), sx
+
+    def setup(self, pf):
+        # Builds the template from the expected perforation size
+        w,h = pf.expectedSize
+        mx,my,sx = self.margins(pf)
+        template = np.zeros( (h+2*my, w+mx), dtype=np.uint8 )
+        template[my:my+h, mx:] = 255
+        self.setTemplate( template, (mx,my), (w,h) )
+
+    def setTemplate(self, template, offset, size):
+        # offset is the top left of the perforation in the template, size its width and height
+        self.template = template
+        self.offset = offset
+        self.size = tuple(size)
+        mx,my = offset
+        w,h = size
+        r = self.reduction
+        self.small = np.ascontiguousarray( template[::r,::r] )
+        # Profiles down the middle of the perforation and across it
+        self.rowProfile = template[:, mx+w//5:mx+w-w//5].mean(axis=1)
+        self.colProfile = template[my+h//5:my+h-h//5, :].mean(axis=0)
+
+    def find(self, pf, img):
+        pf.found = False
+        mx,my,sx = self.margins(pf)
+        if self.template is None or self.size != tuple(pf.expectedSize) or self.offset != (mx,my):
+            self.setup(pf)
+        gray = img[:,:,1] if img.ndim > 2 else img
+        img_h,img_w = gray.shape
+        th,tw = self.template.shape
+        w,h = self.size
+        r = self.reduction
+        # Search the ROI rows plus the template margins, and the perforation
+        # line with room for the film to weave
+        x,y = pf.ROIxy
+        roiW,roiH = pf.ROIwh
+        cx = pf.ROIcentrexy[0]
+        left = max( 0, cx - w//2 - mx - sx )
+        right = min( img_w, cx + w - w//2 + sx )
+        top = max( 0, y - my )
+        bot = min( img_h, y + roiH + my )
+        if bot-top < th+2*r or right-left < tw:
+            return None
+        area = gray[top:bot, left:right]
+        # Dark dirt in the film next to the perforation would swamp the
+        # correlation when the film is nearly as bright as the perforation,
+        # so the darkest pixels are all set to the same level
+        small = area[::r,::r]
+        floor = int(small.max()*self.floor)
+        small = np.maximum(small, floor)
+        match = cv2.matchTemplate( small, self.small, cv2.TM_CCOEFF_NORMED )
+        minVal,self.correlation,minLoc,(px,py) = cv2.minMaxLoc(match)
+        if self.correlation < self.minCorrelation:
+            return None
+        px,py = px*r, py*r
+        if mx < r:
+            # No film to the left to match, so stay on the perforation line
+            px = cx - w//2 - mx - left
+        # Refine at full resolution, keeping the refining windows inside the area
+        py = min( max(py, r), area.shape[0]-th-r )
+        rows = np.maximum( area[py-r:py+th+r, px+mx+w//5:px+mx+w-w//5], floor ).mean(axis=1)
+        dy = refineMatch( rows, self.rowProfile, py, r )
+        py += int(round(dy))
+        dx = 0.0
+        if mx >= r:
+            px = min( max(px, r), area.shape[1]-tw-r )
+            cols = np.maximum( area[py+my+h//5:py+my+h-h//5, px-r:px+tw+r], floor ).mean(axis=0)
+            dx = refineMatch( cols, self.colProfile, px, r )
+        pf.setPerfPosition( left+px+dx+mx+w/2, top+py+(dy-round(dy))+my+h/2 )
+        pf.foundSize = self.size
+        pf.confidence = self.correlation
+        pf.found = True
+        return result(pf)
+
+class dualEngine():
+    """
+    Registers the frame from both perforations in view and the frame line
+    between the pictures, for Standard 8 where one perforation on worn film
+    gives a jittery position.
+
+    One strip down the perforation line and one down the picture are taken
+    from the top of the ROI to a pitch below its bottom, and reduced in the
+    same pass over the rows. Bright runs of the right height in the first
+    are perforations, found to a fraction of a pixel. The perforation is the
+    one in the ROI nearest the middle (or the tracking prediction), and the
+    next perforation should be about a pitch below it. The frame line is a
+    dark run in the picture strip near the perforation.
+
+    Each gives an estimate of the perforation centre - the one found, the
+    next one less the pitch, and the frame line less its offset from the
+    perforation. A perforation of the expected height is used as it is,
+    otherwise the median of the other estimates is used, so a damaged
+    perforation is registered from the next one and the frame line. The distance to the next perforation is
+    left in pf.measuredPitch, to correct the steps to the next frame.
+    Confidence is the fraction of the three estimates found.
+    """
+
+    name = 'dual'
+    pitchTolerance = 0.05   # Next perforation within this fraction of the pitch
+    heightTolerance = 0.02  # A perforation within this fraction of the expected height is whole
+    gapRange = (0.2, 0.7)   # Frame line height as a fraction of the perforation height
+    learn = 0.2             # How quickly the pitch and frame line offset follow the film
+
+    def __init__(self):
+        self.pitch = None       # Average distance between perforations
+        self.gapOffset = None   # Average frame line centre relative to the perforation
+        self.size = ( 0,0 )
+
+    def setup(self, pf):
+        # Starts from the pitch given by the film dimensions
+        self.size = tuple(pf.expectedSize)
+        self.pitch = pf.expectedSize[1] * pf.frameHeightMultiplier[pf.filmType]
+        self.gapOffset = None
+
+    def runs(self, strip, mask, lo, hi):
+        # Sub-pixel (start, stop) of the runs of mask lo to hi long
+        starts,stops = findRuns(mask)
+        heights = stops-starts
+        ok = (heights >= lo) & (heights <= hi) & (starts > 0) & (stops < strip.size)
+        return [ (edgePosition(strip,a), edgePosition(strip,b)) for a,b in zip(starts[ok],stops[ok]) ]
+
+    def find(self, pf, img):
+        pf.found = False
+        pf.measuredPitch = None
+        if self.pitch is None or self.size != tuple(pf.expectedSize):
+            self.setup(pf)
+        gray = img[:,:,1] if img.ndim > 2 else img
+        img_h,img_w = gray.shape
+        w,h = pf.expectedSize
+        x,y = pf.ROIxy
+        roiW,roiH = pf.ROIwh
+        cx = pf.ROIcentrexy[0]
+        win = int(w - (w*pf.sizeMargin))//2
+        # Rows from the top of the ROI to far enough below it for the next perforation
+        top = y
+        bot = min( img_h, int(y + roiH + self.pitch*(1+self.pitchTolerance)) )
+        picture = ( min(img_w, cx+w), min(img_w, cx+2*w) )
+        if bot-top < h or picture[1]-picture[0] < win:
+            return None
+        rows = gray[top:bot]
+        perf = pf.reduceStrip( rows[:, cx-win:cx+win], 1 ).astype(np.float64)
+        frame = pf.reduceStrip( rows[:, picture[0]:picture[1]], 1 ).astype(np.float64)
+        runs = self.runs( perf, perf >= perf.max()*pf.thresholdVal, pf.heightRange[0], pf.heightRange[1] )
+        perfs = [ (a+b)/2 for a,b in runs ]
+        # The perforation in the ROI nearest where it should be
+        middle = (pf.predictedY if pf.predictedY is not None else pf.ROIcentrexy[1]) - top
+        inside = [ n for n,c in enumerate(perfs) if c < roiH ]
+        estimates = []
+        ref = whole = None
+        if inside:
+            n = min( inside, key=lambda n: abs(perfs[n]-middle) )
+            ref = perfs[n]
+            whole = abs(runs[n][1]-runs[n][0]-h) < h*self.heightTolerance
+            estimates.append( ref )
+        # The next perforation - or the one after the missing perforation
+        base = ref if ref is not None else middle
+        nexts = [ c for c in perfs if abs(c-base-self.pitch) < self.pitch*self.pitchTolerance ]
+        nxt = min( nexts, key=lambda c: abs(c-base-self.pitch) ) if nexts else None
+        if nxt is not None:
+            estimates.append( nxt-self.pitch )
+        if not estimates:
+            return None
+        # The frame line - the darkest part of the picture strip near the perforation
+        centre = np.median(estimates)
+        gap = None
+        lo = int(max( 0, centre - self.pitch/2 ))
+        hi = int(min( frame.size, centre + self.pitch/2 ))
+        section = frame[lo:hi]
+        if section.size:
+            dark = section < section.min() + (np.median(section) - section.min())/2
+            gaps = [ lo+(a+b)/2 for a,b in self.runs( section, dark, h*self.gapRange[0], h*self.gapRange[1] ) ]
+            expected = centre + (self.gapOffset or 0)
+            if gaps:
+                gap = min( gaps, key=lambda g: abs(g-expected) )
+                if self.gapOffset is not None and abs(gap-expected) < self.pitch*self.pitchTolerance:
+                    estimates.append( gap-self.gapOffset )
+                elif self.gapOffset is not None:
+                    gap = None
+        if whole or len(estimates) == 1:
+            centre = estimates[0]
+        else:
+            # Don't use a damaged perforation if there is anything else
+            centre = np.median( estimates[1:] if ref is not None else estimates )
+        # Follow the pitch and frame line offset when everything agrees
+        if ref is not None and nxt is not None:
+            pf.measuredPitch = nxt-ref
+            self.pitch += self.learn*(pf.measuredPitch-self.pitch)
+            if gap is not None:
+                offset = gap-centre
+                self.gapOffset = offset if self.gapOffset is None else self.gapOffset + self.learn*(offset-self.gapOffset)
+        if centre >= roiH:
+            return None
+        pf.setROIimg(img)
+        pf.setPerfPosition( cx, top+centre )
+        pf.foundSize = ( w,h )
+        pf.confidence = len(estimates)/3
+        pf.found = True
+        if pf.checkLeftEdge:
+            pf.findLeftEdge()
+        return result(pf)
+
+# Engines by name, in the order they are listed
+engineTypes = collections.OrderedDict( [
+    ('threshold', thresholdEngine),
+    ('segments',  segmentsEngine),
+    ('template',  templateEngine),
+    ('dual',      dualEngine),
+    ] )
+
+# The chain used when none is given - the same as the original detection,
+# which tried the segments when the threshold failed
+defaultEngines = ['threshold','segments']
+
+def registerEngine(name, engineClass):
+    # Adds an engine so it can be used in a chain
+    engineClass.name = name
+    engineTypes[name] = engineClass
+
+def makeEngines(names):
+    # A new instance of each engine in the chain
+    engines = []
+    for name in names:
+        if name not in engineTypes:
+            raise Exception("Error - '{}' is an incorrect detection engine.".format(name))
+        engines.append( engineTypes[name]() )
+    return engines
+
+def compareEngines(pf, images, names=None, tolerance=2):
+    """
+    Runs each engine on its own over the images, for comparing them on
+    the same frames. The consensus for each frame is the median of the
+    centres found. Returns an OrderedDict of each engine's results with:
+      times      - seconds taken by each frame
+      found      - number of frames where the perforation was found
+      deviation  - vertical distance from the consensus of each frame found
+      agreement  - fraction of the frames where it was found within
+                   tolerance pixels of the consensus
+    The detection state of pf is left as it was.
+    """
+    names = list(engineTypes.keys()) if names is None else names
+    saved = dict( (k,getattr(pf,k)) for k in ('found','centre','exactCentre','position','yDiff','foundSize','confidence') )
+    found = collections.OrderedDict()
+    times = collections.OrderedDict()
+    for engine in makeEngines(names):
+        found[engine.name] = []
+        times[engine.name] = []
+        for img in images:
+            t = time.time()
+            res = engine.find(pf, img)
+            times[engine.name].append( time.time()-t )
+            found[engine.name].append( res )
+    for k,v in saved.items():
+        setattr(pf, k, v)
+    results = collections.OrderedDict()
+    for name in found:
+        results[name] = { 'times':times[name], 'found':0, 'deviation':[], 'agreement':0.0 }
+    for n in range(len(images)):
+        ys = [ found[name][n].centre[1] for name in found if found[name][n] is not None ]
+        if not ys:
+            continue
+        consensus = np.median(ys)
+        for name in found:
+            res = found[name][n]
+            if res is not None:
+                deviation = abs(res.centre[1]-consensus)
+                results[name]['found'] += 1
+                results[name]['deviation'].append( deviation )
+                if deviation <= tolerance:
+                    results[name]['agreement'] += 1/len(images)
+    return results
@@ -0,0 +1,357 @@
+# RPi Telecine - Frame buffers
+#
+# Buffers and containers for the image data coming from the camera.
+#
+# The Pi camera writes unencoded images padded out to a multiple of
+# 32 pixels wide and 16 pixels high. The classes here keep that padded
+# data in preallocated Numpy arrays, and hand out views of the visible
+# part of the image so no copy is made between the camera and the
+# perforation detection.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import collections
+import threading
+import time
+import numpy as np
+import cv2
+
+def padded_resolution(resolution):
+    # Size of the unencoded image the camera writes - width is rounded
+    # up to a multiple of 32, height to a multiple of 16
+    w,h = resolution
+    return ( (w+31)//32*32, (h+15)//16*16 )
+
+class bgrBufferPool():
+    """
+    A small ring of preallocated BGR image buffers.
+
+    The pool is a file-like object that can be given to PiCamera.capture
+    or capture_continuous as the output. Data written is copied straight
+    into the current buffer. Calling next_frame returns a view of the
+    finished image and moves on to the next buffer in the ring.
+
+    An image returned by next_frame is only valid until the pool has
+    wrapped round to the same buffer again - so anything that needs to
+    keep the image for longer must copy it.
+    """
+
+    def __init__(self, resolution, buffers=3):
+        self.resolution = tuple(resolution)
+        pw,ph = padded_resolution(resolution)
+        self.buffers = [ np.empty( (ph,pw,3), dtype=np.uint8 ) for n in range(max(2,buffers)) ]
+        # Flat views of each buffer used when writing
+        self.flat = [ b.reshape(-1) for b in self.buffers ]
+        self.index = 0
+        self.pos = 0
+
+    def write(self, data):
+        # Copy data from the camera into the current buffer
+        buf = self.flat[self.index]
+        n = len(data)
+        if self.pos+n > buf.size:
+            raise Exception('Too much image data for buffer. Expected: {} bytes'.format(buf.size))
+        buf[self.pos:self.pos+n] = np.frombuffer(data, dtype=np.uint8)
+        self.pos += n
+        return n
+
+    def flush(self):
+        pass
+
+    def truncate(self, size=0):
+        # Discard partially written data
+        self.pos = size
+
+    def next_frame(self):
+        """
+        Returns a view of the image just written and starts
+        filling the next buffer in the ring.
+        """
+        if self.pos != self.flat[self.index].size:
+            raise Exception('Incomplete image in buffer. Received {} of {} bytes'.format(self.pos,self.flat[self.index].size))
+        w,h = self.resolution
+        img = self.buffers[self.index][:h,:w]
+        self.index = (self.index+1) % len(self.buffers)
+        self.pos = 0
+        return img
+
+class yuvFrame():
+    """
+    A YUV420 (I420) image as written by the camera with format='yuv'.
+
+    The data is a full size luma (Y) plane followed by quarter size U and
+    V planes. The luma plane is an exact greyscale image, available as a
+    view with no copying or conversion for the perforation detection.
+    Conversion to BGR is only done on the part of the image being kept.
+
+    The frame is file-like so it can be captured into directly, and its
+    buffer is reused - call reset before capturing into it again.
+    """
+
+    def __init__(self, resolution):
+        self.resolution = tuple(resolution)
+        w,h = resolution
+        pw,ph = padded_resolution(resolution)
+        self.padded = (pw,ph)
+        self.shape = (h,w)
+        self.data = np.empty( (pw*ph*3)//2, dtype=np.uint8 )
+        self.pos = 0
+
+    def reset(self):
+        self.pos = 0
+
+    def write(self, data):
+        n = len(data)
+        if self.pos+n > self.data.size:
+            raise Exception('Too much image data for buffer. Expected: {} bytes'.format(self.data.size))
+        self.data[self.pos:self.pos+n] = np.frombuffer(data, dtype=np.uint8)
+        self.pos += n
+        return n
+
+    def flush(self):
+        pass
+
+    def set_bgr(self, img):
+        # Fills the frame from a BGR image, as if it had been captured
+        h,w = self.shape
+        i420 = cv2.cvtColor( img, cv2.COLOR_BGR2YUV_I420 ).reshape(-1)
+        uvSize = (h//2)*(w//2)
+        y,u,v = self.planes()
+        y[:h,:w] = i420[:h*w].reshape( h,w )
+        u[:h//2,:w//2] = i420[h*w:h*w+uvSize].reshape( h//2,w//2 )
+        v[:h//2,:w//2] = i420[h*w+uvSize:h*w+uvSize*2].reshape( h//2,w//2 )
+        self.pos = self.data.size
+
+    def planes(self):
+        # Views of the padded Y, U and V planes
+        pw,ph = self.padded
+        ySize = pw*ph
+        uvSize = ySize//4
+        y = self.data[:ySize].reshape( ph, pw )
+        u = self.data[ySize:ySize+uvSize].reshape( ph//2, pw//2 )
+        v = self.data[ySize+uvSize:ySize+uvSize*2].reshape( ph//2, pw//2 )
+        return y,u,v
+
+    def luma(self):
+        # Greyscale image - a view of the Y plane
+        h,w = self.shape
+        return self.planes()[0][:h,:w]
+
+    def crop(self, crop, gray=False):
+        """
+        Returns a new image of the area given by a numpy slice, as made by
+        telecinePerforation.cropToSlice. Colour images are converted
+        to BGR, greyscale images are a copy of the luma.
+        """
+        h,w = self.shape
+        y0,y1,step = crop[0].indices(h)
+        x0,x1,step = crop[1].indices(w)
+        if gray:
+            return self.luma()[y0:y1,x0:x1].copy()
+        # Chroma is at half resolution, so convert an area with
+        # even edges, then trim it to the requested crop
+        ey0, ex0 = y0 - y0%2, x0 - x0%2
+        ey1, ex1 = min(y1 + y1%2, h - h%2), min(x1 + x1%2, w - w%2)
+        y,u,v = self.planes()
+        i420 = np.concatenate( ( y[ey0:ey1,ex0:ex1].ravel(),
+                                 u[ey0//2:ey1//2,ex0//2:ex1//2].ravel(),
+                                 v[ey0//2:ey1//2,ex0//2:ex1//2].ravel() ) )
+        bgr = cv2.cvtColor( i420.reshape( ((ey1-ey0)*3)//2, ex1-ex0 ), cv2.COLOR_YUV2BGR_I420 )
+        return bgr[y0-ey0:y1-ey0, x0-ex0:x1-ex0]
+
+    def bgr(self):
+        # The whole image converted to BGR
+        h,w = self.shape
+        return self.crop( np.index_exp[0:h,0:w] )
+
+class captureBuffer():
+    """
+    Preallocated file-like output for captures of variable size, such
+    as a jpeg with the raw Bayer data appended. The buffer is reused for
+    each capture - call reset before capturing into it again.
+    """
+
+    def __init__(self, size):
+        self.buffer = np.empty( size, dtype=np.uint8 )
+        self.pos = 0
+
+    def reset(self):
+        self.pos = 0
+
+    def write(self, data):
+        n = len(data)
+        if self.pos+n > self.buffer.size:
+            raise Exception('Capture too large for buffer of {} bytes'.format(self.buffer.size))
+        self.buffer[self.pos:self.pos+n] = np.frombuffer(data, dtype=np.uint8)
+        self.pos += n
+        return n
+
+    def flush(self):
+        pass
+
+    def tail(self, size):
+        # Return a copy of the last 'size' bytes written
+        if size > self.pos:
+            raise Exception('Only {} bytes captured - expected at least {}'.format(self.pos,size))
+        return self.buffer[self.pos-size:self.pos].copy()
+
+class frameRing():
+    """
+    A preallocated ring of memory that images waiting to be written are
+    copied into, so the memory they use is bounded in bytes rather than
+    by a number of images.
+
+    put copies an image into the ring and returns a key and the copy. The
+    copy is compact, so a crop no longer keeps the whole captured image
+    alive. When there isn't room, put waits until enough has been released
+    and records how long it waited. Images can be released in any order -
+    the space is reused once everything put before it has been released.
+    """
+
+    def __init__(self, size):
+        self.buffer = np.empty( size, dtype=np.uint8 )
+        self.blocks = collections.deque()   # [start, end, released] in the order put
+        self.head = 0                       # Where the next image is put
+        self.cond = threading.Condition()
+        self.waits = []                     # Seconds put waited, for each image
+        self.peak = 0                       # Most bytes in use at once
+
+    def used(self):
+        # Bytes between the oldest image still held and the head
+        if not self.blocks:
+            return 0
+        tail = self.blocks[0][0]
+        return self.head-tail if self.head > tail else self.buffer.size-tail+self.head
+
+    def fill(self):
+        # Fraction of the ring in use
+        with self.cond:
+            return self.used()/self.buffer.size
+
+    def _place(self, n):
+        # Start of a free space of n bytes, or None
+        if not self.blocks:
+            return 0
+        tail = self.blocks[0][0]
+        if self.head > tail:
+            if self.head+n <= self.buffer.size:
+                return self.head
+            # Not enough room at the end - start again at the beginning
+            return 0 if n <= tail else None
+        return self.head if self.head+n <= tail else None
+
+    def put(self, img):
+        img = np.ascontiguousarray(img)
+        n = img.nbytes
+        if n > self.buffer.size:
+            raise Exception('Image of {} bytes is larger than the buffer of {} bytes'.format(n,self.buffer.size))
+        t = time.time()
+        with self.cond:
+            start = self._place(n)
+            while start is None:
+                self.cond.wait()
+                start = self._place(n)
+            block = [start, start+n, False]
+            self.blocks.append(block)
+            self.head = start+n
+            self.peak = max(self.peak, self.used())
+        self.waits.append( time.time()-t )
+        copy = self.buffer[start:start+n].view(img.dtype).reshape(img.shape)
+        copy[...] = img
+        return block, copy
+
+    def release(self, block):
+        # Frees the space of an image once it has been written
+        with self.cond:
+            block[2] = True
+            while self.blocks and self.blocks[0][2]:
+                self.blocks.popleft()
+            if not self.blocks:
+                self.head = 0
+            self.cond.notify_all()
+
+# Offsets of the red, green, green and blue pixels in each 2x2 block
+# of the Bayer mosaic - indexed by the bayer_order in the raw header.
+# Each is a (row, column) pair
+bayerOffsets = {
+    0: ((0,0), (1,0), (0,1), (1,1)),
+    1: ((1,0), (0,0), (1,1), (0,1)),
+    2: ((1,1), (0,1), (1,0), (0,0)),
+    3: ((0,1), (1,1), (0,0), (1,0)),
+    }
+
+class rawBayerFrame():
+    """
+    Undemosaiced sensor data as appended to a jpeg capture by the
+    OV5647 (V1) camera with bayer=True.
+
+    The data is kept exactly as it comes from the camera - a 32K header
+    starting 'BRCM', followed by rows of 10 bit pixels packed 4 pixels
+    in 5 bytes. Unpacking to full 10 bit values and demosaicing is left
+    to the host - see post-production/develop-raw.py. On the Pi only the
+    top 8 bits are used, which are enough to find the perforation.
+    """
+
+    rawSize = 6404096           # Size of raw data block including header
+    headerSize = 32768
+    rawShape = ( 1952, 3264 )   # Rows, bytes per row including padding
+    imageSize = ( 1944, 2592 )  # Visible rows, pixels per row
+
+    def __init__(self, data):
+        self.data = data
+        if self.data[:4].tostring() != 'BRCM':
+            raise Exception('Raw Bayer data not found in capture')
+        self.bayerOrder = int(self.data[176+68])
+        self.shape = self.imageSize
+
+    def mosaic(self):
+        # Returns the 8 most significant bits of each pixel as a 2D array
+        # The first 4 bytes of every 5 hold the top bits of 4 pixels
+        rows,cols = self.imageSize
+        data = self.data[self.headerSize:].reshape(self.rawShape)
+        data = data[:rows,:(cols*5)//4].reshape( rows, cols//4, 5 )
+        return data[:,:,:4].reshape( rows, cols )
+
+    def green(self):
+        """
+        Returns a full size greyscale image made from the green pixels
+        of the mosaic. The red and blue sites take the value of the green
+        pixel next to them on the same row. This is good enough for
+        perforation detection, which looks at a single channel anyway.
+        """
+        m = self.mosaic()
+        (ry,rx),(gy,gx),(Gy,Gx),(by,bx) = bayerOffsets[self.bayerOrder]
+        m[ry::2,rx::2] = m[ry::2,1-rx::2]
+        m[by::2,bx::2] = m[by::2,1-bx::2]
+        return m
+
+    def save(self,fn):
+        # Writes the raw data unaltered
+        with open(fn,'wb') as f:
+            f.write(self.data.tostring())
@@ -0,0 +1,221 @@
+# RPi Telecine - Job journal
+#
+# A record of the frames of a job that are safely written, so a job that
+# stops part way through - a crash or a power cut - can be carried on
+# from where it got to with tc-run.py --resume.
+#
+# The journal is a JSON lines file in the job folder with three kinds of
+# line:
+#   run      a run of tc-run.py was started, with its start and end frames
+#   moved    the film was moved on from a frame, with the steps and direction
+#   written  every image of a frame is written, with the perforation centre
+#            and the steps moved on from it
+# written lines are only added once the images are on disk - or on the PC
+# when streaming. Rather than an fsync for each image, they are collected
+# and written in batches, after making everything written so far durable
+# with a single sync. moved lines are flushed but not synced, as they are
+# only needed to find where the film is after tc-run.py itself stops.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import ctypes
+import ctypes.util
+import json
+import os
+import threading
+import time
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    sync = libc.sync
+except (OSError, AttributeError):
+    sync = None
+
+def syncFiles():
+    # Flushes every file written so far to disk with one call
+    if sync is not None:
+        sync()
+
+class jobJournal():
+    """
+    Appends to the journal of a job.
+
+    started(start, end, forward) records the start of a run. frame(n, files,
+    centre, steps, forward) is called from the capture loop once the film is moving
+    on from frame n, with the filenames of its images. written(filename, ok)
+    is called by the writers. The frame is recorded as written when all of
+    its images are - if any failed it isn't, so it is captured again.
+    syncWritten is called before each batch of written frames is recorded -
+    it should make sure everything written so far will survive a power cut,
+    and can return the filenames that turned out not to be written, whose
+    frames are left out. It is run by a writer, outside the lock the
+    capture loop takes, so the capture doesn't wait for it.
+    """
+
+    def __init__(self, path, batch=25, interval=10.0, syncWritten=syncFiles):
+        self.file = open(path, 'ab')
+        self.batch = batch
+        self.interval = interval    # Most seconds a written frame waits to be recorded
+        self.syncWritten = syncWritten
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()   # Held while a batch is synced and recorded
+        self.fileLock = threading.Lock()
+        self.frames = {}            # Frame number to [record, images still to write, any failed, filenames]
+        self.files = {}             # Filename to frame number
+        self.lines = []             # (filenames, line) of the frames written since the last batch
+        self.lastFlush = time.time()
+
+    def _write(self, record):
+        with self.fileLock:
+            self.file.write( json.dumps(record, sort_keys=True) + '\n' )
+            self.file.flush()
+
+    def started(self, start, end, forward=True):
+        with self.lock:
+            self._write( {'type':'run', 'time':time.time(), 'start':start, 'end':end, 'forward':forward} )
+
+    def frame(self, n, files, centre, steps, forward, moved=True):
+        # moved is False for the last frame of a job, which the film stays at
+        with self.lock:
+            if moved:
+                self._write( {'type':'moved', 'frame':n, 'steps':int(steps), 'forward':forward} )
+            record = {'type':'written', 'frame':n, 'centre':[ float(c) for c in centre ], 'steps':int(steps), 'images':len(files)}
+            self.frames[n] = [record, len(files), False, files]
+            for fn in files:
+                self.files[fn] = n
+            # A frame without images is recorded with the next batch - the
+            # capture loop never syncs
+            self._finish(n)
+
+    def written(self, fn, ok):
+        with self.lock:
+            n = self.files.pop(fn, None)
+            if n not in self.frames:
+                return
+            self.frames[n][1] -= 1
+            self.frames[n][2] |= not ok
+            due = self._finish(n)
+        if due:
+            self._flush(False)
+
+    def _finish(self, n):
+        # Returns True when a batch is due
+        record,left,failed,files = self.frames[n]
+        if left > 0:
+            return False
+        del self.frames[n]
+        if not failed:
+            self.lines.append( (files, json.dumps(record, sort_keys=True)) )
+        return len(self.lines) >= self.batch or time.time()-self.lastFlush >= self.interval
+
+    def _flush(self, wait=True):
+        # Without wait, a batch already being flushed by another writer is
+        # left to finish, and these lines go in the next one
+        if not self.flushLock.acquire(wait):
+            return
+        try:
+            with self.lock:
+                lines = self.lines
+                self.lines = []
+                self.lastFlush = time.time()
+            if not lines:
+                return
+            # The images first, then the lines saying they are written
+            lost = set( self.syncWritten() or () )
+            lines = [ line for files,line in lines if not lost.intersection(files) ]
+            if lines:
+                with self.fileLock:
+                    self.file.write( '\n'.join(lines) + '\n' )
+                    self.file.flush()
+                os.fsync(self.file.fileno())
+        finally:
+            self.flushLock.release()
+
+    def close(self):
+        # Records the frames written - frames still waiting for images aren't
+        self._flush()
+        with self.fileLock:
+            self.file.close()
+
+def readJournal(path):
+    """
+    Reads a journal, returning (runs, written, moves). runs is the list of
+    run records, written maps each frame written to its record, and moves
+    maps each frame to the last (steps, forward) the film was moved on from
+    it by. A line cut short by a crash is ignored.
+    """
+    runs = []
+    written = {}
+    moves = {}
+    if not os.path.exists(path):
+        return runs, written, moves
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            kind = record.get('type')
+            if kind == 'run':
+                record['moved'] = []
+                runs.append(record)
+            elif kind == 'moved':
+                moves[record['frame']] = (record['steps'], record['forward'])
+                if runs:
+                    runs[-1]['moved'].append(record['frame'])
+            elif kind == 'written':
+                written[record['frame']] = record
+    return runs, written, moves
+
+def resumePoint(path, start, end):
+    """
+    Where a job from start to end (inclusive) should carry on from. Returns
+    (frame, undo, written) - the first frame not written, the moves to undo
+    to get the film back to it as (steps, forward), and the number of frames
+    already written. steps is None if the move wasn't recorded. If the film
+    stopped short of the frame, undo has the moves over the frames in
+    between as moves the other way. frame is None if every frame is written.
+    """
+    runs, written, moves = readJournal(path)
+    direction = 1 if end >= start else -1
+    frames = range(start, end+direction, direction)
+    done = sum( 1 for n in frames if n in written )
+    resume = next( (n for n in frames if n not in written), None )
+    if resume is None or not runs:
+        return resume, [], done
+    # The film is at the frame after the last one the last run moved on from
+    last = runs[-1]
+    runDirection = 1 if last['end'] >= last['start'] else -1
+    position = last['moved'][-1]+runDirection if last['moved'] else last['start']
+    forward = last.get('forward')
+    undo = [ moves.get(n, (None, forward)) for n in range(resume, position, direction) ]
+    for n in range(position, resume, direction):
+        steps,fd = moves.get(n, (None, forward))
+        undo.append( (steps, None if fd is None else not fd) )
+    return resume, undo, done
@@ -0,0 +1,247 @@
+# RPi Telecine - Live metrics
+#
+# Counters, gauges and histograms of a running job, served over HTTP in
+# the Prometheus text format from a background thread, so a job lasting
+# hours can be watched - with curl, a browser or a Prometheus server.
+#
+# Recording a value only takes a lock and an addition, so the capture loop
+# isn't slowed down. Gauges that take some work to find, such as the free
+# disk space, are functions only called when the metrics are fetched.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import bisect
+import collections
+import os
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+class counterMetric():
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def lines(self):
+        return [ '{} {}'.format(self.name, self.value) ]
+
+class gaugeMetric():
+    """
+    A value that goes up and down - either set, or given as a function
+    called each time the metrics are fetched.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def lines(self):
+        value = self.value
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except:
+                value = float('nan')
+        return [ '{} {}'.format(self.name, value) ]
+
+class histogramMetric():
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0]*(len(self.buckets)+1)    # Last is above the largest bucket
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def lines(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound,count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append( '{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative) )
+        cumulative += counts[-1]
+        lines.append( '{}_bucket{{le="+Inf"}} {}'.format(self.name, cumulative) )
+        lines.append( '{}_sum {}'.format(self.name, total) )
+        lines.append( '{}_count {}'.format(self.name, cumulative) )
+        return lines
+
+class metricsRegistry():
+    # The metrics to be served, in the order they were added
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise Exception("Error - metric '{}' already added.".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add( counterMetric(name, help) )
+
+    def gauge(self, name, help, fn=None):
+        return self.add( gaugeMetric(name, help, fn) )
+
+    def histogram(self, name, help, buckets):
+        return self.add( histogramMetric(name, help, buckets) )
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append( '# HELP {} {}'.format(metric.name, metric.help) )
+            lines.append( '# TYPE {} {}'.format(metric.name, metric.kind) )
+            lines.extend( metric.lines() )
+        return '\n'.join(lines) + '\n'
+
+secondsBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class jobMetrics():
+    """
+    The metrics of a capture job.
+
+    queueDepth is a function returning the number of images waiting to be
+    written, and path is where the images are being written, for the free
+    disk space.
+    """
+
+    def __init__(self, queueDepth=None, path='.'):
+        self.registry = metricsRegistry()
+        r = self.registry
+        self.path = path
+        self.frameTimes = collections.deque()
+        self.frameLock = threading.Lock()
+        self.frames = r.counter('telecine_frames_total', 'Frames captured')
+        r.gauge('telecine_frames_per_minute', 'Frames captured in the last minute', self.framesPerMinute)
+        self.currentFrame = r.gauge('telecine_current_frame', 'Number of the frame last captured')
+        self.capture = r.histogram('telecine_capture_seconds', 'Time taking each picture', secondsBuckets)
+        self.detect = r.histogram('telecine_detect_seconds', 'Time finding each perforation', secondsBuckets)
+        self.transportWait = r.histogram('telecine_transport_wait_seconds', 'Time waiting for the film to stop before each capture', secondsBuckets)
+        self.failures = r.counter('telecine_detection_failures_total', 'Frames where the perforation was not found')
+        self.streak = r.gauge('telecine_failed_frames', 'Adjacent frames where the perforation was not found')
+        r.gauge('telecine_queue_depth', 'Images waiting to be written', queueDepth)
+        self.encode = r.histogram('telecine_encode_seconds', 'Time encoding and writing each image', secondsBuckets)
+        self.written = r.counter('telecine_images_written_total', 'Images written')
+        self.writeFailures = r.counter('telecine_write_failures_total', 'Images that failed to write')
+        self.bytesWritten = r.counter('telecine_image_bytes_total', 'Bytes written, after encoding')
+        self.encodeLevel = r.gauge('telecine_encode_level', 'Encode level of the image last written - 0 is the most effort')
+        r.gauge('telecine_disk_free_bytes', 'Free space where the images are written', self.diskFree)
+
+    def frameDone(self, n):
+        # Called at the end of each frame
+        self.frames.inc()
+        self.currentFrame.set(n)
+        with self.frameLock:
+            self.frameTimes.append( time.time() )
+
+    def framesPerMinute(self):
+        now = time.time()
+        with self.frameLock:
+            while self.frameTimes and self.frameTimes[0] < now-60:
+                self.frameTimes.popleft()
+            return len(self.frameTimes)
+
+    def imageWritten(self, secs, size, ok, level=None):
+        self.encode.observe(secs)
+        if level is not None:
+            self.encodeLevel.set(level)
+        self.written.inc()
+        self.bytesWritten.inc(size)
+        if not ok:
+            self.writeFailures.inc()
+
+    def diskFree(self):
+        s = os.statvfs(self.path)
+        return s.f_bavail*s.f_frsize
+
+class metricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/','/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep requests out of the job's output
+        pass
+
+class metricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the metrics of a registry at /metrics from a background thread.
+    The address defaults to localhost - use '' to serve on every interface.
+    """
+    daemon_threads = True
+
+    def __init__(self, registry, port, address='localhost'):
+        BaseHTTPServer.HTTPServer.__init__(self, (address,port), metricsHandler)
+        self.registry = registry
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -46,11 +46,37 @@
 
 from __future__ import division
 import numpy as np
-import scipy.ndimage.measurements as nd
 
 # Types of film 
 filmTypes = ['super8', 'std8']
 
+# Ways of reducing a section of the ROI to a single pixel wide strip
+reductionTypes = ['median', 'partition', 'subsample', 'trimmed']
+
+def findRuns(mask):
+    # Start and stop indices of each run of True values in a 1D boolean array
+    edges = np.diff( np.concatenate( ([0], mask.astype(np.int8), [0]) ) )
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def edgePosition(strip, edge, r=3):
+    # Sub-pixel position of the edge between strip[edge-1] and strip[edge].
+    # Takes the profile r pixels either side of the edge, and finds where
+    # it crosses half way between its darkest and brightest values by
+    # interpolating between the pixels either side of the crossing.
+    # Positions are of pixel edges - a crossing half way between the two
+    # pixels returns edge
+    lo = max( 0, edge-r )
+    profile = strip[lo:edge+r].astype(np.float64)
+    if profile.size < 2:
+        return float(edge)
+    half = (profile.min() + profile.max())/2
+    above = profile >= half
+    crossings = np.flatnonzero( above[1:] != above[:-1] )
+    if not crossings.size:
+        return float(edge)
+    k = crossings[ np.abs(crossings+lo+1-edge).argmin() ]
+    return lo + k + 0.5 + (half-profile[k])/(profile[k+1]-profile[k])
+
 class telecinePerforation():
     """
     Class that handles the perforation finding
@@ -63,6 +89,8 @@ class telecinePerforation():
     isInitialised = False
 
     imageSize = ( 0,0 )         # Size of the frame to convert
+    fullImageSize = ( 0,0 )     # Size of the full uncropped frame
+    imageOffset = ( 0,0 )       # Position of the frame in the full frame when the camera is cropping
 
     ROIslice = None             # Slice for the ROI where the perforation should lie
     ROIxy = ( 0,0 )             # Position of ROI in image
@@ -78,14 +106,29 @@ class telecinePerforation():
     
     # Updated when the find method is called
     found = False	# If last detection was successful
+    foundSize = ( 0,0 ) # Size of the perforation found
+    confidence = 0.0    # How sure the detection is of the perforation - 0 to 1
 
     thresholdVal = 0.98 # 
 
+    # How each row or column of a section of the ROI is reduced to one value:
+    # median    - median of all pixels (original method)
+    # partition - middle pixel found with a partial sort, no averaging
+    # subsample - middle pixel of reductionSamples evenly spaced pixels
+    # trimmed   - mean of the middle half of reductionSamples evenly spaced pixels
+    reduction = 'median'
+    reductionSamples = 15
+
     expectedSize = ( 0,0 )      # Expected size of perforation
     position = (0,0)
     centre = (0,0)	# Centre of perforation
+    exactCentre = (0.0,0.0)    # Centre of perforation to a fraction of a pixel
     yDiff = 0		# Difference between real and ideal position of perforation
 
+    # Find the edges to a fraction of a pixel from the profile across them,
+    # rather than the first pixel past the threshold
+    subpixel = True
+
     # Ranges of acceptable values for aspect ratio, height and width of the detected perforation
     aspectRange = ( 0.0, 0.0 )
     widthRange = ( 0,0 )
@@ -96,6 +139,30 @@ class telecinePerforation():
     # 2 - Use bottom edge only as reference
     # else use centre between detected top and bottom edges as reference
     checkLeftEdge = True
+
+    # Chain of detection engines from rpiTelecine.engines used by find() - each
+    # is tried until one finds the perforation. None uses defaultEngines
+    engines = None
+    result = None               # detectionResult of the last detection
+    engine = None               # Name of the engine that found it
+    measuredPitch = None        # Distance to the next perforation, if the engine measured it
+
+    # Tracking - predicts where the next perforation will be from how far the
+    # film has been moved and the pitch of the previous perforations, and only
+    # searches a small window round the prediction. The pitch is followed with a
+    # constant velocity (alpha-beta) filter. On failure the whole ROI is searched.
+    tracking = False
+    trackAlpha = 0.3            # Gain of the pitch filter
+    trackBeta = 0.02            # Gain of the change of pitch per frame
+    trackMargin = 4             # Window is this many times the average prediction error...
+    trackMinWindow = 12         # ...but at least this many pixels above and below the perforation
+    trackPitch = 0              # Estimated distance between perforations in pixels
+    trackRate = 0               # Estimated change of pitch per frame
+    trackSpread = 0             # Average prediction error in pixels
+    trackY = None               # Last perforation centre on the full frame, None if lost
+    trackMoved = 0              # Pixels the film has moved since the last detection
+    predictedY = None           # Predicted centre while searching the tracking window
+    fullROI = None              # ROI to go back to after searching the tracking window
     
     # Some useful information based on the mm dimensions from the film specifications
     perforationAspectRatio = {'super8':(0.91/1.14), 'std8':(1.8/1.23)} # Standard sizes in mm
@@ -120,6 +187,8 @@ class telecinePerforation():
         # size is a (w,h) tuple of a perforation size
         if imageSize[0]>imageSize[1]:
             self.imageSize = (imageSize[1],imageSize[0])
+        self.fullImageSize = self.imageSize
+        self.imageOffset = (0,0)
         self.setFilmType(filmType)
         self.ROIcentrexy[0] = int(cx)
         self.setPerforationSize( expectedSize )
@@ -135,6 +204,28 @@ class telecinePerforation():
         else:
             raise Exception("Error - '{}' is an incorrect film type.".format(filmType))
 
+    def setReduction(self,reduction):
+        if reduction in reductionTypes:
+            self.reduction = reduction
+        else:
+            raise Exception("Error - '{}' is an incorrect reduction.".format(reduction))
+
+    def reduceStrip(self, section, axis):
+        # Makes a single pixel wide strip from a section of the ROI, with
+        # one value for each row (axis=1) or column (axis=0)
+        n = section.shape[axis]
+        if self.reduction == 'median' or n < 3:
+            return np.median(section, axis=axis)
+        if self.reduction != 'partition':
+            step = max(1, n//self.reductionSamples)
+            section = section[:,::step] if axis==1 else section[::step]
+            n = section.shape[axis]
+        if self.reduction == 'trimmed':
+            section = np.sort(section, axis=axis)
+            middle = np.index_exp[:,n//4:n-n//4] if axis==1 else np.index_exp[n//4:n-n//4]
+            return section[middle].mean(axis=axis)
+        return np.partition(section, n//2, axis=axis).take(n//2, axis=axis)
+
     def setPerforationSize(self,size):
         # Sets the expected size of the perforation, and a margin for error
         w,h = size
@@ -145,16 +236,42 @@ class telecinePerforation():
             self.heightRange = ( h-h_margin , h+h_margin )
             self.expectedSize = size
             self.isInitialised = True
+            self.resetTracking()
         else:
             self.expectedSize = (0,0)
             self.ROIimg = None
             self.isInitialised = False
         self.setROI()
 
+    def setImageCrop(self, crop=None):
+        """
+        Tells the detection the camera is only capturing part of the full
+        frame - crop is (x,y,w,h) in full frame coordinates, or None for the
+        full frame. From then on all positions (ROI, centre, crop slices)
+        are relative to the cropped image, and the ROI covers the same
+        part of the film as it did before.
+        """
+        full_h,full_w = self.fullImageSize
+        if crop is None:
+            crop = ( 0,0, full_w,full_h )
+        x,y,w,h = crop
+        dx = x - self.imageOffset[0]
+        dy = y - self.imageOffset[1]
+        self.imageOffset = ( x,y )
+        self.imageSize = ( h,w )
+        self.ROIcentrexy = [ self.ROIcentrexy[0]-dx, self.ROIcentrexy[1]-dy ]
+        self.centre = ( self.centre[0]-dx, self.centre[1]-dy )
+        self.exactCentre = ( self.exactCentre[0]-dx, self.exactCentre[1]-dy )
+        self.position = ( self.position[0]-dx, self.position[1]-dy )
+        self.setROI()
+
     def setROI(self):
         # Sets the ROI where to look for a perforation
         # If an expected perforation size is set, then ROI is based on size of perforation
-        img_h,img_w = self.imageSize
+        # The ROI is worked out on the full frame, then moved to the
+        # image coordinates if the camera is cropping
+        img_h,img_w = self.fullImageSize
+        ox,oy = self.imageOffset
         if self.isInitialised:
             # Already know expected size, so use smaller ROI
             # ROI height and position on Y axis
@@ -168,9 +285,9 @@ class telecinePerforation():
                 y = int(img_h/50)  # 39 pixels with 1944px high image
             # Base width on previously detected perforation - centre ib ROIcx
             w = int((self.expectedSize[0] + (self.expectedSize[0]*self.sizeMargin))/2)
-            roiL = max(0, self.ROIcentrexy[0]-w)
-            roiR = min(img_w, self.ROIcentrexy[0]+w)
-            self.ROIcentrexy = [ int(roiL+(roiR-roiL)/2), int(y+(h/2)) ]
+            roiL = max(0, self.ROIcentrexy[0]+ox-w)
+            roiR = min(img_w, self.ROIcentrexy[0]+ox+w)
+            self.ROIcentrexy = [ int(roiL+(roiR-roiL)/2)-ox, int(y+(h/2))-oy ]
         else:
             # Not found before - so use larger area for detection
             # Use whole image height + half image width
@@ -179,6 +296,13 @@ class telecinePerforation():
             roiL = 0
             roiR = int(img_w/2)
             self.ROIcentrexy = [0,0]
+        # Move to image coordinates, keeping inside the image
+        img_h,img_w = self.imageSize
+        roiL = min(max(0, roiL-ox), img_w)
+        roiR = min(max(0, roiR-ox), img_w)
+        y0 = min(max(0, y-oy), img_h)
+        h = min(max(0, y+h-oy), img_h) - y0
+        y = y0
         self.ROIxy = ( roiL, y )
         self.ROIwh = ( roiR-roiL, h )
         self.ROIslice = np.index_exp[ y:y+h, roiL:roiR ]         # Create the slice object for making the ROI
@@ -217,6 +341,8 @@ class telecinePerforation():
         self.found = False
 
         self.imageSize = img.shape[:2]
+        self.fullImageSize = self.imageSize
+        self.imageOffset = (0,0)
         self.setROI()
         self.setROIimg(img)
  
@@ -230,13 +356,15 @@ class telecinePerforation():
         threshVal = int(vROI.max()*self.thresholdVal)
 
         #Make a single pixel wide strip, with the median of all the rows - and threshold it
-        vROI = np.median(vROI,axis=1) < threshVal
+        vStrip = self.reduceStrip(vROI,1)
+        vROI = vStrip < threshVal
 
         # And horizontal...
         hROI = self.ROIimg[yStart-win:yStart+win,:]
         
         #Make a single pixel wide strip, with the median of all the columns - and threshold it
-        hROI = np.median(hROI,axis=0) < threshVal
+        hStrip = self.reduceStrip(hROI,0)
+        hROI = hStrip < threshVal
 
         # Check if centre section is clear of data
         if hROI[xStart-win:xStart+win].any() or vROI[yStart-win:yStart+win].any():
@@ -259,14 +387,24 @@ class telecinePerforation():
             left  = hROI[::-1].argmax() 
             left  = xStart-left if left>0 else 0
 
+            edges = [ float(left), float(top), float(right), float(bot) ]
+            if self.subpixel:
+                # Edges that lie inside the ROI
+                for n,(strip,edge,end) in enumerate( ((hStrip,left,w), (vStrip,top,h), (hStrip,right,w), (vStrip,bot,h)) ):
+                    if 0 < edge < end:
+                        edges[n] = edgePosition(strip, edge)
+            leftF,topF,rightF,botF = edges
+
             # Sanity check the aspect ratio of detection
-            w = right-left
-            h = bot-top
+            w = int(round(rightF-leftF))
+            h = int(round(botF-topF))
             aspect = float(w) / float(h)
             if self.aspectRange[0] <= aspect <= self.aspectRange[1]:
                 # Aspect Ratio of found perforation is OK - save information
                 self.setPerforationSize( (w,h) )
-                self.setPerfPosition( x+left+((right-left)/2), y+top+(h/2) )
+                self.setPerfPosition( x+(leftF+rightF)/2, y+(topF+botF)/2 )
+                self.foundSize = ( w,h )
+                self.confidence = 1.0
                 self.windowWidth = w - (w*self.sizeMargin*2)
                 self.isInitialised = True
                 # Now adjust ROI to match found perforation
@@ -276,15 +414,74 @@ class telecinePerforation():
             else:
                 print( "Perforation aspect {} ratio NOT OK - detection failed. Range: {}".format(aspect,self.aspectRange) )
 
+    def findCandidates(self, img, reduction=8):
+        """
+        Coarse search for a perforation anywhere in the left half of the image,
+        on a view of every reduction'th pixel - no copy or resize is done.
+        Bands of columns with a lot of bright pixels may be the perforation
+        line, and the bright runs down a band with the right aspect ratio are
+        the candidates. Bands are tried from the left, as the perforations are
+        at the edge of the film. Returns the (x,y) centres of the candidates in
+        the first band that has any, in image coordinates, nearest the middle
+        of the ROI first.
+        """
+        img_h,img_w = img.shape[:2]
+        small = img[::reduction,:img_w//2:reduction]
+        if small.ndim > 2:
+            small = small[:,:,1]
+        bright = small >= int(small.max()*self.thresholdVal)
+        # Perforations take up over a quarter of the film length, so
+        # a column through them is bright for at least an eighth of it
+        cols = bright.sum(axis=0)
+        middle = self.ROIcentrexy[1] if self.isInitialised else img_h/2
+        for left,right in zip( *findRuns( cols > bright.shape[0]//8 ) ):
+            candidates = []
+            for top,bot in zip( *findRuns( bright[:,left:right].mean(axis=1) > 0.5 ) ):
+                # Width of this run - the band may be wider if the film weaves
+                inside = np.flatnonzero( bright[top:bot,left:right].mean(axis=0) > 0.5 )
+                w = inside.size
+                h = bot-top
+                # Allow for the edges being out by a pixel either way at this scale
+                if not self.aspectRange[0]*(h+2) <= w+2 or not w-2 <= self.aspectRange[1]*(h-2):
+                    continue
+                if self.isInitialised and not self.heightRange[0]/reduction-1 <= h <= self.heightRange[1]/reduction+1:
+                    continue
+                candidates.append( ( (left+inside.mean()+0.5)*reduction, (top+bot)*reduction/2 ) )
+            if candidates:
+                candidates.sort( key=lambda c: abs(c[1]-middle) )
+                return [ (int(cx),int(cy)) for cx,cy in candidates ]
+        return []
+
+    def findCandidate(self, img, reduction=8):
+        # Centre of the most likely perforation from findCandidates, or None
+        candidates = self.findCandidates(img, reduction)
+        return candidates[0] if candidates else None
+
+    def findFirst(self, img, windowWidth=20, reduction=8):
+        # Find first perforation and its size without a starting position
+        # A coarse search finds the candidates, then findFirstFromCoords 
+        # finds the edges at full resolution - trying each candidate in turn
+        self.found = False
+        candidates = self.findCandidates(img, reduction)
+        for candidate in candidates:
+            self.findFirstFromCoords(img, candidate, windowWidth)
+            if self.found:
+                break
+        if not candidates:
+            print( "No perforation candidate found" )
+
     def setPerfPosition(self,cx,cy):
         # Sets the perforation position based on the centre
-        self.centre = ( int(cx), int(cy) )
-        self.position = ( int(cx-self.expectedSize[0]/2),int(cy-self.expectedSize[1]/2) )
-        self.yDiff = int(self.centre[1]-self.ROIcentrexy[1])
+        # centre and position are whole pixels, yDiff keeps the fraction
+        self.exactCentre = ( float(cx), float(cy) )
+        self.centre = ( int(round(cx)), int(round(cy)) )
+        self.position = ( int(round(cx-self.expectedSize[0]/2)),int(round(cy-self.expectedSize[1]/2)) )
+        self.yDiff = self.exactCentre[1]-self.ROIcentrexy[1]
 
-    def findVertical(self, img):
+    def findVertical(self, img, alternative=True):
         # Used for subsequent captures where we know the expected size and 
         # approximate horizontal position of perforation
+        # If alternative is set findVerticalAlternative is tried on failure
 
         self.found = False
         self.setROIimg(img)
@@ -293,13 +490,17 @@ class telecinePerforation():
 
         xStart = self.ROIwh[0]//2
         #xStart = self.centre[0]-ROIxy[0]
-        yStart = self.ROIcentrexy[1]-self.ROIxy[1]
-        win = (expectedW - (expectedW*self.sizeMargin) )//2 
+        if self.predictedY is None:
+            yStart = self.ROIcentrexy[1]-self.ROIxy[1]
+        else:
+            yStart = self.predictedY-self.ROIxy[1]
+        win = int(expectedW - (expectedW*self.sizeMargin) )//2 
 
         vROI = self.ROIimg[:,xStart-win:xStart+win]
         threshVal = int(vROI.max() * self.thresholdVal)
 
-        vROI = np.median(vROI,axis=1) < threshVal
+        strip = self.reduceStrip(vROI,1)
+        vROI = strip < threshVal
         #print "FindVertical: vROI"
         #print "shape: {}".format(vROI.shape)
 
@@ -316,62 +517,80 @@ class telecinePerforation():
         #print("top:{}".format(top))
         #print vROI[::-1]
         top   = yStart-top if top>0 else 0
+
+        topF,botF = float(top),float(bot)
+        if self.subpixel:
+            if top > 0:
+                topF = edgePosition(strip, top)
+            if bot < h:
+                botF = edgePosition(strip, bot)
   
         if self.checkEdges==1:
             # use top edge as reference and extrapolate bottom edge
             bot = top+expectedH
+            botF = topF+expectedH
         elif self.checkEdges==2:
             # use bottom edge as reference
             top = bot-expectedH
+            topF = botF-expectedH
+        if self.predictedY is not None and (top == 0 or bot == h):
+            # Perforation runs off the tracking window so the edges are wrong
+            return
         # Check if detected is close to correct aspect ratio of perforation
         aspect =  float(expectedW) / float(bot-top)
         if self.aspectRange[0] <= aspect <= self.aspectRange[1]:
             # Aspect Ratio of found perforation is OK - save information
             #print( "Aspect ratio OK" )
             x,y = self.ROIxy
-            self.setPerfPosition( x + xStart, y + top + ((bot-top)/2) )
+            self.setPerfPosition( x + xStart, y + (topF+botF)/2 )
+            self.foundSize = ( expectedW, bot-top )
+            self.confidence = max( 0.0, 1 - abs(bot-top-expectedH)/expectedH )
             self.found = True
         else:
             print( "Perforation aspect {} ratio NOT OK - detection failed. Range: {}".format(aspect,self.aspectRange) )
-        if not(self.found):
+        if not(self.found) and alternative and self.predictedY is None:
             # Try alternative method
             self.findVerticalAlternative()
 
     def findVerticalAlternative(self):
         # This is an alternative method, a bit more expensive
         # than the first version, and is called on failure of
-        # the previous findVertical. It uses Scipy labelling to segment the a strip 
-        # of data from the ROI
+        # the previous findVertical. It segments a strip of data from
+        # the ROI into runs of bright rows, and takes the brightest run
+        # that is the right height for a perforation
         self.found = False
         cx = self.ROIwh[0]//2
         expectedW, expectedH = self.expectedSize
 
-        win = (expectedW - (expectedW*self.sizeMargin) )//2 
+        win = int(expectedW - (expectedW*self.sizeMargin) )//2 
         #take a vertical section of pixels from the ROI and threshold it
         vROI = self.ROIimg[:,cx-win:cx+win]
 
         #Make a single pixel wide strip, with the median of all the rows 
-        vROI = np.median(vROI,axis=1)
+        vROI = self.reduceStrip(vROI,1)
         threshVal = int(vROI.max() * self.thresholdVal)
         vROIthres = vROI >= threshVal
-        candidate = None
         if vROIthres.min() != vROIthres.max(): 
             # Prevent a divide by zero because roi is all the same value. 
             # e.g. we have a frame completely white or black
-            lbl,numLbl = nd.label(vROIthres)
-            obj = nd.find_objects(lbl)
-            brightest = 0
-            for s in obj:
-                print s
-                # s is an np.slice object
-                sBright = np.mean(vROI[s]) 
-                sHeight = s[0].stop - s[0].start
-                if (self.heightRange[0] <= sHeight <= self.heightRange[1]) and sBright > brightest:
-                    candidate = s[0]
-                    brightest = sBright
-        if candidate:
-            self.setPerfPosition( self.ROIcentrexy[0], self.ROIxy[1]+candidate.start + ((candidate.stop-candidate.start)/2 )) 
-            self.found = True
+            starts,stops = findRuns(vROIthres)
+            heights = stops-starts
+            # Mean brightness of every run from the running total of the strip
+            total = np.concatenate( ([0], np.cumsum(vROI, dtype=np.float64)) )
+            brightness = (total[stops]-total[starts]) / heights
+            ok = np.flatnonzero( (heights >= self.heightRange[0]) & (heights <= self.heightRange[1]) )
+            if ok.size:
+                best = ok[ brightness[ok].argmax() ]
+                top,bot = float(starts[best]),float(stops[best])
+                if self.subpixel:
+                    if starts[best] > 0:
+                        top = edgePosition(vROI, starts[best])
+                    if stops[best] < vROI.size:
+                        bot = edgePosition(vROI, stops[best])
+                self.setPerfPosition( self.ROIcentrexy[0], self.ROIxy[1] + (top+bot)/2 ) 
+                self.foundSize = ( expectedW, heights[best] )
+                self.confidence = max( 0.0, 1 - abs(heights[best]-expectedH)/expectedH )
+                self.found = True
 
     def findLeftEdge(self):
         # Find the left edge of the perforation.
@@ -385,7 +604,7 @@ class telecinePerforation():
 
             expectedW, expectedH = self.expectedSize
 
-            win = (expectedH - (expectedH*self.sizeMargin) )//2 
+            win = int(expectedH - (expectedH*self.sizeMargin) )//2 
 
             #Centre of current perforation
             centre = (self.centre[0]-self.ROIxy[0], self.centre[1]-self.ROIxy[1] )
@@ -395,24 +614,118 @@ class telecinePerforation():
             threshVal = int(hROI.max() * self.thresholdVal)
 
             #Make a single pixel wide strip, with the median of all the columns - and threshold it
-            hROI = np.median(hROI, axis=0) < threshVal
+            strip = self.reduceStrip(hROI,0)
+            hROI = strip < threshVal
 
             # Position of edge of perforation
             left  = hROI[::-1].argmax() 
             left  = centre[0]-left if left>0 else 0
+            leftF = edgePosition(strip, left) if self.subpixel and left > 0 else float(left)
 
             self.position = ( left + self.ROIxy[0], self.position[1] )
             self.centre = (left + (self.expectedSize[0]//2) + self.ROIxy[0], self.centre[1] )
+            self.exactCentre = ( leftF + self.expectedSize[0]/2 + self.ROIxy[0], self.exactCentre[1] )
         else:
             raise Exception('Error - Cannot do findLeftEdge until vertical has been found')
 
+    def resetTracking(self):
+        # Starts tracking again from the expected perforation size
+        if self.filmType in self.frameHeightMultiplier:
+            self.trackPitch = self.expectedSize[1] * self.frameHeightMultiplier[self.filmType]
+        self.trackRate = 0
+        self.trackSpread = 0
+        self.trackY = None
+        self.trackMoved = 0
+
+    def moved(self, pixels):
+        # Tells the tracking the film has been moved - positive pixels moves
+        # the film up the image
+        self.trackMoved += pixels
+
+    def predict(self):
+        # Predicted centre of the perforation nearest the middle of the ROI on the
+        # full frame, and how many perforations the film has moved on to get there
+        y = self.trackY - self.trackMoved
+        pitch = self.trackPitch + self.trackRate
+        frames = int(round((self.ROIcentrexy[1] + self.imageOffset[1] - y) / pitch))
+        return y + frames*pitch, frames
+
+    def setTrackingROI(self):
+        # Narrows the ROI to a window round the predicted perforation position
+        # Returns False if there's no prediction
+        if self.trackY is None or self.trackPitch <= 0:
+            return False
+        predicted, frames = self.predict()
+        predicted = int(round(predicted)) - self.imageOffset[1]
+        half = int(self.expectedSize[1]/2 + max(self.trackMinWindow, self.trackMargin*self.trackSpread))
+        x,y = self.ROIxy
+        w,h = self.ROIwh
+        top = max(y, predicted-half)
+        bot = min(y+h, predicted+half)
+        if bot-top < self.expectedSize[1] or not top < predicted < bot:
+            return False
+        self.fullROI = ( self.ROIslice, self.ROIxy, self.ROIwh )
+        self.ROIxy = ( x, top )
+        self.ROIwh = ( w, bot-top )
+        self.ROIslice = np.index_exp[ top:bot, x:x+w ]
+        self.predictedY = predicted
+        return True
+
+    def restoreROI(self):
+        # Back to the full ROI after searching the tracking window
+        self.ROIslice, self.ROIxy, self.ROIwh = self.fullROI
+        self.predictedY = None
+
+    def updateTracking(self):
+        # Updates the pitch estimate from the perforation just found
+        if not self.found:
+            self.trackY = None
+            self.trackMoved = 0
+            return
+        y = self.exactCentre[1] + self.imageOffset[1]
+        if self.trackY is not None:
+            predicted, frames = self.predict()
+            error = y - predicted
+            if frames:
+                self.trackPitch += self.trackRate + self.trackAlpha*error/frames
+                self.trackRate += self.trackBeta*error/frames
+            self.trackSpread += (abs(error) - self.trackSpread) * 0.25
+        self.trackY = y
+        self.trackMoved = 0
+
+    def setEngines(self, names=None):
+        # Sets the chain of detection engines by name - see rpiTelecine.engines
+        # The engines use the functions in this module, so are imported here
+        from rpiTelecine.engines import makeEngines, defaultEngines
+        self.engines = makeEngines(defaultEngines if names is None else names)
+
+    def detect(self, img):
+        # Runs the chain of detection engines on the current ROI
+        if self.engines is None:
+            self.setEngines()
+        self.result = None
+        self.engine = None
+        self.measuredPitch = None
+        for engine in self.engines:
+            self.result = engine.find(self, img)
+            if self.result is not None:
+                self.engine = engine.name
+                break
+
     def find(self,img):
         # Find perforation position in the image
         if self.isInitialised:
-            self.findVertical(img)
-            if self.found and self.checkLeftEdge:
-                self.findLeftEdge()
+            self.found = False
+            if self.tracking and self.setTrackingROI():
+                # Search a small window round the predicted position first
+                self.detect(img)
+                self.restoreROI()
+                if not self.found:
+                    print('Perforation not at predicted position - searching whole ROI')
+            if not self.found:
+                self.detect(img)
+            if self.tracking:
+                self.updateTracking()
         else:
             # We haven't initialised or run findFirstFromCoords 
             raise Exception('Error - Perforation detection not initialised.')
-
@@ -0,0 +1,291 @@
+# RPi Telecine - Replay camera and control
+#
+# Stand-ins for TelecineCamera and tcControl, so the telecine scripts
+# can be run, tested and benchmarked on any Linux box without a Pi,
+# camera, or the MCP23S17 control board.
+#
+# The replay camera serves frames from one of:
+#   - a directory of images (png/jpg), in filename order
+#   - a .npy file holding a stack of images
+#   - 'synthetic' or 'synthetic:std8' - a rendered strip of film
+#
+# The replay control keeps count of the motor steps taken. The camera
+# uses this to decide what to show - a synthetic strip is rendered at
+# the exact position of the film, recorded frames move on one frame
+# for each steps_per_frame motor steps.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import glob
+import os
+import time
+import numpy as np
+import cv2
+
+from rpiTelecine.frames import bgrBufferPool, padded_resolution, yuvFrame
+from rpiTelecine.synthetic import filmStrip
+
+class replayControl():
+    """
+    Stub of tcControl. Nothing is driven - the motor steps are counted
+    so the replay camera knows where the film is. step_time can be set
+    to simulate the time the steppers take.
+    """
+
+    step_time = 0.0     # Seconds per motor step
+
+    def __init__(self):
+        self.position = 0   # Film travel in motor steps
+        self.direction = True
+        self.light = False
+        self.m1 = replayDevice()
+        self.m2 = replayDevice()
+        self.reel1 = replayDevice()
+        self.reel2 = replayDevice()
+        self.led = replayDevice()
+
+    def light_on(self):
+        self.light = True
+
+    def light_off(self):
+        self.light = False
+
+    def change_direction( self, d = True ):
+        self.direction = d
+
+    def steps_forward(self,steps=1):
+        if not self.direction:
+            self.change_direction( True )
+        self.position += steps
+        if self.step_time:
+            time.sleep(steps*self.step_time)
+
+    def steps_back(self,steps=1):
+        if self.direction:
+            self.change_direction( False )
+        self.position -= steps
+        if self.step_time:
+            time.sleep(steps*self.step_time)
+
+    def tension_film(self,steps=200):
+        pass
+
+    def clean_up(self):
+        self.light_off()
+
+class replayDevice():
+    """
+    Stub for the motors, reel motors and LED of tcControl
+    """
+
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+    def pulse(self):
+        pass
+
+    def step(self):
+        pass
+
+    def set_direction(self, direction=True):
+        pass
+
+class directorySource():
+    # Frames from image files in a directory, in filename order
+
+    def __init__(self, path):
+        self.files = sorted( glob.glob(os.path.join(path,'*.png')) + glob.glob(os.path.join(path,'*.jpg')) )
+        if not self.files:
+            raise Exception('No images found in {}'.format(path))
+        img = cv2.imread(self.files[0])
+        self.imageSize = ( img.shape[1], img.shape[0] )
+
+    def __len__(self):
+        return len(self.files)
+
+    def frame(self, n):
+        return cv2.imread(self.files[n % len(self.files)])
+
+class arraySource():
+    # Frames from a .npy stack of images - (frames,h,w,3) or (frames,h,w)
+    # The file is memory mapped so only the frames used are read
+
+    def __init__(self, path):
+        self.stack = np.load(path, mmap_mode='r')
+        self.imageSize = ( self.stack.shape[2], self.stack.shape[1] )
+
+    def __len__(self):
+        return self.stack.shape[0]
+
+    def frame(self, n):
+        img = np.array(self.stack[n % self.stack.shape[0]])
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        return img
+
+class replayCamera():
+    """
+    Stand-in for TelecineCamera that serves recorded or synthetic frames
+    through the same take_picture/take_bracket_pictures API.
+
+    source is a directory, a .npy file, 'synthetic' or 'synthetic:std8'.
+    transport is the replayControl whose step count says where the film is.
+    capture_time adds a delay to each capture to simulate the camera.
+    """
+
+    IMAGE_EFFECTS = { 'none':0 }
+    capture_time = 0.0
+
+    def __init__(self, source, transport=None, steps_per_frame=300, pixels_per_step=4.0):
+        self.transport = transport
+        self.steps_per_frame = steps_per_frame
+        self.pixels_per_step = pixels_per_step
+        self.strip = None
+        self.recorded = None
+        if source.startswith('synthetic'):
+            filmType = source.split(':')[1] if ':' in source else 'super8'
+            self.strip = filmStrip(filmType)
+            self.MAX_IMAGE_RESOLUTION = self.strip.imageSize
+        elif source.endswith('.npy'):
+            self.recorded = arraySource(source)
+            self.MAX_IMAGE_RESOLUTION = self.recorded.imageSize
+        else:
+            self.recorded = directorySource(source)
+            self.MAX_IMAGE_RESOLUTION = self.recorded.imageSize
+        self.resolution = self.MAX_IMAGE_RESOLUTION
+        self.crop = None            # Sensor crop (x,y,w,h)
+        self.captures = 0           # Number of pictures taken
+        self.shutter_speed = 0
+        self.base_shutter = 0
+        self.awb_gains = (1.5,1.5)
+        self.awb_mode = 'off'
+        self.drc_strength = 'off'
+        self.image_effect = 'none'
+        self.exposure_mode = 'auto'
+        self.framerate = 15
+        self.vflip = True
+        self.bracket_stops = []
+        self.bracket_shutters = []
+        self._yuv_frames = []
+
+    def setup_cam(self,awb_gains,shutter,drc='off',effect='none'):
+        self.awb_gains = awb_gains
+        self.shutter_speed = shutter
+        self.base_shutter = shutter
+        self.drc_strength = drc
+        self.image_effect = effect
+
+    def image(self):
+        # The full frame at the current film position
+        self.captures += 1
+        if self.capture_time:
+            time.sleep(self.capture_time)
+        position = self.transport.position if self.transport else self.captures
+        if self.strip is not None:
+            img = self.strip.render( position*self.pixels_per_step )
+        elif self.transport:
+            img = self.recorded.frame( int(round(position/self.steps_per_frame)) )
+        else:
+            img = self.recorded.frame( self.captures-1 )
+        if self.crop is not None:
+            x,y,w,h = self.crop
+            img = img[y:y+h,x:x+w]
+        return img
+
+    def take_picture(self):
+        return self.image().copy()
+
+    def set_sensor_crop(self, crop=None, mirror=None):
+        # Same alignment as TelecineCamera, the mirror is not needed
+        W,H = self.MAX_IMAGE_RESOLUTION
+        if crop is None:
+            self.crop = None
+            self.resolution = (W,H)
+            return (0,0,W,H)
+        x,y,w,h = crop
+        w = min( W, (w+31)//32*32 )
+        h = min( H, (h+15)//16*16 )
+        x = min( max(0, x - x%2), W-w )
+        y = min( max(0, y - y%2), H-h )
+        self.crop = (x,y,w,h)
+        self.resolution = (w,h)
+        return self.crop
+
+    def yuv_frame(self,n=0):
+        if self._yuv_frames and self._yuv_frames[0].resolution != tuple(self.resolution):
+            self._yuv_frames = []
+        while len(self._yuv_frames) <= n:
+            self._yuv_frames.append( yuvFrame(self.resolution) )
+        frame = self._yuv_frames[n]
+        frame.reset()
+        return frame
+
+    def take_yuv_picture(self):
+        frame = self.yuv_frame()
+        frame.set_bgr( self.image() )
+        return frame
+
+    def take_raw_picture(self):
+        raise Exception('Raw capture is not available from the replay camera')
+
+    def continuous_pictures(self, buffers=3):
+        # Same buffer handling as the video port capture
+        pool = bgrBufferPool(self.resolution, buffers)
+        pw,ph = padded_resolution(self.resolution)
+        padded = np.zeros( (ph,pw,3), dtype=np.uint8 )
+        while True:
+            img = self.image()
+            padded[:img.shape[0],:img.shape[1]] = img
+            pool.write( padded.data )
+            yield pool.next_frame()
+
+    def setup_brackets(self, stops=(0,2)):
+        self.bracket_stops = list(stops)
+        self.bracket_shutters = [ int(round(self.base_shutter * 2**s)) for s in stops ]
+
+    def take_bracket_pictures(self,yuv=False):
+        # The same frame brightened or darkened for each exposure
+        if not self.bracket_stops:
+            self.setup_brackets()
+        img = self.image()
+        imgs = []
+        for n,stop in enumerate(self.bracket_stops):
+            exposure = cv2.convertScaleAbs( img, alpha=2**stop )
+            if yuv:
+                frame = self.yuv_frame(n)
+                frame.set_bgr( exposure )
+                exposure = frame
+            imgs.append( exposure )
+        return imgs
+
+    def close(self):
+        pass
@@ -0,0 +1,212 @@
+# RPi Telecine - Frame store
+#
+# An alternative to writing a file per frame. The encoded images of a job
+# are appended to a few large chunk files, and a small index file has a
+# fixed size record for each image: the frame number, bracket, where the
+# image is in the chunks, the perforation centre and when it was taken and
+# written. Thousands of frames are then a handful of files to copy, and
+# there is no directory of thousands of entries on the SD card.
+#
+# The data of an image is written before its index record, and a record
+# is written in a single write, so if the job is stopped part way the
+# store is still readable up to the last complete record. A store can be
+# added to by running the job again.
+#
+# frameStoreReader memory maps the chunks, so an image's data is a view
+# of the file with nothing read until it is used.
+# post-production/export-frames.py writes the frames back out as files.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import mmap
+import os
+import threading
+import time
+import numpy as np
+import cv2
+
+indexName = 'frames.idx'
+chunkName = 'frames-{:04d}.dat'
+storeVersion = 1
+
+headerType = np.dtype( [ ('magic','S4'), ('version','<u2'), ('ext','S10') ] )
+recordType = np.dtype( [ ('frame','<i4'), ('bracket','u1'), ('flags','u1'), ('chunk','<u2'),
+                         ('offset','<u8'), ('length','<u4'), ('cx','<f4'), ('cy','<f4'),
+                         ('captured','<f8'), ('written','<f8') ] )
+
+# Bits of the flags field
+failedFlag = 1      # Perforation not found - a full frame
+rawFlag = 2         # Raw Bayer data rather than an encoded image
+
+def isStore(path):
+    return os.path.isfile( os.path.join(path, indexName) )
+
+def readHeader(path):
+    # Returns the version and image type of a store
+    with open( os.path.join(path, indexName), 'rb' ) as f:
+        header = np.fromfile(f, dtype=headerType, count=1)
+    if len(header) != 1 or header['magic'][0] != b'TCFS':
+        raise Exception('{} is not a frame store'.format(path))
+    version = int(header['version'][0])
+    if version > storeVersion:
+        raise Exception('Frame store version {} is newer than this program'.format(version))
+    return version, header['ext'][0].decode('ascii')
+
+class frameStore():
+    """
+    Appends images to the store in the folder path. ext is the type of the
+    encoded images - 'png', 'jpg' or 'raw' - and is the same for the whole
+    store. A new chunk file is started once a chunk is chunkSize bytes.
+    append can be called from several writer threads at once.
+    """
+
+    def __init__(self, path, ext, chunkSize=1<<30):
+        self.path = path
+        self.ext = ext
+        self.chunkSize = chunkSize
+        self.lock = threading.Lock()
+        indexPath = os.path.join(path, indexName)
+        if os.path.exists(indexPath):
+            version,storeExt = readHeader(path)
+            if storeExt != ext:
+                raise Exception('Frame store in {} holds {} images, not {}'.format(path, storeExt, ext))
+            # Carry on from the end of the last chunk
+            size = os.path.getsize(indexPath) - headerType.itemsize
+            self.index = open(indexPath, 'ab')
+            self.index.truncate( headerType.itemsize + size - size%recordType.itemsize )
+            self.chunk = 0
+            while os.path.exists( os.path.join(path, chunkName.format(self.chunk+1)) ):
+                self.chunk += 1
+        else:
+            self.index = open(indexPath, 'wb')
+            header = np.zeros(1, dtype=headerType)
+            header['magic'] = b'TCFS'
+            header['version'] = storeVersion
+            header['ext'] = ext
+            self.index.write( header.tostring() )
+            self.index.flush()
+            self.chunk = 0
+        self.data = open( os.path.join(path, chunkName.format(self.chunk)), 'ab' )
+        self.data.seek(0, os.SEEK_END)
+        self.offset = self.data.tell()
+        self.record = np.zeros(1, dtype=recordType)
+
+    def append(self, data, frame, bracket=0, failed=False, centre=(0,0), captured=0):
+        """
+        Adds an image. data is the encoded image as a numpy uint8 array or
+        string, bracket is 0 unless the frame is bracketed - then it counts
+        from 1 - and centre is the perforation centre in the full image.
+        """
+        data = np.asarray( bytearray(data) if isinstance(data, bytes) else data, dtype=np.uint8 ).reshape(-1)
+        with self.lock:
+            if self.offset > 0 and self.offset + data.size > self.chunkSize:
+                self.data.close()
+                self.chunk += 1
+                self.data = open( os.path.join(self.path, chunkName.format(self.chunk)), 'ab' )
+                self.offset = 0
+            self.data.write( data.data )
+            self.data.flush()
+            r = self.record
+            r['frame'] = frame
+            r['bracket'] = bracket
+            r['flags'] = (failedFlag if failed else 0) | (rawFlag if self.ext == 'raw' else 0)
+            r['chunk'] = self.chunk
+            r['offset'] = self.offset
+            r['length'] = data.size
+            r['cx'],r['cy'] = centre
+            r['captured'] = captured
+            r['written'] = time.time()
+            self.index.write( r.tostring() )
+            self.index.flush()
+            self.offset += data.size
+
+    def close(self):
+        with self.lock:
+            self.data.close()
+            self.index.close()
+
+class frameStoreReader():
+    """
+    Reads a frame store. The index is read when the store is opened, the
+    chunks are memory mapped as they are needed. Images are numbered in
+    the order they were written - index holds their records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version,self.ext = readHeader(path)
+        with open( os.path.join(path, indexName), 'rb' ) as f:
+            f.seek(headerType.itemsize)
+            # A record cut short when the job stopped is left out
+            self.index = np.fromfile(f, dtype=recordType)
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def chunk(self, n):
+        if n not in self.maps:
+            with open( os.path.join(self.path, chunkName.format(n)), 'rb' ) as f:
+                self.maps[n] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[n]
+
+    def data(self, i):
+        # The encoded image - a read only view of the chunk, not a copy
+        r = self.index[i]
+        return np.frombuffer( self.chunk(int(r['chunk'])), dtype=np.uint8,
+                              count=int(r['length']), offset=int(r['offset']) )
+
+    def image(self, i, flags=-1):
+        # The decoded image, or the data of a raw frame
+        if self.index[i]['flags'] & rawFlag:
+            return self.data(i)
+        return cv2.imdecode( self.data(i), flags )
+
+    def name(self, i):
+        # File name the image would have had if written by itself
+        r = self.index[i]
+        name = 'img-{:05d}'.format(int(r['frame']))
+        if r['bracket']:
+            name += '-{}'.format(int(r['bracket']))
+        if r['flags'] & failedFlag:
+            name = 'failed-' + name
+        return '{}.{}'.format(name, self.ext)
+
+    def find(self, frame, bracket=0, failed=False):
+        # Index of the image of a frame, or None. If the frame was taken
+        # more than once, the last is returned
+        flags = self.index['flags'] & failedFlag
+        found = np.nonzero( (self.index['frame'] == frame) & (self.index['bracket'] == bracket) &
+                            (flags == (failedFlag if failed else 0)) )[0]
+        return int(found[-1]) if len(found) else None
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
@@ -0,0 +1,271 @@
+# RPi Telecine - Streaming frames to the PC
+#
+# Instead of writing the images to the SD card, the writers can send them
+# over the network to post-production/ingest-server.py on the PC, which
+# writes the files as they arrive.
+#
+# Each image is sent with a sequence number, and the server acknowledges
+# it once the file is written. Up to window images are sent without
+# waiting for their acknowledgements, so the network is kept busy. They
+# are kept until acknowledged, and if the connection is lost it is made
+# again and the server says the last sequence number it has - everything
+# after it is sent again. Sequence numbers carry on from the server's last
+# one when a job is run again. If the server can't be reached for a while
+# the images not acknowledged are given up on and reported, so the job's
+# journal leaves their frames to be captured again.
+#
+# Messages, all little endian:
+#   hello   'TCST', version (uint16), job name length (uint16), job name
+#   reply   'TCOK', last sequence number received for the job (uint64)
+#   frame   'TCFR', sequence number (uint64), name length (uint16),
+#           data length (uint32), flags (uint8), name, data
+#   ack     'TCAK', sequence number (uint64) - everything up to it is written
+# Flags: 1 - the data is zlib compressed
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import collections
+import socket
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+streamVersion = 1
+helloFormat = '<4sHH'
+replyFormat = '<4sQ'
+frameFormat = '<4sQHIB'
+ackFormat = '<4sQ'
+compressedFlag = 1
+
+def recvExactly(sock, n):
+    # Reads n bytes, or raises EOFError if the connection is closed first
+    parts = []
+    while n > 0:
+        data = sock.recv(min(n, 1<<16))
+        if not data:
+            raise EOFError('Connection closed')
+        parts.append(data)
+        n -= len(data)
+    return b''.join(parts)
+
+class frameStreamer():
+    """
+    Sends images to an ingest server for the job. send can be called
+    from several writer threads - it waits while window images are
+    waiting to be acknowledged. Raises an exception if the server can't
+    be reached when it is made. After that a lost connection is retried
+    for up to giveUp seconds, and close waits as long for the last
+    acknowledgements. If either runs out, failed is set, the names of
+    the images the server didn't acknowledge are put in lost, and send
+    raises an exception from then on.
+    """
+
+    retryDelay = 2.0    # Seconds between attempts to connect again
+
+    def __init__(self, host, port, job, window=8, compress=False, timeout=10, giveUp=60):
+        self.address = (host, port)
+        self.job = job.encode('utf8')
+        self.window = max(1, window)
+        self.compress = compress
+        self.timeout = timeout
+        self.giveUp = giveUp
+        self.cond = threading.Condition()
+        self.sendLock = threading.Lock()            # Keeps the images going out in sequence
+        self.pending = collections.OrderedDict()    # Sequence number to (header, data, name)
+        self.seq = 0
+        self.sock = None
+        self.closing = False
+        self.failed = False
+        self.lost = []          # Names of the images the server never acknowledged
+        self.sentBytes = 0
+        self.resent = 0
+        self.reconnects = 0
+        self.connect()
+        self.reader = threading.Thread(target=self.readAcks)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall( struct.pack(helloFormat, b'TCST', streamVersion, len(self.job)) + self.job )
+            magic,last = struct.unpack( replyFormat, recvExactly(sock, struct.calcsize(replyFormat)) )
+            if magic != b'TCOK':
+                raise Exception('Not an ingest server at {}:{}'.format(*self.address))
+            # A server that stops responding without the connection being
+            # lost is noticed by sends and acknowledgements timing out
+            sock.settimeout(self.giveUp)
+            with self.cond:
+                # The server already has everything up to last
+                for seq in list(self.pending):
+                    if seq <= last:
+                        del self.pending[seq]
+                self.seq = max(self.seq, last)
+                resend = list(self.pending.values())
+            # Nothing new is sent until self.sock is set, so these go first
+            for header,data,name in resend:
+                sock.sendall(header)
+                sock.sendall(data)
+                self.resent += 1
+            with self.cond:
+                if self.failed:
+                    raise Exception('Gave up on the ingest server')
+                self.sock = sock
+                self.cond.notify_all()
+        except:
+            sock.close()
+            raise
+
+    def send(self, name, data):
+        # Queues an image for sending and returns its sequence number
+        data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1)
+        flags = 0
+        if self.compress:
+            data = np.frombuffer( zlib.compress(data.tostring(), 1), dtype=np.uint8 )
+            flags |= compressedFlag
+        encoded = name.encode('utf8')
+        with self.sendLock:
+            with self.cond:
+                while not self.failed and (self.sock is None or len(self.pending) >= self.window):
+                    self.cond.wait(1)
+                if self.failed:
+                    raise Exception('Not sent - lost the connection to the ingest server')
+                self.seq += 1
+                seq = self.seq
+                header = struct.pack(frameFormat, b'TCFR', seq, len(encoded), data.size, flags) + encoded
+                self.pending[seq] = (header, data, name)
+                sock = self.sock
+            # The socket is written without holding cond, so acknowledgements
+            # and flush aren't held up by a slow network
+            try:
+                sock.sendall(header)
+                sock.sendall(data)
+                self.sentBytes += data.size
+            except socket.error:
+                # Part of the image may have gone, so the connection is
+                # dropped. The reader makes it again and sends it again
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        return seq
+
+    def readAcks(self):
+        size = struct.calcsize(ackFormat)
+        while True:
+            with self.cond:
+                if self.failed or (self.closing and not self.pending):
+                    return
+                sock = self.sock
+            try:
+                magic,seq = struct.unpack( ackFormat, recvExactly(sock, size) )
+            except socket.timeout:
+                with self.cond:
+                    idle = not self.pending
+                if idle:
+                    # Nothing is owed
+                    continue
+                print('The ingest server has not acknowledged anything for {} secs'.format(self.giveUp))
+                self.reconnect(sock)
+                continue
+            except (socket.error, EOFError):
+                if self.failed or (self.closing and not self.pending):
+                    return
+                self.reconnect(sock)
+                continue
+            with self.cond:
+                for s in list(self.pending):
+                    if s > seq:
+                        break
+                    del self.pending[s]
+                self.cond.notify_all()
+
+    def reconnect(self, sock):
+        with self.cond:
+            self.sock = None
+        sock.close()
+        start = time.time()
+        while not self.failed:
+            try:
+                self.connect()
+                self.reconnects += 1
+                print('Connected to the ingest server again - {} images sent again'.format(len(self.pending)))
+                return
+            except Exception as e:
+                if time.time()-start >= self.giveUp:
+                    self.abandon('Could not connect to the ingest server at {}:{} for {} secs'.format(
+                            self.address[0], self.address[1], self.giveUp))
+                    return
+                print('Lost the connection to the ingest server at {}:{} - {}. Trying again'.format(self.address[0], self.address[1], e))
+                time.sleep(self.retryDelay)
+
+    def abandon(self, reason):
+        # Stops waiting for the server. The unacknowledged images are lost
+        with self.cond:
+            if self.failed:
+                return
+            self.failed = True
+            lost = [ name for header,data,name in self.pending.values() ]
+            self.lost.extend(lost)
+            self.pending.clear()
+            self.cond.notify_all()
+        print('{} - {} images were not acknowledged{}'.format(reason, len(lost), ': '+', '.join(lost) if lost else ''))
+
+    def flush(self):
+        # Waits until everything sent so far has been acknowledged, or
+        # the server is given up on
+        with self.cond:
+            seq = self.seq
+            while not self.failed and self.pending and next(iter(self.pending)) <= seq:
+                self.cond.wait(1)
+
+    def close(self):
+        # Waits up to giveUp seconds for everything sent to be acknowledged
+        deadline = time.time()+self.giveUp
+        with self.cond:
+            self.closing = True
+            while self.pending and not self.failed and time.time() < deadline:
+                print('Waiting for {} images to reach the ingest server'.format(len(self.pending)))
+                self.cond.wait( min(5, max(deadline-time.time(), 0)) )
+            waiting = bool(self.pending)
+            sock = self.sock
+        if waiting:
+            self.abandon('The ingest server did not acknowledge the images within {} secs'.format(self.giveUp))
+        if sock is not None:
+            # Wakes the reader, which is waiting for another acknowledgement
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.reader.join()
+        if sock is not None:
+            sock.close()
@@ -0,0 +1,241 @@
+# RPi Telecine - Synthetic film
+#
+# Renders images of a strip of 8mm film as the telecine camera would
+# see it, with the perforations at known positions. Used by the replay
+# camera so the telecine scripts can be run without a Pi.
+#
+# The geometry follows the film specifications used in perforation.py.
+# The default scale of 280 pixels per mm is close to the real telecine,
+# where a Super 8 frame crop is about 1800x1300 pixels, and gives a
+# perforation pitch of about 1200 pixels - 300 motor steps at the
+# default 4 pixels per step.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import numpy as np
+
+# Film dimensions in mm - perforation size, pitch and frame size
+filmDimensions = {
+    'super8': { 'perf':(0.91,1.14), 'pitch':4.23, 'frame':(5.46,4.01), 'perfY':0.5 },
+    'std8':   { 'perf':(1.8,1.23),  'pitch':3.81, 'frame':(4.5,3.3),   'perfY':-0.255/3.3 },
+    }
+# perfY is the perforation centre from the top of the frame as a fraction of
+# the frame height - Standard 8 perforations are in the middle of the frame line
+
+class filmStrip():
+    """
+    A synthetic strip of film.
+
+    render(travel) returns a BGR image of the strip after it has moved
+    travel pixels through the gate. Moving forwards moves the film up the
+    image. perforationCentres(travel) gives the true position of each
+    perforation in that image.
+
+    Super 8 perforations are level with the middle of the frame, Standard 8
+    perforations lie in the middle of the frame line - as telecinePerforation
+    expects.
+
+    Faults can be added to the strip. Each frame's faults are chosen from a
+    random generator seeded with the frame number, so a frame always looks
+    the same wherever it is in the gate:
+      weave     - maximum random sideways and up/down shift of each frame in pixels
+      damage    - chance of a frame having a torn or partly blocked perforation
+      dust      - number of dust specks per frame
+      exposure  - 'normal', 'over', 'under' or 'mixed' frame exposure. Over
+                  exposed frames are as bright as the perforations
+      splices   - chance of a frame having a splice across it
+    """
+
+    baseLevel = 30          # Brightness of film base around the frames
+    lightLevel = 250        # Brightness of light through the perforations
+    gateLevel = 10          # Brightness of the gate outside the film
+
+    exposureTypes = ('normal','over','under','mixed')
+
+    def __init__(self, filmType='super8', imageSize=(2592,1944), pixelsPerMm=280, perfX=300,
+                 weave=0, damage=0.0, dust=0, exposure='normal', splices=0.0, seed=0):
+        if filmType not in filmDimensions:
+            raise Exception("Error - '{}' is an incorrect film type.".format(filmType))
+        if exposure not in self.exposureTypes:
+            raise Exception("Error - '{}' is an incorrect exposure.".format(exposure))
+        self.filmType = filmType
+        self.imageSize = tuple(imageSize)
+        dims = filmDimensions[filmType]
+        self.perfSize = ( int(round(dims['perf'][0]*pixelsPerMm)), int(round(dims['perf'][1]*pixelsPerMm)) )
+        self.pitch = dims['pitch']*pixelsPerMm
+        self.frameSize = ( int(round(dims['frame'][0]*pixelsPerMm)), int(round(dims['frame'][1]*pixelsPerMm)) )
+        self.perfX = perfX
+        # Perforation centre when travel is 0 - in the middle of the
+        # super8 ROI, or in the top part of the image for std8
+        w,h = self.imageSize
+        self.perfY0 = h/2 if filmType == 'super8' else h/50 + h/4
+        self.framePerfY = dims['perfY']   # Perforation position as a fraction of the frame height
+        self.weave = weave
+        self.damage = damage
+        self.dust = dust
+        self.exposure = exposure
+        self.splices = splices
+        self.seed = seed
+
+    def faults(self, number):
+        # The faults of frame number - always the same for the same frame
+        rnd = np.random.RandomState( (self.seed*100003 + number) & 0x7fffffff )
+        f = {}
+        f['dx'], f['dy'] = rnd.uniform(-self.weave, self.weave, 2) if self.weave else (0.0,0.0)
+        f['damaged'] = rnd.rand() < self.damage
+        f['tear'] = rnd.randint(4)              # Which way the perforation is damaged
+        f['tearSize'] = rnd.uniform(0.15,0.4)
+        exposure = self.exposure
+        if exposure == 'mixed':
+            exposure = self.exposureTypes[rnd.randint(3)]
+        f['exposure'] = exposure
+        f['splice'] = rnd.rand() < self.splices
+        f['spliceY'] = rnd.uniform(0.1,0.9)
+        f['rnd'] = rnd
+        return f
+
+    def perforationCentres(self, travel):
+        # True (x,y) centre of each perforation that can be seen in the image
+        return [ (cx,cy) for number,cx,cy in self.perforations(travel) ]
+
+    def perforations(self, travel, margin=None):
+        # Frame number and (x,y) centre of each perforation that can be seen,
+        # or is within margin pixels of the image
+        w,h = self.imageSize
+        margin = self.perfSize[1] if margin is None else margin
+        first = self.perfY0 - travel
+        k0 = int(np.floor(-first/self.pitch)) - 2
+        perfs = []
+        for k in range(k0, k0 + int(h/self.pitch) + 5):
+            y = first + k*self.pitch
+            if -margin < y < h + margin:
+                f = self.faults(k)
+                perfs.append( (k, self.perfX+f['dx'], y+f['dy']) )
+        return perfs
+
+    def frameNumber(self, travel, cy):
+        # Number of the frame whose perforation is at cy
+        return int(round((cy - self.perfY0 + travel)/self.pitch))
+
+    def frameContent(self, number, img, top, left, exposure='normal'):
+        # Draws the picture for frame number into the frame area at top,left
+        fw,fh = self.frameSize
+        h,w = img.shape[:2]
+        y0,y1 = max(0,top), min(h,top+fh)
+        x0,x1 = max(0,left), min(w,left+fw)
+        if y0 >= y1 or x0 >= x1:
+            return
+        # A gradient that changes from frame to frame, with a bright
+        # block in a different position in each frame
+        ys = np.arange(y0,y1)[:,None] - top
+        xs = np.arange(x0,x1)[None,:] - left
+        level = 60 + (100*xs/fw) + (40*ys/fh) + (number*7)%40
+        if exposure == 'over':
+            level = np.minimum(255, level + 120)
+        elif exposure == 'under':
+            level = level * 0.3
+        img[y0:y1,x0:x1,1] = level.astype(np.uint8)
+        img[y0:y1,x0:x1,0] = (level*0.8).astype(np.uint8)
+        img[y0:y1,x0:x1,2] = (level*0.9).astype(np.uint8)
+        bx = left + int((number*0.37 % 1)*fw*0.7)
+        by = top + int((number*0.61 % 1)*fh*0.7)
+        img[max(y0,by):min(y1,by+fh//5), max(x0,bx):min(x1,bx+fw//5)] = 255 if exposure == 'over' else 200
+
+    def fillArea(self, img, x0, y0, x1, y1, level):
+        # Fills an area with edges at fractions of a pixel. Pixels the edges
+        # pass through are blended with what is there by how much they cover
+        h,w = img.shape[:2]
+        x0,y0 = max(0.0,x0), max(0.0,y0)
+        x1,y1 = min(float(w),x1), min(float(h),y1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        ix0,iy0 = int(np.floor(x0)), int(np.floor(y0))
+        ix1,iy1 = int(np.ceil(x1)), int(np.ceil(y1))
+        # Coverage of each row and column
+        cy = np.minimum(np.arange(iy0,iy1)+1, y1) - np.maximum(np.arange(iy0,iy1), y0)
+        cx = np.minimum(np.arange(ix0,ix1)+1, x1) - np.maximum(np.arange(ix0,ix1), x0)
+        cover = (cy[:,None]*cx[None,:])[:,:,None]
+        area = img[iy0:iy1,ix0:ix1]
+        area[:] = (level*cover + area*(1-cover) + 0.5).astype(np.uint8)
+
+    def damagePerforation(self, img, f, x0, y0, pw, ph):
+        # Torn edge or something partly blocking the perforation
+        tear = f['tear']
+        size = f['tearSize']
+        if tear == 0:
+            # Torn towards the frame - the hole extends right
+            self.fillArea( img, x0+pw, y0+int(ph*0.3), x0+pw+int(pw*size), y0+int(ph*0.7), self.lightLevel )
+        elif tear == 1:
+            # Torn top edge
+            self.fillArea( img, x0+int(pw*0.2), y0-int(ph*size), x0+int(pw*0.8), y0, self.lightLevel )
+        elif tear == 2:
+            # Dirt blocking part of the hole
+            self.fillArea( img, x0, y0+int(ph*0.4), x0+int(pw*0.6), y0+int(ph*(0.4+size/2)), self.baseLevel )
+        else:
+            # Torn bottom edge
+            self.fillArea( img, x0+int(pw*0.2), y0+ph, x0+int(pw*0.8), y0+ph+int(ph*size), self.lightLevel )
+
+    def render(self, travel):
+        w,h = self.imageSize
+        img = np.empty( (h,w,3), dtype=np.uint8 )
+        img[:] = self.gateLevel
+        pw,ph = self.perfSize
+        fw,fh = self.frameSize
+        # Film base - from the left of the perforations to the far side of the frames
+        filmL = max(0, self.perfX - pw)
+        filmR = min(w, self.perfX + pw + fw + pw//2)
+        img[:,filmL:filmR] = self.baseLevel
+        # Frames whose perforation is out of sight can still be seen
+        for number,fx,fy in self.perforations(travel, self.pitch):
+            f = self.faults(number)
+            cx,cy = int(round(fx)), int(round(fy))
+            if f['exposure'] == 'over':
+                # Clear or thin film base lets nearly as much light
+                # through as the perforation
+                band = int(round(self.pitch/2))
+                img[ max(0,cy-band):max(0,cy+band), filmL:filmR ] = self.lightLevel - 15
+            # Frame picture to the right of the perforation
+            top = int(round(cy - self.framePerfY*fh))
+            self.frameContent( number, img, top, self.perfX + int(round(f['dx'])) + pw//2 + pw//4, f['exposure'] )
+            self.fillArea( img, fx-pw/2, fy-ph/2, fx+pw/2, fy+ph/2, self.lightLevel )
+            x0,y0 = cx-pw//2, cy-ph//2
+            if f['damaged']:
+                self.damagePerforation( img, f, x0, y0, pw, ph )
+            if f['splice']:
+                # Splice tape - a bright line across the whole film
+                sy = int(round(cy - self.pitch/2 + f['spliceY']*self.pitch))
+                img[ max(0,sy):max(0,sy+6), filmL:filmR ] = 220
+            rnd = f['rnd']
+            for n in range(self.dust):
+                # Dark specks anywhere in the frame, including the perforation
+                dx,dy = rnd.randint(-pw, pw+fw), rnd.randint(-int(self.pitch/2), int(self.pitch/2))
+                r = rnd.randint(2,12)
+                sx,sy = cx+dx, cy+dy
+                img[ max(0,sy-r):max(0,sy+r), max(0,sx-r):max(0,sx+r) ] = rnd.randint(0,40)
+        return img
@@ -0,0 +1,125 @@
+# RPi Telecine - Per frame timing trace
+#
+# A record for each frame of a job, written as a line of JSON, so the
+# time a long job takes can be broken down afterwards - see tc-trace.py.
+#
+# The frame's record is started in the capture loop and the stages add
+# their times to it. The images of the frame are written later by the
+# writers, so the record is only written out once every image queued for
+# it has been written. Lines are written in batches to keep the cost to
+# the capture loop small.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+import collections
+import json
+import threading
+import time
+
+class frameTrace():
+    """
+    Collects a record for each frame and appends them to a JSON lines file.
+
+    frame(n, ...) starts the record of frame n, update(n, ...) adds fields,
+    queued(n, filename) says an image of the frame has been queued, and
+    written(filename, ...) is called by the writer once it is written.
+    done(n) says nothing more is coming from the capture loop - the record
+    goes out when both it is done and all its images are written.
+    """
+
+    def __init__(self, path, batch=50):
+        self.file = open(path, 'ab')
+        # The file is appended to, so each record says which run it is from
+        self.run = int(time.time())
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.records = collections.OrderedDict()    # Frame number to record
+        self.files = {}                             # Queued filename to frame number
+        self.lines = []
+
+    def frame(self, n, **fields):
+        record = { 'run':self.run, 'frame':n, 'images':0, 'written':0, 'encode':0.0, 'queue_wait':0.0,
+                   'bytes':0, 'write_failed':0, 'levels':[] }
+        record.update(fields)
+        with self.lock:
+            self.records[n] = [record, False]
+
+    def update(self, n, **fields):
+        with self.lock:
+            self.records[n][0].update(fields)
+
+    def queued(self, n, fn):
+        with self.lock:
+            self.files[fn] = n
+            self.records[n][0]['images'] += 1
+
+    def written(self, fn, secs, wait, size, ok, level=None):
+        with self.lock:
+            n = self.files.pop(fn, None)
+            if n not in self.records:
+                return
+            record = self.records[n][0]
+            record['written'] += 1
+            record['encode'] += secs
+            record['queue_wait'] = max(record['queue_wait'], wait)
+            record['bytes'] += size
+            record['write_failed'] += 0 if ok else 1
+            if level is not None:
+                record['levels'].append(level)
+            self._finish(n)
+
+    def done(self, n):
+        with self.lock:
+            self.records[n][1] = True
+            self._finish(n)
+
+    def _finish(self, n):
+        # Writes the record out once it is complete
+        record,done = self.records[n]
+        if done and record['written'] >= record['images']:
+            del self.records[n]
+            self.lines.append( json.dumps(record, sort_keys=True) )
+            if len(self.lines) >= self.batch:
+                self._flush()
+
+    def _flush(self):
+        if self.lines:
+            self.file.write( '\n'.join(self.lines) + '\n' )
+            self.lines = []
+        self.file.flush()
+
+    def close(self):
+        # Writes out everything left, including records still waiting for images
+        with self.lock:
+            for record,done in self.records.values():
+                record['incomplete'] = True
+                self.lines.append( json.dumps(record, sort_keys=True) )
+            self.records.clear()
+            self._flush()
+            self.file.close()
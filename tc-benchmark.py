@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#
+# RPi Telecine - Perforation detection benchmark
+#
+# Usage: python tc-benchmark.py [-f super8|std8] [-n frames] [-s scenario [scenario...]]
+#                               [-r reduction [reduction...]] [-e chain [chain...]] [-t] [-a]
+#
+# Renders synthetic strips of film with known perforation positions (see
+# rpiTelecine/synthetic.py) and runs the perforation detection over them.
+# For each scenario it reports how often the perforation was found, the
+# time taken by the first detection and find() as percentiles, and the
+# error in pixels between the detected and true perforation centres.
+#
+# Scenarios:
+# clean		No faults
+# weave		Frames shifted sideways and up/down by up to 20 pixels
+# damaged	Half the perforations torn or partly blocked
+# dust		Dust specks on every frame
+# over		Over exposed frames with clear film base nearly as bright as the perforation
+# under		Under exposed frames
+# splices	Half the frames with a splice
+# mixed		All of the above at once
+#
+# The transport is simulated by moving the strip on one perforation pitch
+# per frame, with a random error of up to 12% of the pitch.
+# Image rendering is not included in the times. Runs on any Linux box
+# with Numpy and OpenCV - no Pi needed.
+#
+# Each scenario is run once for each of the detection engine chains given
+# with -e and the reductions given with -r, so they can be compared for
+# speed and accuracy on the same frames. A chain is a comma separated list
+# of engines tried in turn, as perf_engines in the job ini file, e.g.
+# -e threshold,segments template. The reduction only affects the threshold
+# and segments engines.
+#
+# With -t the perforation tracking is turned on. The detection is told how
+# far the film was moved before each frame, with an error of up to 2% of
+# the pitch as the motor steps would give.
+#
+# With -a the first detection is done with findFirst() - a coarse search of
+# the whole image followed by findFirstFromCoords() - instead of a click.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+
+import argparse
+import collections
+import os
+import sys
+import time
+import numpy as np
+
+import rpiTelecine
+from rpiTelecine.synthetic import filmStrip
+
+scenarios = collections.OrderedDict( [
+    ('clean',   {}),
+    ('weave',   {'weave':20}),
+    ('damaged', {'damage':0.5}),
+    ('dust',    {'dust':40}),
+    ('over',    {'exposure':'over'}),
+    ('under',   {'exposure':'under'}),
+    ('splices', {'splices':0.5}),
+    ('mixed',   {'weave':20, 'damage':0.2, 'dust':20, 'exposure':'mixed', 'splices':0.2}),
+    ] )
+
+transport_error = 0.12	# Maximum transport error as a fraction of the pitch
+step_error = 0.02	# Maximum error of the movement given to the tracking
+
+class quiet():
+    # Hides the detection's progress messages
+    def __enter__(self):
+	self.stdout = sys.stdout
+	sys.stdout = open(os.devnull,'w')
+    def __exit__(self, *args):
+	sys.stdout.close()
+	sys.stdout = self.stdout
+
+def percentiles(values, ps=(50,90,99)):
+    if not values:
+	return [float('nan')]*(len(ps)+1)
+    return list(np.percentile(values, ps)) + [max(values)]
+
+def nearest_perforation(strip, travel, y):
+    # True centre of the perforation nearest to y
+    return min( strip.perforationCentres(travel), key=lambda c: abs(c[1]-y) )
+
+def make_detector(args, strip):
+    # Sets up the perforation detection the same way as tc-run.py
+    pf = rpiTelecine.telecinePerforation()
+    pf.setFilmType(strip.filmType)
+    pf.setReduction(args.reduction)
+    pf.setEngines(args.engine.split(','))
+    return pf
+
+def bench_first(args, strip, rnd):
+    # Cold start detection from a click inside the perforation
+    times, errors, found = [], [], 0
+    for n in range(args.first):
+	travel = (rnd.randint(1000) + rnd.uniform(-transport_error, transport_error))*strip.pitch
+	img = strip.render(travel)
+	cx,cy = nearest_perforation(strip, travel, strip.perfY0)
+	pw,ph = strip.perfSize
+	click = ( int(cx + rnd.uniform(-pw/6,pw/6)), int(cy + rnd.uniform(-ph/6,ph/6)) )
+	pf = make_detector(args, strip)
+	with quiet():
+	    t = time.time()
+	    if args.auto:
+		pf.findFirst(img)
+	    else:
+		pf.findFirstFromCoords(img, click, 20)
+	    times.append( time.time()-t )
+	if pf.found:
+	    # Any perforation will do when there's no click
+	    cx,cy = nearest_perforation(strip, travel, pf.exactCentre[1])
+	    found += 1
+	    errors.append( abs(pf.exactCentre[1]-cy) )
+    return times, errors, found
+
+def bench_find(args, strip, rnd):
+    # Detection of each frame as the film is moved on
+    pf = make_detector(args, strip)
+    clean = filmStrip(strip.filmType)
+    cx,cy = nearest_perforation(clean, 0, clean.perfY0)
+    with quiet():
+	pf.findFirstFromCoords(clean.render(0), (int(cx),int(cy)), 20)
+    if not pf.found:
+	raise Exception('Could not initialise perforation detection')
+    pf.checkLeftEdge = args.left_edge
+    pf.tracking = args.tracking
+    times, errors, xerrors, found, gross = [], [], [], 0, 0
+    last_travel = 0
+    for n in range(args.frames):
+	travel = (n + rnd.uniform(-transport_error, transport_error))*strip.pitch
+	pf.moved( travel - last_travel + rnd.uniform(-step_error, step_error)*strip.pitch )
+	last_travel = travel
+	img = strip.render(travel)
+	cx,cy = nearest_perforation(strip, travel, pf.ROIcentrexy[1])
+	with quiet():
+	    t = time.time()
+	    pf.find(img)
+	    times.append( time.time()-t )
+	if pf.found:
+	    found += 1
+	    error = abs(pf.exactCentre[1]-cy)
+	    errors.append( error )
+	    xerrors.append( abs(pf.exactCentre[0]-cx) )
+	    if error > strip.perfSize[1]/4:
+		gross += 1
+    return times, errors, xerrors, found, gross
+
+def reduces(chain):
+    # If the reduction makes a difference to the chain of engines
+    return 'threshold' in chain.split(',') or 'segments' in chain.split(',')
+
+def detectors(args):
+    # Engine chain and reduction pairs to compare
+    pairs = []
+    for engine in args.engines:
+	for reduction in args.reductions if reduces(engine) else args.reductions[:1]:
+	    pairs.append( (engine,reduction) )
+    return pairs
+
+def engine_chain(value):
+    # Checks a comma separated chain of engines given with -e
+    for name in value.split(','):
+	if name not in rpiTelecine.engineTypes:
+	    raise argparse.ArgumentTypeError("unknown engine '{}' - choose from {}".format(name, ', '.join(rpiTelecine.engineTypes)))
+    return value
+
+def run(args):
+    print('Film type: {}  frames: {}  first detections: {}{}'.format(args.film, args.frames, args.first, ' (no click)' if args.auto else ''))
+    print('Times in ms, errors in pixels. p50/p90/p99/max')
+    print('{:<36} {:>6} {:>27} {:>27} {:>17} {:>6} {:>6} {:>23}'.format( 'scenario', 'found',
+	    'find() time', 'first detection time', 'y error mean/p95', 'max', 'gross', 'x error mean/p95/max' ))
+    for name in args.scenarios:
+	strip = filmStrip(args.film, seed=args.seed, **scenarios[name])
+	for engine,reduction in detectors(args):
+	    # Same transport errors and clicks for each engine and reduction
+	    rnd = np.random.RandomState(args.seed)
+	    args.engine = engine
+	    args.reduction = reduction
+	    times, errors, xerrors, found, gross = bench_find(args, strip, rnd)
+	    ftimes, ferrors, ffound = bench_first(args, strip, rnd)
+	    t = [ v*1000 for v in percentiles(times) ]
+	    ft = [ v*1000 for v in percentiles(ftimes) ]
+	    e = errors or [float('nan')]
+	    xe = xerrors or [float('nan')]
+	    print('{:<36} {:>5.1f}% {:>6.1f}/{:>6.1f}/{:>6.1f}/{:>6.1f} {:>6.1f}/{:>6.1f}/{:>6.1f}/{:>6.1f} {:>8.2f}/{:>8.2f} {:>6.1f} {:>6d} {:>7.2f}/{:>7.2f}/{:>7.1f}'.format(
+		'{} {}'.format(name, engine + (' '+reduction if len(args.reductions) > 1 and reduces(engine) else '')), 100*found/args.frames, t[0],t[1],t[2],t[3], ft[0],ft[1],ft[2],ft[3],
+		np.mean(e), np.percentile(e,95), max(e), gross,
+		np.mean(xe), np.percentile(xe,95), max(xe) ))
+	    if ffound < args.first:
+		print('                                     findFirstFromCoords failed {} of {}'.format(args.first-ffound, args.first))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the perforation detection on synthetic film')
+    parser.add_argument('-f','--film', default='super8', choices=rpiTelecine.filmTypes, help='Film type')
+    parser.add_argument('-n','--frames', type=int, default=200, help='Frames per scenario')
+    parser.add_argument('--first', type=int, default=20, help='findFirstFromCoords runs per scenario')
+    parser.add_argument('-s','--scenarios', nargs='+', default=list(scenarios.keys()), choices=list(scenarios.keys()), help='Scenarios to run')
+    parser.add_argument('-r','--reductions', nargs='+', default=['median'], choices=rpiTelecine.reductionTypes, help='Reductions to compare')
+    parser.add_argument('-e','--engines', nargs='+', type=engine_chain, default=[','.join(rpiTelecine.defaultEngines)], help='Detection engine chains to compare')
+    parser.add_argument('-a','--auto', action='store_true', help='First detection without a click')
+    parser.add_argument('-t','--tracking', action='store_true', help='Turn on perforation tracking')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--no-left-edge', dest='left_edge', action='store_false', help="Don't find the left edge")
+    args = parser.parse_args()
+    run(args)
@@ -10,6 +10,7 @@
 # -j, --jpeg    	Save jpegs instead of PNG
 # -r, --reverse		Run transport backwards
 # -b, --brackets        Bracket exposure
+# -m, --mode		Capture mode (still, continuous, raw, yuv) - overrides the job setting
 #
 # Writing the images is done in a concurrent thread to the picture taking and
 # film transport. 
@@ -48,14 +49,18 @@
 from __future__ import division
 
 import argparse
+import collections
 import os
 import time
 import threading
 import Queue
+import csv
 import cv2
 import numpy as np
 
 from tc_common import *
+from rpiTelecine.encoder import processEncoder
+from rpiTelecine.frames import rawBayerFrame
 
 job_name = ''
 start_frame = 0
@@ -64,12 +69,20 @@ frames_count = 0
 current_frame = 0
 capture_direction = 1
 capture_ext = 'png'
-fileSaveParams = []
+capture_mode = None
+trace_job = False
+trace = None	# frameTrace when the job is run with --trace
+resume_job = False
+journal = None	# jobJournal of the frames written
+rewind = []	# Moves to undo to get back to the frame a resumed job starts at
+raw_file = None
+metrics = None	# jobMetrics when metrics_port is set
 
 def parse_commandline():
     # Command line arguments
     global job_name, start_frame, end_frame, frames_count
     global current_frame, capture_direction, capture_ext, reverse, brackets
+    global capture_mode, trace_job, resume_job
     parser = argparse.ArgumentParser()
     parser.add_argument('jobname', help='Name of the telecine job')
     parser.add_argument('-s','--start', type=int, help='Start frame number')
@@ -77,6 +90,9 @@ def parse_commandline():
     parser.add_argument('-j','--jpeg', help='Save Jpeg images',	action='store_true')
     parser.add_argument('-r','--reverse', help='Run backwards', action='store_true')
     parser.add_argument('-b','--brackets', help='Bracket exposures', action='store_true')
+    parser.add_argument('-m','--mode', help='Capture mode', choices=cnf.capture_mode_values)
+    parser.add_argument('-t','--trace', help='Write a timing trace of each frame to trace.jsonl in the job folder', action='store_true')
+    parser.add_argument('--resume', help='Carry on from the first frame the journal says is not written', action='store_true')
 
     args = parser.parse_args()
     
@@ -93,11 +109,13 @@ def parse_commandline():
     if args.jpeg:
 	print('Saving as jpeg')
 	capture_ext = 'jpg'
-	fileSaveParams = [int(cv2.IMWRITE_JPEG_QUALITY), 95]
     brackets = args.brackets
     if args.brackets:
 	print('Bracketing on')
+    capture_mode = args.mode
     reverse = args.reverse
+    trace_job = args.trace
+    resume_job = args.resume
     if args.reverse:
 	print('Reverse capture')
 
@@ -108,51 +126,362 @@ def make_crop():
     crop_y = cy+cnf.crop_offset[1]
     return pf.cropToSlice( (crop_x, crop_y, cnf.crop_size[0],cnf.crop_size[1]) )
 
-q = Queue.Queue(10)
-job_finished = False
-still_writing = True
+q = Queue.Queue()	# Images to write - bounded by the size of ring
+ring = None		# Memory the images waiting to be written are copied into
+writers = []		# Writer threads
+write_stats = []	# (writer, seconds writing, seconds queued, bytes, encode level) of each image
+encoder = None		# Worker processes when writer_processes is set
+effort = None		# Chooses the encode settings of each image
+image_levels = {}	# Encode level of each image queued for the worker processes
+store = None		# frameStore when output_format is store
+streamer = None		# frameStreamer when output_format is stream
 
-def writer():
-    # Writer is run in a separate thread, so that writing is concurrent
-    # to taking the pictures.
-    global q, job_finished, still_writing
+def writer(n):
+    # Writers are run in separate threads, so that writing is concurrent
+    # to taking the pictures. Each waits on the queue until it is given
+    # None. OpenCV releases the GIL while encoding, so several writers
+    # can encode at once
     write_time = Stopwatch()
-    #writeParams = (int(cv2.IMWRITE_PNG_COMPRESSION),7)
-    while not job_finished:
-	still_writing = True
-	while not q.empty():
-	    write_time.start()
-            fn,img = q.get()
-	    try:
-                cv2.imwrite(fn,img, fileSaveParams)
-                t=write_time.stop()
-                print('Written {} in {:.02f} secs'.format(fn,t))
-	    except:
-		t=write_time.stop()
-		print('Failed to write {} in {:.02f} secs'.format(fn,t))
-    # Finished all jobs and queue is empty
-    still_writing = False
+    while True:
+	item = q.get()
+	if item is None:
+	    break
+	fn,img,block,raw,info,queued = item
+	wait = time.time()-queued
+	# When the images are arriving faster than they are written, less
+	# effort is put into encoding rather than making the capture wait for room
+	level = None if raw else effort.choose(ring.fill())
+	write_time.start()
+	try:
+	    # size is the bytes written, after encoding
+	    if store is not None or streamer is not None:
+		data = img
+		if not raw:
+		    ok,data = cv2.imencode('.'+capture_ext, img, effort.params(level))
+		    if not ok:
+			raise Exception('Cannot encode {}'.format(fn))
+		if store is not None:
+		    store.append(data, *info)
+		else:
+		    # Waits while the server is behind, which holds the
+		    # image in the write buffer
+		    streamer.send(os.path.basename(fn), data)
+		size = data.nbytes
+	    elif raw:
+		# Raw frames are written unaltered
+		with open(fn,'wb') as f:
+		    f.write(img.tostring())
+		size = img.nbytes
+	    else:
+		cv2.imwrite(fn,img, effort.params(level))
+		size = os.path.getsize(fn)
+	    t=write_time.stop()
+	    print('Written {} in {:.02f} secs{}'.format(fn,t,' ({})'.format(effort.name(level)) if level else ''))
+	except:
+	    t=write_time.stop()
+	    size = 0
+	    print('Failed to write {} in {:.02f} secs'.format(fn,t))
+	ring.release(block)
+	image_written(n,fn,t,wait,size,size > 0,level)
+
+def image_written(n,fn,t,wait,size,ok,level=None):
+    # Records an image the writers have finished with
+    # list.append is atomic, so the writers can share the list
+    write_stats.append( (n,t,wait,size if ok else 0,level) )
+    name = None
+    if level is not None:
+	name = effort.name(level)
+	if ok:
+	    effort.written(level,t)
+    if trace is not None:
+	trace.written(fn,t,wait,size if ok else 0,ok,name)
+    if metrics is not None:
+	metrics.imageWritten(t,size if ok else 0,ok,level)
+    if journal is not None:
+	journal.written(fn,ok)
+
+def queue_image(fn,img,info=None):
+    # Hands a copy of an image to the writers - waits if there's no room
+    # info is (frame, bracket, failed, perforation centre, time taken) for the store
+    raw = not isinstance(img,np.ndarray)
+    if raw:
+	img = img.data
+    if encoder is not None:
+	if raw:
+	    encoder.put(fn,img,None)
+	else:
+	    # The workers can't see the queue, so the level is chosen here
+	    level = effort.choose( queue_depth()/len(encoder.slots) )
+	    image_levels[fn] = level
+	    encoder.put(fn,img,effort.params(level))
+	    effort.arrived(encoder.slotWaits[-1])
+	return
+    block,img = ring.put(img)
+    if not raw:
+	effort.arrived(ring.waits[-1])
+    q.put( (fn,img,block,raw,info,time.time()) )
+
+def start_writers(count, processes=0):
+    global encoder, ring, effort, store, streamer
+    levels = rpiTelecine.encodeLevels(capture_ext, cnf.png_compression, cnf.jpeg_quality, cnf.jpeg_quality_floor)
+    effort = rpiTelecine.effortController(levels, processes or count)
+    print('Encode levels: {}'.format(', '.join(name for name,params in levels)))
+    # Room for at least a full frame or a raw capture
+    w,h = cam.MAX_IMAGE_RESOLUTION
+    largest = max(w*h*3, rawBayerFrame.rawSize)
+    if cnf.output_format == 'store':
+	store = rpiTelecine.frameStore(fpath, capture_ext, cnf.store_chunk_size*1000000)
+	print('Writing frames to the frame store in {}'.format(fpath))
+	if processes:
+	    print('The frame store is written by the writer threads - writer_processes not used')
+	    processes = 0
+    elif cnf.output_format == 'stream':
+	# Stops here if the server can't be reached, before anything is captured
+	try:
+	    streamer = rpiTelecine.frameStreamer(cnf.stream_host, cnf.stream_port, job_name,
+				cnf.stream_window, cnf.stream_compress, giveUp=cnf.stream_timeout)
+	except Exception as e:
+	    print('Cannot connect to the ingest server at {}:{} - {}'.format(cnf.stream_host, cnf.stream_port, e))
+	    quit()
+	print('Streaming frames to {}:{}{}'.format(cnf.stream_host, cnf.stream_port,
+				' compressed' if cnf.stream_compress else ''))
+	if processes:
+	    print('Frames are streamed by the writer threads - writer_processes not used')
+	    processes = 0
+    if processes:
+	encoder = processEncoder(processes, largest)
+	encoder.start()
+	print('Encoding in {} processes with {} slots'.format(processes,len(encoder.slots)))
+	return
+    ring = rpiTelecine.frameRing( max(cnf.write_buffer*1000000, largest) )
+    for n in range(count):
+	t = threading.Thread(target=writer, args=(n,))
+	t.start()
+	writers.append(t)
+
+def queue_depth():
+    # Images queued but not yet written
+    if encoder is not None:
+	return len(encoder.slotWaits) - len(encoder.written)
+    return q.qsize()
+
+def encoder_written(results):
+    # Records the images the worker processes have written
+    for n,fn,ok,t,wait,size in results:
+	image_written(n,fn,t,wait,size,ok,image_levels.pop(fn,None))
+
+def stop_writers():
+    # Each writer stops when it gets None, after the images queued before it
+    if encoder is not None:
+	done = len(encoder.written)
+	encoder_written( encoder.close()[done:] )
+	return
+    for t in writers:
+	q.put(None)
+    for t in writers:
+	t.join()
+    if store is not None:
+	store.close()
+    if streamer is not None:
+	streamer.close()
+	print('Streamed {:.1f} MB, {} images sent again after {} reconnections'.format(
+		streamer.sentBytes/1e6, streamer.resent, streamer.reconnects))
+	if streamer.lost:
+	    print('{} images did not reach the ingest server - their frames are captured again with --resume'.format(
+		    len(streamer.lost)))
+
+def writer_stats(elapsed):
+    # Encode throughput of each writer, the time images waited in the queue
+    # and the time taking pictures waited for room to put them
+    if not write_stats:
+	return
+    for n in range(encoder.workers if encoder is not None else len(writers)):
+	times = [ t for w,t,wait,size,level in write_stats if w == n ]
+	if times:
+	    print('Writer {}: {} images, {:.2f} secs each, {:.1f} images/sec while busy'.format(
+		    n, len(times), sum(times)/len(times), len(times)/max(sum(times),1e-6) ))
+    waits = [ wait for w,t,wait,size,level in write_stats ]
+    written = sum( size for w,t,wait,size,level in write_stats )
+    print('Written {} images - {:.2f} images/sec, {:.1f} MB/sec written'.format(
+	    len(write_stats), len(write_stats)/elapsed, written/elapsed/1e6 ))
+    print('Queue wait: average {:.2f} secs, longest {:.2f} secs'.format( sum(waits)/len(waits), max(waits) ))
+    if encoder is not None:
+	slots = encoder.slotWaits
+	print('Waiting for a free slot: {:.2f} secs in total, longest {:.2f} secs'.format( sum(slots), max(slots) ))
+    else:
+	blocked = ring.waits
+	print('Waiting for room in the write buffer: {:.2f} secs in total, longest {:.2f} secs'.format( sum(blocked), max(blocked) ))
+	print('Write buffer: {:.0f} MB, at most {:.0f} MB used'.format( ring.buffer.size/1e6, ring.peak/1e6 ))
+    levels = collections.Counter( level for w,t,wait,size,level in write_stats if level is not None )
+    if levels:
+	print('Images at each encode level: {}'.format(', '.join( '{} {}'.format(effort.name(level),levels[level])
+		for level in sorted(levels) )))
+
+def sync_written():
+    # Makes sure the images written so far will survive a crash before the
+    # journal says they are written. Returns the images that didn't make it
+    if raw_file is not None and not raw_file.closed:
+	raw_file.flush()
+    rpiTelecine.syncFiles()
+    if streamer is not None:
+	streamer.flush()
+	return [ os.path.join(fpath,name) for name in streamer.lost ]
+
+def start_journal():
+    global journal
+    journal = rpiTelecine.jobJournal( os.path.join(fpath,'journal.jsonl'), cnf.journal_batch, syncWritten=sync_written )
+    journal.started(start_frame, end_frame, not reverse)
+
+def resume_point():
+    # Moves the start of the job on past the frames already written
+    global start_frame, frames_count, rewind
+    frame,rewind,done = rpiTelecine.resumePoint( os.path.join(fpath,'journal.jsonl'), start_frame, end_frame )
+    if frame is None:
+	print('All {} frames are already written'.format(frames_count))
+	quit()
+    print('Resuming at frame {} - {} frames already written'.format(frame,done))
+    start_frame = frame
+    frames_count = abs(end_frame - start_frame)+1
+
+def rewind_transport():
+    # Undoes the moves made since the frame the job resumes at, or moves
+    # on to it if the film stopped short. The frame is centred
+    # afterwards, which takes up any difference
+    if not rewind:
+	return
+    total = 0	# Steps forward the film has been moved since
+    for steps,forward in rewind:
+	if forward is None:
+	    # Not recorded - the move this job would have made
+	    forward = not reverse
+	if steps is None:
+	    steps = cnf.ave_steps_fd if forward else cnf.ave_steps_bk
+	total += steps if forward else -steps
+    print('Moving {} {} steps to frame {}'.format('back' if total > 0 else 'on',abs(total),start_frame))
+    if total > 0:
+	tc.steps_back(total)
+    elif total < 0:
+	tc.steps_forward(-total)
+
+def start_metrics(port, address):
+    # Serves live metrics of the job from a background thread, if a port is set
+    global metrics
+    if not port:
+	return None
+    metrics = rpiTelecine.jobMetrics(queue_depth, fpath)
+    try:
+	server = rpiTelecine.metricsServer(metrics.registry, port, address)
+    except Exception as e:
+	print('Cannot serve metrics on {}:{} - {}'.format(address,port,e))
+	metrics = None
+	return None
+    server.start()
+    print('Metrics at http://{}:{}/metrics'.format(address or 'localhost',port))
+    return server
+
+def sensor_crop():
+    # The part of the sensor needed for the job - the union of the perforation
+    # ROI and the film crop, with a margin for weave. (x,y,w,h) in the full image
+    rows,cols = pf.ROIslice
+    cx,cy = pf.centre
+    crop_x = cx+cnf.crop_offset[0]
+    crop_y = cy+cnf.crop_offset[1]
+    m = cnf.sensor_crop_margin
+    x0 = min(cols.start, crop_x) - m
+    y0 = min(rows.start, crop_y) - m
+    x1 = max(cols.stop, crop_x+cnf.crop_size[0]) + m
+    y1 = max(rows.stop, crop_y+cnf.crop_size[1]) + m
+    return ( x0, y0, x1-x0, y1-y0 )
+
+def start_sensor_crop():
+    # Crop on the sensor now the perforation has been found, so less data
+    # is read, converted and transferred for each frame.
+    # A picture is taken to check the perforation is where it should be in
+    # the cropped image. This also checks which way up the camera applies
+    # the crop when the image is flipped. If it can't be found, the full
+    # image is used.
+    crop = sensor_crop()
+    cx,cy = pf.centre
+    for mirror in (True,False):
+	used = cam.set_sensor_crop(crop,mirror)
+	pf.setImageCrop(used)
+	pf.find(detection_image(take_picture()))
+	if pf.found and abs(pf.centre[0]+used[0]-cx) < pf.expectedSize[0]/2 \
+		    and abs(pf.centre[1]+used[1]-cy) < pf.expectedSize[1]/2:
+	    print('Sensor crop: {}:{} {}x{}'.format(*used))
+	    return
+    print('Perforation not found in sensor crop - using full image')
+    cam.set_sensor_crop(None)
+    pf.setImageCrop(None)
+    pf.found = False
 
 failed_frames = 0
 
 taking_time = Stopwatch()
 taking_times = []
 
+frames = None	# Image generator when using continuous capture
+
+def take_picture():
+    # Take a single picture in the capture mode of the job
+    if frames is not None:
+	return next(frames)
+    if capture_mode == 'yuv':
+	return cam.take_yuv_picture()
+    return cam.take_picture()
+
+def detection_image(img):
+    # Image to find the perforation in - yuv captures use the luma plane
+    # directly, others are converted to grey if the job is in grayscale
+    if capture_mode == 'yuv':
+	return img.luma()
+    if cnf.show_gray:
+	img = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+    return img
+
+def full_image(img):
+    # Whole image to write out when perforation detection fails
+    if capture_mode == 'yuv':
+	return img.luma().copy() if cnf.show_gray else img.bgr()
+    return img
+
+def crop_image(img, crop):
+    # Crop the frame from the image - yuv captures are only converted to 
+    # BGR in the cropped area. Others are a view of the captured image, which
+    # queue_image copies before the capture buffer is reused
+    if capture_mode == 'yuv':
+	return img.crop(crop, gray=cnf.show_gray)
+    return img[crop]
+
+# Seconds each frame spent in each stage of the pipeline
+stage_times = collections.OrderedDict( [ ('capture',taking_times), ('detect',[]), ('crop',[]),
+					 ('transport',[]), ('transport wait',[]) ] )
+detect_time = Stopwatch()
+
+def find_perforation(img):
+    detect_time.start()
+    pf.find(img)
+    stage_times['detect'].append( detect_time.stop() )
+
 def single_picture(current_frame):
-    # Takes one picture and sends it to the writer
+    # Takes one picture and finds the perforation. Returns the images to
+    # write as (filename, function making the image, bracket, failed) - they are
+    # cropped and queued while the film is being moved on
     global cnf, capture_ext,fpath,failed_frames
     global taking_time, taking_times
     fname = 'img-{:05d}.{}'.format(current_frame,capture_ext)
     taking_time.start()
-    img = cam.take_picture()
+    img = take_picture()
     t = taking_time.stop()
     taking_times.append(t)
     print('Taken {} in {:.2f} secs'.format(current_frame,t))
-    if cnf.show_gray:
-	img = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+    gray = detection_image(img)
+    if cnf.show_gray and capture_mode != 'yuv':
+	img = gray
     #print('Img Shape: {}'.format(img.shape))
-    pf.find(img)
+    find_perforation(gray)
     found = pf.found
+    writes = []
     if not found:
 	# Not found a perforation - but save full frame anyway
 	# So we can manually crop it later - if we have a previous
@@ -163,7 +492,7 @@ def single_picture(current_frame):
 	failed_frames += 1
 	failedname = 'failed-' + fname
 	failedname = os.path.join( fpath, failedname )
-	q.put( (failedname,img) )
+	writes.append( (failedname, lambda: full_image(img), 0, True) )
 	if pf.position != (0,0):
 	    # Use last successful crop as a basis 
 	    found = True
@@ -171,39 +500,67 @@ def single_picture(current_frame):
 	# Reset fail count if we found the perforation
 	failed_frames = 0
     if found:
-	img = img[make_crop()]
-	fname = os.path.join(fpath,fname)
-	q.put( (fname,img) )
+	crop = make_crop()
+	writes.append( (os.path.join(fpath,fname), lambda: crop_image(img,crop), 0, False) )
+    return writes
     
+raw_log = None	# csv writer for the metadata of raw frames
+bracket_ref = 0	# Index of the bracket exposure used to find the perforation
+
+def raw_picture(current_frame):
+    # Takes a raw Bayer picture and returns it to be written
+    # The whole frame is written - the perforation position and crop
+    # are logged so the frame can be developed and cropped on the host
+    global cnf, capture_ext,fpath,failed_frames
+    global taking_time, taking_times
+    fname = 'img-{:05d}.{}'.format(current_frame,capture_ext)
+    taking_time.start()
+    frame = cam.take_raw_picture()
+    t = taking_time.stop()
+    taking_times.append(t)
+    print('Taken {} in {:.2f} secs'.format(current_frame,t))
+    find_perforation(frame.green())
+    if pf.found:
+	failed_frames = 0
+    else:
+	print('Perforation failed:{}'.format(fname))
+	failed_frames += 1
+	fname = 'failed-' + fname
+    cx,cy = pf.centre
+    raw_log.writerow( [ current_frame, fname, int(pf.found), cx, cy,
+			cx+cnf.crop_offset[0], cy+cnf.crop_offset[1], cnf.crop_size[0], cnf.crop_size[1],
+			'%.3f'%cnf.awb_gains[0], '%.3f'%cnf.awb_gains[1], cnf.shutter_speed ] )
+    return [ (os.path.join(fpath,fname), lambda: frame, 0, not pf.found) ]
+
 def bracket_pictures(current_frame):
-    # Takes the bracketed pictures
-    # At present it is hard coded to take two exposures - one normal and
-    # a much longer exposure.
+    # Takes the bracketed pictures - one for each exposure in the job's
+    # schedule of stops. The perforation is found in the exposure 
+    # closest to the normal one, and the same crop is used for all.
+    # Returns the images to write, as single_picture
     global cnf, capture_ext,fpath,failed_frames
     global taking_time, taking_times
-    fnames = [ 'img-{:05d}-1.{}'.format(current_frame,capture_ext),\
-	       'img-{:05d}-2.{}'.format(current_frame,capture_ext) ]
+    fnames = [ 'img-{:05d}-{}.{}'.format(current_frame,k+1,capture_ext) \
+	       for k in range(len(cnf.bracket_stops)) ]
     taking_time.start()
-    imgs = cam.take_bracket_pictures()
+    imgs = cam.take_bracket_pictures(yuv=(capture_mode=='yuv'))
     t = taking_time.stop()
     taking_times.append(t)
     print('Taken {} in {:.2f} secs'.format(current_frame,t))
-    if cnf.show_gray:
-	imgs[0] = cv2.cvtColor(imgs[0],cv2.COLOR_BGR2GRAY)
-	imgs[1] = cv2.cvtColor(imgs[1],cv2.COLOR_BGR2GRAY)
-    pf.find(imgs[0])
+    if cnf.show_gray and capture_mode != 'yuv':
+	imgs = [ cv2.cvtColor(img,cv2.COLOR_BGR2GRAY) for img in imgs ]
+    ref = bracket_ref
+    find_perforation(detection_image(imgs[ref]) if capture_mode == 'yuv' else imgs[ref])
     found = pf.found
+    writes = []
     if not found:
 	# Not found a perforation - but save full frame anyway
 	# So we can manually crop it later - if we have a previous
 	# perforation stored, then use this to fake a successful crop find
 	# even though it may be misaligned - means we don't get a missing frame
-	print('Perforation failed:{}'.format(fnames[0]))
+	print('Perforation failed:{}'.format(fnames[ref]))
 	failed_frames += 1
-	failednames = [ os.path.join( fpath, ('failed-' + fnames[0]) ), \
-			os.path.join( fpath, ('failed-' + fnames[1]) ) ]
-	q.put( (failednames[0],imgs[0]) )
-	q.put( (failednames[1],imgs[1]) )
+	for k,(fname,img) in enumerate(zip(fnames,imgs)):
+	    writes.append( (os.path.join( fpath, ('failed-' + fname) ), lambda img=img: full_image(img), k+1, True) )
 	if pf.position != (0,0):
 	    # Use last successful crop as a basis 
 	    found = True
@@ -211,74 +568,208 @@ def bracket_pictures(current_frame):
 	# Reset fail count if we found the perforation
 	failed_frames = 0
     if found:
-	imgs[0] = imgs[0][make_crop()]
-	imgs[1] = imgs[1][make_crop()]
-	fnames = [ os.path.join(fpath,fnames[0]), os.path.join(fpath,fnames[1]) ]
-	q.put( (fnames[0],imgs[0]) )
-	q.put( (fnames[1],imgs[1]) )
+	crop = make_crop()
+	for k,(fname,img) in enumerate(zip(fnames,imgs)):
+	    writes.append( (os.path.join(fpath,fname), lambda img=img: crop_image(img,crop), k+1, False) )
+    return writes
+
+move_thread = None	# Moves the film while the last frame is cropped and queued
+moving_frame = None	# Frame the film is being moved on from
+move_time = Stopwatch()
+
+def move(steps, forward):
+    move_time.start()
+    if forward:
+	tc.steps_forward(steps)
+    else:
+	tc.steps_back(steps)
+    stage_times['transport'].append( move_time.stop() )
+
+def start_transport(current_frame):
+    # Starts moving the film on to the next frame. The steps only depend
+    # on the perforation just found, so the images don't have to be written first
+    global move_thread, moving_frame
+    if not reverse:
+	steps = next_frame_steps()
+	pf.moved(steps*cnf.pixels_per_step)
+    else:
+	steps = prev_frame_steps()
+	pf.moved(-steps*cnf.pixels_per_step)
+    print('Moving %d steps'%(steps))
+    move_thread = threading.Thread(target=move, args=(steps,not reverse))
+    move_thread.start()
+    moving_frame = current_frame
+    if trace is not None:
+	trace.update(current_frame, steps=steps)
+    return steps
+
+def wait_transport():
+    # The film has to be still before the next picture is taken
+    # Returns the seconds waited
+    global move_thread
+    if move_thread is None:
+	return 0.0
+    t = time.time()
+    move_thread.join()
+    move_thread = None
+    t = time.time()-t
+    stage_times['transport wait'].append(t)
+    if trace is not None:
+	# The record of the frame moved on from is complete once the move is
+	trace.update(moving_frame, transport=stage_times['transport'][-1])
+	trace.done(moving_frame)
+    return t
+
+def stage_stats(frame_times):
+    # Time spent in each stage of the pipeline. The crop overlaps the
+    # transport, so a frame takes less than the sum of the stages
+    print('Stage               average   longest')
+    total = 0
+    for stage,times in stage_times.items():
+	if times:
+	    print('{:<18} {:>6.3f}s  {:>6.3f}s'.format(stage, sum(times)/len(times), max(times)))
+    stages = [ stage_times[stage] for stage in ('capture','detect','crop','transport') ]
+    if all(stages):
+	total = sum( sum(times)/len(times) for times in stages )
+	print('Sum of stages: {:.3f}s, time per frame: {:.3f}s'.format(total, sum(frame_times)/len(frame_times)))
 
 def run_job():
-    global q, job_finished
+    global q
     global cnf,job_name, start_frame, end_frame 
     global capture_direction, capture_ext, fpath
     global brackets, reverse
     global pf, tc, cam
-    global failed_frames
+    global failed_frames, frames, raw_log, raw_file, bracket_ref
     
     max_fails = 5 # Maximum number of adjacent failed perforation detections
     
     job_time = Stopwatch()
     job_time.start()
-    job_finished = False
-    t = threading.Thread(target=writer)
-    t.start()
+    start_writers(cnf.writer_threads, cnf.writer_processes)
+    start_journal()
+    server = start_metrics(cnf.metrics_port, cnf.metrics_address)
     print('Film type: {}'.format(pf.filmType))
     try:
 	tc.light_on()
 	cam.setup_cam(cnf.awb_gains, cnf.shutter_speed, cnf.drc, cnf.image_effect)
+	rewind_transport()
 	centre_frame()
+	if brackets and capture_mode != 'raw':
+	    # Gains have settled while centering, so can be locked now
+	    cam.setup_brackets(cnf.bracket_stops)
+	    stops = [ abs(stop) for stop in cnf.bracket_stops ]
+	    bracket_ref = stops.index(min(stops))
+	    print('Bracket exposures: {}'.format(', '.join('{:+g} stops ({}us)'.format(stop,shutter) \
+				for stop,shutter in zip(cnf.bracket_stops,cam.bracket_shutters))))
+	if cnf.sensor_crop and capture_mode != 'raw' and pf.found:
+	    start_sensor_crop()
+	if capture_mode == 'continuous':
+	    if brackets:
+		print('Continuous capture not available when bracketing - using still port')
+	    else:
+		print('Continuous capture with {} buffers'.format(cnf.capture_buffers))
+		frames = cam.continuous_pictures(cnf.capture_buffers)
+	if capture_mode == 'raw':
+	    if brackets:
+		print('Bracketing not available with raw capture')
+	    raw_file = open( os.path.join(fpath,'raw-frames.csv'), 'ab' )
+	    raw_log = csv.writer(raw_file)
 	frame_time = Stopwatch()
+	crop_time = Stopwatch()
 	frame_times = []
 	end_frame = end_frame + capture_direction	# Make list inclusive
 	for current_frame in range(start_frame,end_frame,capture_direction):
+	    if streamer is not None and streamer.failed:
+		print('Stopping - lost the connection to the ingest server')
+		break
 	    frame_time.start() # Start timing
-	    taking_time.start()
-	    if not brackets:
-		single_picture(current_frame)
+	    # Capture and detect, then start moving the film while this
+	    # frame is cropped and queued for writing
+	    wait = wait_transport()
+	    if trace is not None:
+		trace.frame(current_frame, start=time.time()-wait, transport_wait=wait)
+	    taken = time.time()
+	    if capture_mode == 'raw':
+		writes = raw_picture(current_frame)
+	    elif not brackets:
+		writes = single_picture(current_frame)
 	    else:
-		bracket_pictures(current_frame)
-	    if failed_frames >= max_fails:
+		writes = bracket_pictures(current_frame)
+	    if metrics is not None:
+		metrics.capture.observe(taking_times[-1])
+		metrics.detect.observe(stage_times['detect'][-1])
+		metrics.transportWait.observe(wait)
+		metrics.streak.set(failed_frames)
+		if not pf.found:
+		    metrics.failures.inc()
+	    if trace is not None:
+		trace.update(current_frame, capture=taking_times[-1], detect=stage_times['detect'][-1],
+			     found=pf.found, engine=pf.engine, ydiff=pf.yDiff if pf.found else None,
+			     failed_count=failed_frames, cropped=len(writes) > 0 )
+	    # In the full image - exactCentre is in the sensor crop when there is one
+	    centre = ( pf.exactCentre[0]+pf.imageOffset[0], pf.exactCentre[1]+pf.imageOffset[1] )
+	    stop = failed_frames >= max_fails
+	    if stop:
+		# The film isn't moved on, but the full frame is still saved
 		print('Maximum failed perforation detections')
-		break
-	    if not reverse:
-	    	next_frame()
+		steps = 0
 	    else:
-	    	prev_frame()
+		steps = start_transport(current_frame)
+	    journal.frame(current_frame, [ fn for fn,image,bracket,failed in writes ], centre, steps, not reverse, moved=not stop)
+	    crop_time.start()
+	    for fn,image,bracket,failed in writes:
+		if trace is not None:
+		    trace.queued(current_frame, fn)
+		queue_image( fn,image(),(current_frame,bracket,failed,centre,taken) )
+	    stage_times['crop'].append( crop_time.stop() )
+	    if stop:
+		if trace is not None:
+		    trace.done(current_frame)
+		break
+	    if encoder is not None:
+		encoder_written( encoder.poll() )
 	    t = frame_time.stop()
 	    print('Frame {} in {:.2f} secs'.format(current_frame, t))
 	    frame_times.append(t)
+	    if metrics is not None:
+		metrics.frameDone(current_frame)
+	    if trace is not None:
+		trace.update(current_frame, crop=stage_times['crop'][-1], total=t,
+			     queue_depth=queue_depth(), buffer_fill=ring.fill() if ring is not None else None)
     finally:
+	wait_transport()
 	tc.light_off()
+	if frames is not None:
+	    frames.close()
+	if raw_log is not None:
+	    raw_file.close()
 	cam.close()
-	job_finished = True	# Signals the writing thread to finish
-	while still_writing:
-	    # Wait until writing queue is empty
-	    time.sleep(0.1)
+	# Wait until the writing queue is empty
+	stop_writers()
+	journal.close()
+	if trace is not None:
+	    trace.close()
+	if server is not None:
+	    server.stop()
     jt = job_time.stop()
     minutes = jt // 60
     seconds = jt % 60
-    job_finished = True		
-    ave_per_frame = sum(frame_times) / len(frame_times)
-    ave_camera_time = sum(taking_times) / len(taking_times)
-    # Some stats
+    # Some stats - the job may have stopped before a frame was finished
     print('%d frames'%(len(frame_times)))
     print('Elapsed time {:.0f} mins {:.1f} secs'.format(minutes,seconds))
-    print('Average time per frame: {:.2f} secs'.format(ave_per_frame))
-    print('Fastest frame: {:.2f} secs'.format(min(frame_times)))
-    print('Slowest frame: {:.2f} secs'.format(max(frame_times)))
-    print('Average camera time per frame: {:.2f} secs'.format(ave_camera_time))
-    print('Fastest frame: {:.2f} secs'.format(min(taking_times)))
-    print('Slowest frame: {:.2f} secs'.format(max(taking_times)))
+    if frame_times:
+	ave_per_frame = sum(frame_times) / len(frame_times)
+	print('Average time per frame: {:.2f} secs'.format(ave_per_frame))
+	print('Fastest frame: {:.2f} secs'.format(min(frame_times)))
+	print('Slowest frame: {:.2f} secs'.format(max(frame_times)))
+    if taking_times:
+	ave_camera_time = sum(taking_times) / len(taking_times)
+	print('Average camera time per frame: {:.2f} secs'.format(ave_camera_time))
+	print('Fastest frame: {:.2f} secs'.format(min(taking_times)))
+	print('Slowest frame: {:.2f} secs'.format(max(taking_times)))
+    if frame_times:
+	stage_stats(frame_times)
+    writer_stats(jt)
     
   
 if __name__ == '__main__':
@@ -286,8 +777,15 @@ if __name__ == '__main__':
     parse_commandline()
     cnf.read_configfile(job_name)
     brackets = brackets or cnf.brackets
+    capture_mode = capture_mode or cnf.capture_mode
+    if capture_mode == 'raw':
+	print('Saving raw Bayer data')
+	capture_ext = 'raw'
     pf.init( filmType=cnf.film_type, imageSize=cam.MAX_IMAGE_RESOLUTION,
                     expectedSize=cnf.perf_size, cx=cnf.perf_cx )
+    pf.setReduction(cnf.perf_reduction)
+    pf.tracking = cnf.perf_tracking
+    pf.setEngines(cnf.perf_engines)
     try:
 	pf.setROI()
     except:
@@ -315,6 +813,10 @@ if __name__ == '__main__':
 	print('%s is a file not a directory'%fpath)
 	quit()
 
+    if resume_job:
+	resume_point()
+    if trace_job:
+	trace = rpiTelecine.frameTrace( os.path.join(fpath,'trace.jsonl') )
     run_job()
     
     
\ No newline at end of file
@@ -40,6 +40,7 @@ from __future__ import division
 
 import argparse
 import cv2
+import numpy as np
 
 from tc_common import *
 
@@ -55,6 +56,7 @@ b | B	Reduce|increase blue gain
 p	Toggle perforation detection
 o	Centre frame
 i	Redetect perforation
+x	Compare detection engines over the next 8 frames
 #	Calibrate Transport (same as u/t/y)
 t | y	Calibrate transport forward/backward
 u	Calibrate pixels per motor step
@@ -73,36 +75,39 @@ scale_display = 3
 
 saving = False
 
-def get_pixels_per_step(times=5):
+def get_pixels_per_step(times=3):
     # Establishes how many pixels in the image per motor step
-    # Takes an average
+    # from how far the perforation moves. Takes an average
     steps = 60
     counts = []
     tc.tension_film()
     for n in range(times):
-	centre_frame()
-	img = cam.take_picture()
-	pf.find(img)
-	centre = pf.centre[1]
+	if not centre_frame():
+	    continue
+	# Position of the perforation centre_frame finished on
+	centre = pf.exactCentre[1]
 	tc.steps_forward(steps)
 	img = cam.take_picture()
 	pf.find(img)
 	found1 = pf.found
 	if found1:
-	    pixels_per_step = abs(pf.yDiff)/float(steps)
+	    # Moving forward moves the film up the image
+	    pixels_per_step = (centre-pf.exactCentre[1])/float(steps)
 	    counts.append(pixels_per_step)
-	    centre = pf.centre[1]
 	tc.steps_back(steps*2)
 	img = cam.take_picture()
 	pf.find(img)
 	found2 = pf.found
 	if found2:
-	    pixels_per_step = (pf.yDiff)/float(steps*2)
+	    pixels_per_step = (pf.exactCentre[1]-centre)/float(steps)
 	    counts.append(pixels_per_step)
 	tc.steps_forward(steps)
 	if not(found1 and found2):
 	    # Perforation went out of view - so reduce number of steps
 	    steps = int(steps/1.4)
+    if not counts:
+	print("Perforation not found - pixels per step not changed")
+	return
     cnf.pixels_per_step = sum(counts)/len(counts)
     print("Pixels per step:{}".format(cnf.pixels_per_step))
 
@@ -110,6 +115,10 @@ def calibrate_transport(frames=18,d=True):
     # Calibrate the film transport over a number of frames
     # This establishes how many motor steps are needed on average
     # for a sequence of frames. d=True - move forwards, else move backwards
+    # The steps each frame needed come from how far the perforation ended
+    # up from where the last one was, so the film isn't moved back and forth
+    # to centre each frame. The next jump allows for how far off centre
+    # the perforation is, so it only takes one capture per frame
     steps_per_frame = []
     ave_steps = cnf.ave_steps_fd if d else cnf.ave_steps_bk
     pixels_per_step = max(2,min(10,cnf.pixels_per_step))
@@ -117,41 +126,45 @@ def calibrate_transport(frames=18,d=True):
     print('Calibrating ' + 'Forward' if d else 'Backward')
     print('Pixels per step:{:.3f}'.format(pixels_per_step))
     centre_frame()
+    last = pf.yDiff if pf.found else 0
     steps = 250 # Jump a minimum number of steps
+    captures = 0
     for n in range(frames):
 	print('Calibrating - frame:%d'%(n))
-	diff=500
 	tc.steps_forward(steps) if d else tc.steps_back(steps)
-	while abs(diff)>10:
-	    # Zero in on centre point 
+	moved = steps
+	img = cam.take_picture()
+	captures += 1
+	pf.find(img)
+	while not pf.found and moved < steps+200:
+	    # Need to put something a bit more intelligent here 
+	    # when we fail to read a perforation
+	    print "perforation not found"
+	    tc.steps_forward(20) if d else tc.steps_back(20)
+	    moved += 20
 	    img = cam.take_picture()
+	    captures += 1
 	    pf.find(img)
-	    if pf.found:
-		diff = pf.yDiff
-		s = int(round(abs(diff)/pixels_per_step))
-		if s<2: s=2
-		print('Diff: {} s: {}'.format(diff,s))
-		if diff < -10:
-		    tc.steps_back(s)
-		    steps = steps-s if d else steps+s
-		elif diff > 10:
-		    tc.steps_forward(s)
-		    steps = steps+s if d else steps-s
-		else:
-		    # Pretty close to the centre
-		    steps_per_frame.append(steps) 
-		    #print('Steps %d'%(steps))
-	    else:
-		# Need to put something a bit more intelligent here 
-		# when we fail to read a perforation
-		print "perforation not found"
-		tc.steps_forward(20) if d else tc.steps_back(20)
-		steps += 20
+	if not pf.found:
+	    break
+	diff = pf.yDiff
+	# Moving forwards moves the film up the image
+	shift = (diff-last)/pixels_per_step
+	steps_per_frame.append( moved+shift if d else moved-shift )
+	ave = sum(steps_per_frame)/len(steps_per_frame)
+	correction = diff/pixels_per_step
+	steps = int(round( ave+correction if d else ave-correction ))
+	last = diff
+	print('Diff: {:.1f} steps: {:.1f}'.format(diff,steps_per_frame[-1]))
+    if not steps_per_frame:
+	print('Perforation not found - steps per frame not changed')
+	return
     ave_steps = int(round(sum(steps_per_frame)/float(len(steps_per_frame))))
     print('Steps per frame:')
-    print(steps_per_frame)
+    print(' '.join('%.1f'%steps for steps in steps_per_frame))
     print('Ave steps over %d frames is %d'%(len(steps_per_frame),ave_steps))
-    print('Min:%d Max:%d'%(min(steps_per_frame),max(steps_per_frame)))
+    print('Min:%.1f Max:%.1f'%(min(steps_per_frame),max(steps_per_frame)))
+    print('Captures per frame: %.2f'%(captures/float(len(steps_per_frame))))
     if d:
 	cnf.ave_steps_fd = ave_steps
     else:
@@ -207,6 +220,24 @@ def play_frames(frames=18,dr=True):
 	if k==cv2_keys['Escape']:
 	    break
 	    
+def compare_engines(frames=8):
+    # Runs every detection engine on the same frames, and reports how
+    # long each takes and how well they agree on the perforation position
+    imgs = []
+    for n in range(frames):
+	img = cam.take_picture()
+	pf.find(img)
+	imgs.append(img)
+	next_frame()
+    results = rpiTelecine.compareEngines(pf, imgs)
+    print('{:<10} {:>6} {:>8} {:>8} {:>10} {:>6}'.format('engine','found','ms p50','ms max','max dev','agree'))
+    for name,r in results.items():
+	ms = [ t*1000 for t in r['times'] ]
+	deviation = max(r['deviation']) if r['deviation'] else float('nan')
+	print('{:<10} {:>3}/{:<2} {:>8.1f} {:>8.1f} {:>10.1f} {:>5.0f}%'.format( name, r['found'], frames,
+		np.median(ms), max(ms), deviation, 100*r['agreement'] ))
+    print('Engines in use: {}'.format(','.join(cnf.perf_engines)))
+
 def adjust_crop(key,img_w,img_h):
     # Move, resize crop
     steps = 10
@@ -314,6 +345,14 @@ def setup_telecine():
 	    elif key==ord('o'):
 		print('Centering frame')
 		centre_frame()
+	    elif key==ord('i'):
+		print('Redetecting perforation')
+		pf.findFirst(img)
+		if pf.found:
+		    print('Perforation found: {} {}'.format(pf.position,pf.expectedSize))
+	    elif key==ord('x'):
+		print('Comparing detection engines')
+		compare_engines(8)
 	    elif key==ord('#'):
 		print('Calibrating transport')
 		print('Discovering pixels per motor step')
@@ -447,6 +486,8 @@ if __name__ == '__main__':
                     expectedSize=cnf.perf_size, cx=cnf.perf_cx )
     else:
         pf.setFilmType(cnf.film_type)
+    pf.setReduction(cnf.perf_reduction)
+    pf.setEngines(cnf.perf_engines)
 
     if args.brackets:
 	print('Bracketing on')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# RPi Telecine - Timing trace analyser
+#
+# Usage: python tc-trace.py job/trace.jsonl [-n slowest] [-a]
+#
+# Reads the trace written by tc-run.py --trace and shows where the time
+# went. For each stage it prints the percentiles of the time taken, and
+# for the stages of the capture loop the share of the job's time. Then the
+# slowest frames, with the stage that took longest in each.
+#
+# The stages in the capture loop, one after the other, are:
+# transport_wait	Waiting for the film to stop before the capture
+# capture		Taking the picture
+# detect		Finding the perforation
+# crop		Cropping and queuing the images
+# The film is moved on (transport) during the crop, and the images are
+# written (queue_wait, encode) by the writers while the next frames are taken.
+#
+# The trace is appended to each time the job is run - only the last run
+# is analysed unless -a is given.
+#
+# Copyright (c) 2015, Jason Lane
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import division
+
+import argparse
+import collections
+import json
+import numpy as np
+
+loop_stages = ('transport_wait','capture','detect','crop')
+stages = loop_stages + ('total','transport','queue_wait','encode')
+
+def read_trace(fn, all_runs=False):
+    records = []
+    with open(fn) as f:
+	for line in f:
+	    try:
+		records.append( json.loads(line) )
+	    except ValueError:
+		# A line cut short if the job was killed
+		pass
+    if records and not all_runs:
+	last = max( r.get('run',0) for r in records )
+	records = [ r for r in records if r.get('run',0) == last ]
+    return sorted( records, key=lambda r: r.get('start',0) )
+
+def values(records, stage):
+    return [ r[stage] for r in records if r.get(stage) is not None ]
+
+def stage_table(records):
+    elapsed = sum( values(records,'total') )
+    print('{:<16} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7}'.format('stage (secs)','mean','p50','p90','p99','max','share'))
+    for stage in stages:
+	v = values(records, stage)
+	if not v:
+	    continue
+	share = '{:>6.1f}%'.format(100*sum(v)/elapsed) if stage in loop_stages and elapsed else '{:>7}'.format('-')
+	p50,p90,p99 = np.percentile(v,(50,90,99))
+	print('{:<16} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {}'.format(stage, np.mean(v), p50, p90, p99, max(v), share))
+
+def summary(records):
+    found = sum( 1 for r in records if r.get('found') )
+    starts = values(records,'start')
+    elapsed = max( r['start']+r.get('total',0) for r in records if 'start' in r ) - min(starts) if starts else 0
+    print('{} frames in {:.1f} secs - {:.2f} frames/sec'.format(len(records), elapsed, len(records)/elapsed if elapsed else 0))
+    print('Perforation found in {} frames ({:.1f}%)'.format(found, 100*found/len(records)))
+    engines = collections.Counter( r.get('engine') for r in records if r.get('found') )
+    if engines:
+	print('Engines: {}'.format(', '.join('{} {}'.format(name,count) for name,count in engines.most_common())))
+    images = sum( values(records,'images') )
+    print('{} images, {:.1f} MB written, {} failed to write'.format(
+	    images, sum(values(records,'bytes'))/1e6, sum(values(records,'write_failed')) ))
+    levels = collections.Counter( level for r in records for level in r.get('levels',[]) )
+    if len(levels) > 1:
+	print('Encode levels: {}'.format(', '.join('{} {}'.format(level,count) for level,count in sorted(levels.items()))))
+    depth = values(records,'queue_depth')
+    fill = values(records,'buffer_fill')
+    if depth:
+	print('Queue depth: mean {:.1f}, most {}'.format(np.mean(depth), max(depth)) +
+	      (', write buffer at most {:.0f}% full'.format(100*max(fill)) if fill else ''))
+    incomplete = sum( 1 for r in records if r.get('incomplete') )
+    if incomplete:
+	print('{} frames still being written when the job stopped'.format(incomplete))
+
+def slowest(records, n):
+    print('Slowest frames')
+    print('{:>7} {:>8}  {:<16} {:>8}  {}'.format('frame','secs','longest stage','secs','engine'))
+    for r in sorted( records, key=lambda r: r.get('total',0), reverse=True )[:n]:
+	stage = max( loop_stages, key=lambda s: r.get(s) or 0 )
+	print('{:>7} {:>8.3f}  {:<16} {:>8.3f}  {}'.format( r['frame'], r.get('total',0), stage,
+		r.get(stage) or 0, r.get('engine') if r.get('found') else 'not found' ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show where the time of a job went, from the trace written by tc-run.py --trace')
+    parser.add_argument('trace', help='trace.jsonl in the job folder')
+    parser.add_argument('-n','--slowest', type=int, default=10, help='Number of slowest frames to show')
+    parser.add_argument('-a','--all', action='store_true', help='Analyse every run in the trace, not just the last')
+    args = parser.parse_args()
+    records = read_trace(args.trace, args.all)
+    if not records:
+	print('No frames in {}'.format(args.trace))
+	quit()
+    summary(records)
+    print('')
+    stage_table(records)
+    print('')
+    slowest(records, args.slowest)
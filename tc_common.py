@@ -34,14 +34,25 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import division
+import os
 import time
 import cv2
 import rpiTelecine
 
-cam = rpiTelecine.TelecineCamera()
+# Setting TELECINE_REPLAY to a directory of images, a .npy file of images, or
+# 'synthetic' (or 'synthetic:std8') runs the scripts with the replay camera
+# and control instead of the Pi hardware
+replay_source = os.environ.get('TELECINE_REPLAY','')
+
+if replay_source:
+    tc  = rpiTelecine.replayControl()
+    cam = rpiTelecine.replayCamera(replay_source, tc)
+else:
+    cam = rpiTelecine.TelecineCamera()
 cnf = rpiTelecine.telecineConfig()
 pf  = rpiTelecine.telecinePerforation()
-tc  = rpiTelecine.tcControl()
+if not replay_source:
+    tc  = rpiTelecine.tcControl()
 	
 # Some useful values returned by cv2.waitKey - 
 # probably platform dependent
@@ -100,28 +111,52 @@ def display_thumb(window_name,img,reduction=2, text=''):
 
     cv2.imshow(window_name,newimg)
 
-def next_frame():
-    # Move to next frame
+reference_pitch = None	# (ave_steps_fd, first pitch measured with it)
+
+def next_frame_steps():
+    # Steps to the next frame from the perforation just found
+    global reference_pitch
     steps = cnf.ave_steps_fd
+    if pf.found and pf.measuredPitch:
+	# The distance to the next perforation was measured with this one.
+	# ave_steps_fd was calibrated on this film, so it is only scaled by
+	# how much the pitch has changed since - shrinkage along the reel.
+	# Using the pitch on its own would turn any error in pixels_per_step
+	# into a fixed offset of every frame
+	if reference_pitch is None or reference_pitch[0] != cnf.ave_steps_fd:
+	    reference_pitch = (cnf.ave_steps_fd, pf.measuredPitch)
+	steps = steps*pf.measuredPitch/reference_pitch[1]
     if pf.found:
 	diff = pf.yDiff # Pixels of centre of perf to centre of ROI
-	steps = steps + int(round(diff/cnf.pixels_per_step))
+	steps = steps + diff/cnf.pixels_per_step
+    return int(round(steps))
+
+def prev_frame_steps():
+    steps = cnf.ave_steps_bk
+    if pf.found:
+	diff = pf.yDiff # Pixels of centre of perf to centre of ROI
+	steps = steps - int(round(diff/cnf.pixels_per_step))
+    return steps
+
+def next_frame():
+    # Move to next frame
+    steps = next_frame_steps()
     print('Moving %d steps'%(steps))
     tc.steps_forward(steps)
+    pf.moved(steps*cnf.pixels_per_step)
     
     
 def prev_frame():
     # Move to next frame
-    steps = cnf.ave_steps_bk
-    if pf.found:
-	diff = pf.yDiff # Pixels of centre of perf to centre of ROI
-	steps = steps - int(round(diff/cnf.pixels_per_step))
+    steps = prev_frame_steps()
     print('Moving %d steps'%(steps))
     tc.steps_back(steps)
+    pf.moved(-steps*cnf.pixels_per_step)
     
 
 def centre_frame():
     # Attempt to centre the frame on the perforation
+    # Returns True if the perforation was centred
     done = False
     count = 10
     print('Centering')
@@ -130,23 +165,40 @@ def centre_frame():
 	img = cam.take_picture()
 	pf.find(img)
 	if pf.found:
+	    steps = int(round(pf.yDiff/cnf.pixels_per_step))
 	    if pf.yDiff > 10:
-		tc.steps_forward(int(pf.yDiff/cnf.pixels_per_step))
+		tc.steps_forward(steps)
+		pf.moved(steps*cnf.pixels_per_step)
 	    elif pf.yDiff < -10:
-		tc.steps_back(int(abs(pf.yDiff)/cnf.pixels_per_step))
+		tc.steps_back(-steps)
+		pf.moved(steps*cnf.pixels_per_step)
 	    else:
 		# Pretty close to the centre
 		done = True
 	else:
-	    # No perforation found so step forward 1/3 frame which should
-	    # get a perforation into the ROI
-	    tc.steps_forward(int(cnf.ave_steps_fd/3))
+	    # Coarse search of the whole image height for a perforation
+	    candidate = pf.findCandidate(img)
+	    diff = candidate[1]-pf.ROIcentrexy[1] if candidate else 0
+	    steps = int(round(diff/cnf.pixels_per_step))
+	    if diff > 10:
+		tc.steps_forward(steps)
+		pf.moved(steps*cnf.pixels_per_step)
+	    elif diff < -10:
+		tc.steps_back(-steps)
+		pf.moved(steps*cnf.pixels_per_step)
+	    else:
+		# No perforation found so step forward 1/3 frame which should
+		# get a perforation into the ROI
+		tc.steps_forward(int(cnf.ave_steps_fd/3))
+		pf.moved(int(cnf.ave_steps_fd/3)*cnf.pixels_per_step)
+    return done
 
 def fast_wind(frames,d=True):
     # Fast wind a lot of frames
     steps = cnf.ave_steps_fd if d else cnf.ave_steps_bk
     steps = steps * frames
     tc.steps_forward(steps) if d else tc.steps_back(steps)
+    pf.moved(steps*cnf.pixels_per_step if d else -steps*cnf.pixels_per_step)
     centre_frame()
     
 def sanitise_job_name(job_name):